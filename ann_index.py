@@ -0,0 +1,213 @@
+import os
+import math
+import logging
+import torch
+
+from gradient_store import GradientStore
+
+INDEX_METRICS = ["dot", "cosine"]
+
+
+def index_file(metric):
+    """Name of the index of a gradient store (it is saved inside the store's directory)."""
+    return f"ivfpq_{metric}.pt"
+
+
+def _squared_distances(x, centroids):
+    return (x ** 2).sum(dim=-1, keepdim=True) - 2 * x @ centroids.T + (centroids ** 2).sum(dim=-1)[None, :]
+
+
+def _nearest(x, centroids, block_size=2**14):
+    return torch.cat([_squared_distances(block, centroids).argmin(dim=-1) for block in x.split(block_size)])
+
+
+def kmeans(x, k, iterations, generator):
+    """Lloyd's k-means, initialised with random points. Empty clusters are moved to random points again, and the
+    clusters still empty after the last iteration are dropped (e.g. for duplicate points), so there may be fewer than k."""
+    k = min(k, len(x))
+    centroids = x[torch.randperm(len(x), generator=generator)[:k]].clone()
+    for _ in range(iterations):
+        assignment = _nearest(x, centroids)
+        counts = torch.bincount(assignment, minlength=len(centroids))
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        centroids = sums / counts.clamp_min(1)[:, None]
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = x[torch.randint(len(x), (int(empty.sum()),), generator=generator)]
+    counts = torch.bincount(_nearest(x, centroids), minlength=len(centroids))
+    return centroids[counts > 0]
+
+
+class IVFPQIndex:
+    """An inverted file index with product quantisation (IVF-PQ) for inner-product or cosine search over the
+    (projected) gradients of a gradient store.
+
+    Gradients are assigned to the nearest of `num_lists` k-means centroids. Their residuals are split into
+    `num_subspaces` parts, and each part is replaced by the id (one byte) of the nearest of 256 sub-centroids.
+    A query only visits the `nprobe` lists whose centroids score highest, and approximates
+    q . x = q . centroid + sum over parts of q_part . sub-centroid from one lookup table per query. The best
+    candidates can then be re-scored exactly from the memory-mapped store (`rerank`).
+
+    For 'cosine', gradients and queries are normalised, so it is an inner-product search as well.
+    """
+
+    def __init__(self, centroids, codebooks, codes, ids, list_offsets, metric, metadata=None):
+        self.centroids = centroids # [num_lists, dim]
+        self.codebooks = codebooks # [num_subspaces, 256, sub_dim]
+        self.codes = codes # [N, num_subspaces] uint8, sorted by list
+        self.ids = ids # [N] store row of every code
+        self.list_offsets = list_offsets # [num_lists + 1]
+        self.metric = metric
+        self.metadata = metadata or {}
+        self.store = None
+
+    @property
+    def dim(self):
+        return self.centroids.shape[-1]
+
+    def _prepare(self, x):
+        x = x.float().reshape(len(x), -1)
+        if self.metric == "cosine":
+            x = torch.nn.functional.normalize(x, p=2, dim=-1)
+        return x
+
+    def _split(self, x):
+        """Zero-pads to num_subspaces * sub_dim and splits: [n, num_subspaces, sub_dim]."""
+        num_subspaces, _, sub_dim = self.codebooks.shape
+        x = torch.nn.functional.pad(x, (0, num_subspaces * sub_dim - x.shape[-1]))
+        return x.view(len(x), num_subspaces, sub_dim)
+
+    def _encode(self, residuals):
+        parts = self._split(residuals)
+        return torch.stack([_nearest(parts[:, j], self.codebooks[j]) for j in range(parts.shape[1])], dim=1).to(torch.uint8)
+
+    @classmethod
+    def build(cls, store, metric="dot", num_lists=None, num_subspaces=64, sample_size=2**16, iterations=20, block_size=4096, seed=42):
+        """Trains the quantisers on a random sample of the store and encodes all of its gradients.
+
+        Args:
+            store: A (dense) GradientStore, e.g. of projected gradients
+            metric: 'dot' or 'cosine'
+            num_lists: Number of inverted lists (default: about 4 * sqrt(N))
+            num_subspaces: Number of PQ parts (bytes per gradient)
+            sample_size: Number of gradients the k-means steps are trained on
+            iterations: Number of k-means iterations
+            block_size: Number of gradients encoded at a time
+            seed: Random seed
+
+        Returns:
+            The IVFPQIndex
+        """
+        if store.ragged:
+            raise ValueError("Indexes need dense (e.g. projected) gradients")
+        if metric not in INDEX_METRICS:
+            raise ValueError(f"Unknown metric {metric}, use one of {INDEX_METRICS}")
+        generator = torch.Generator().manual_seed(seed)
+        num_rows = len(store)
+        num_lists = num_lists or max(1, int(4 * math.sqrt(num_rows)))
+        sub_dim = math.ceil(store.dim / num_subspaces)
+
+        index = cls(None, torch.zeros(num_subspaces, 1, sub_dim), None, None, None, metric, metadata={
+            key: store.manifest.get(key) for key in ["dim", "projection", "model", "model_revision", "dataset", "dataset_split", "dataset_fingerprint", "num_rows"]
+        })
+        sample_rows = torch.randperm(num_rows, generator=generator)[:sample_size].sort().values
+        sample = index._prepare(store.take(sample_rows))
+
+        logging.info(f"training {num_lists} coarse centroids on {len(sample)} gradients ...")
+        index.centroids = kmeans(sample, num_lists, iterations, generator)
+        residuals = index._split(sample - index.centroids[_nearest(sample, index.centroids)])
+        logging.info(f"training {num_subspaces} x 256 sub-centroids ...")
+        codebooks = [kmeans(residuals[:, j], 256, iterations, generator) for j in range(num_subspaces)]
+        # fewer than 256 sub-centroids (tiny stores, duplicate residuals): pad with copies of the first, never the nearest
+        index.codebooks = torch.stack([torch.cat([c, c[:1].expand(256 - len(c), -1)]) for c in codebooks])
+
+        logging.info(f"encoding {num_rows} gradients ...")
+        lists, codes = [], []
+        for _, block in store.iter_blocks(block_size):
+            block = index._prepare(block)
+            assignment = _nearest(block, index.centroids)
+            lists.append(assignment)
+            codes.append(index._encode(block - index.centroids[assignment]))
+        lists, codes = torch.cat(lists), torch.cat(codes)
+
+        order = torch.argsort(lists, stable=True)
+        index.ids = order
+        index.codes = codes[order]
+        index.list_offsets = torch.zeros(len(index.centroids) + 1, dtype=torch.long)
+        index.list_offsets[1:] = torch.cumsum(torch.bincount(lists, minlength=len(index.centroids)), dim=0)
+        index.store = store
+        return index
+
+    def search(self, queries, k, nprobe=8, rerank=4):
+        """Approximate top-k search.
+
+        Args:
+            queries: A [M, dim] tensor of (test) gradients
+            k: Number of results per query
+            nprobe: Number of (non-empty) inverted lists visited per query. The next closest lists are visited as well
+                while there are fewer than the `rerank * k` (or k) candidates needed
+            rerank: Re-score the best `rerank * k` candidates exactly from the store (0: return PQ estimates)
+
+        Returns:
+            ([M, k] scores, [M, k] store rows), best first
+        """
+        queries = self._prepare(queries)
+        if queries.shape[-1] != self.dim:
+            raise ValueError(f"Incompatible gradient dimensions: {queries.shape[-1]} (queries) and {self.dim} (index).")
+        nprobe = min(nprobe, len(self.centroids))
+        num_candidates = k * rerank if rerank else k
+
+        all_scores, all_rows = [], []
+        for query, parts in zip(queries, self._split(queries)):
+            coarse = self.centroids @ query
+            # one lookup table per query: [num_subspaces, 256]
+            table = torch.einsum("jcd,jd->jc", self.codebooks, parts)
+            scores, rows = [torch.empty(0)], [torch.empty(0, dtype=self.ids.dtype)]
+            num_probed, num_found = 0, 0
+            for l in torch.argsort(coarse, descending=True).tolist():
+                if num_probed >= nprobe and num_found >= num_candidates:
+                    break
+                start, end = self.list_offsets[l], self.list_offsets[l + 1]
+                if start == end:
+                    continue
+                codes = self.codes[start:end].long()
+                scores.append(coarse[l] + table.gather(1, codes.T).sum(dim=0))
+                rows.append(self.ids[start:end])
+                num_probed, num_found = num_probed + 1, num_found + int(end - start)
+            scores, rows = torch.cat(scores), torch.cat(rows)
+            best = torch.topk(scores, min(num_candidates, len(scores)))
+            scores, rows = best.values, rows[best.indices]
+
+            if rerank:
+                sorted_rows, order = rows.sort()
+                exact = self._prepare(self.store.take(sorted_rows)) @ query
+                scores, rows = torch.empty_like(exact), torch.empty_like(rows)
+                scores[order], rows[order] = exact, sorted_rows
+                best = torch.topk(scores, min(k, len(scores)))
+                scores, rows = best.values, rows[best.indices]
+
+            # fewer candidates than k: pad
+            all_scores.append(torch.nn.functional.pad(scores[:k], (0, k - len(scores[:k])), value=-math.inf))
+            all_rows.append(torch.nn.functional.pad(rows[:k], (0, k - len(rows[:k])), value=-1))
+        return torch.stack(all_scores), torch.stack(all_rows)
+
+    def save(self, path):
+        torch.save({
+            "centroids": self.centroids,
+            "codebooks": self.codebooks,
+            "codes": self.codes,
+            "ids": self.ids,
+            "list_offsets": self.list_offsets,
+            "metric": self.metric,
+            "metadata": self.metadata,
+        }, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved inside a gradient store (the store is opened for re-ranking)."""
+        state = torch.load(path)
+        index = cls(state["centroids"], state["codebooks"], state["codes"], state["ids"], state["list_offsets"], state["metric"], state["metadata"])
+        index.store = GradientStore(os.path.dirname(os.path.abspath(path)))
+        if index.store.manifest.get("dataset_fingerprint") != index.metadata.get("dataset_fingerprint") or len(index.store) != len(index.ids):
+            raise ValueError(f"The gradient store has changed since {path} was built")
+        return index
@@ -0,0 +1,65 @@
+"""Compares benchmark results (see run.py) with a baseline and flags regressions.
+
+    python benchmarks/compare.py results.json baseline.json [--tolerance 0.1]
+
+Exits with status 1 if any benchmark got slower by more than the tolerance.
+"""
+import sys
+import json
+import argparse
+
+
+def get_key(result):
+    return result["suite"], result["name"], json.dumps(result["params"], sort_keys=True), result["metric"]
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Matches results with the baseline by suite, name, parameters and metric.
+
+    Returns:
+        A list of (result, baseline value, relative change, regressed) for every matched result. The change is
+        positive for an improvement (e.g. +0.2 = 20% faster), whatever the direction of the metric.
+    """
+    baseline = {get_key(r): r["value"] for r in baseline}
+    comparison = []
+    for result in results:
+        reference = baseline.get(get_key(result))
+        if reference is None:
+            continue
+        if result["higher_is_better"]:
+            change = result["value"] / reference - 1
+        else:
+            change = reference / result["value"] - 1
+        comparison.append((result, reference, change, change < -tolerance))
+    return comparison
+
+
+def print_comparison(results, baseline, tolerance=0.1):
+    """Prints the comparison and returns the number of regressions."""
+    comparison = compare_results(results, baseline, tolerance)
+    for result, reference, change, regressed in comparison:
+        print(f"{'REGRESSION' if regressed else '':<10} {result['suite']:<11} {result['name']:<34} {json.dumps(result['params']):<70} {result['metric']:<22} {reference:.4g} -> {result['value']:.4g} ({change:+.1%})")
+    regressions = sum(regressed for *_, regressed in comparison)
+    unmatched = len(results) - len(comparison)
+    print(f"{len(comparison)} compared, {regressions} regression(s) beyond {tolerance:.0%}" + (f", {unmatched} without a baseline" if unmatched else ""))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("compare")
+    parser.add_argument("results", help="Results of run.py")
+    parser.add_argument("baseline", help="Results of an earlier run.py to compare with")
+    parser.add_argument("--tolerance", help="Relative slow-down that counts as a regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(args.results, encoding="utf-8") as f:
+        results = json.load(f)
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    for key in ["cpu_count", "num_threads", "processor", "torch"]:
+        if results["environment"].get(key) != baseline["environment"].get(key):
+            print(f"warning: {key} differs ({baseline['environment'].get(key)} -> {results['environment'].get(key)}), the numbers may not be comparable")
+    if results.get("quick") != baseline.get("quick"):
+        print("warning: one of the runs used --quick, only the shared sizes are compared")
+
+    sys.exit(1 if print_comparison(results["results"], baseline["results"], args.tolerance) else 0)
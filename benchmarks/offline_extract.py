@@ -0,0 +1,23 @@
+"""Runs extract_gradients.py with a local model of synthetic.py (no Hub access, no wandb).
+
+Usage: python benchmarks/offline_extract.py <model dir> <dataset dir> <checkpoint_nr> [extract_gradients.py options]
+"""
+import os
+import sys
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["WANDB_MODE"] = "disabled"
+os.environ.pop("WANDB_API_KEY", None)
+
+import extract_gradients
+import synthetic
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    extractor = extract_gradients.GradientExtractor(extract_gradients.parse_args())
+    extractor.checkpoints = synthetic.get_checkpoints(extractor.args.model) # instead of listing the Hub
+    extractor.run()
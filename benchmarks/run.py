@@ -0,0 +1,252 @@
+"""CPU benchmarks of tokenization, gradient extraction, projection, the gradient store and scoring.
+
+Everything is built locally from fixed seeds (synthetic.py), so results only depend on the code and the machine.
+Results are written as JSON, and can be compared with a saved baseline (see compare.py):
+
+    python benchmarks/run.py --output results.json [--quick] [--suites projection scoring] [--baseline baseline.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import torch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import synthetic
+import compare
+from olmo_training_utils import sft_tulu_tokenize_and_truncate_v1, sft_tulu_tokenize_and_truncate_v2, get_tokenized_sft_dataset
+from projectors import get_projector
+from gradient_store import AsyncShardWriter, GradientStore
+from scoring import compute_scores
+
+SUITES = ["tokenize", "extract", "projection", "store", "scoring"]
+
+# sizes of the full run; --quick uses the second value of each pair
+SIZES = {
+    "tokenize_rows": (200, 40),
+    "extract_rows": ((16, 48), (8, 24)), # the rate is taken between the two, so model loading drops out
+    "extract_batch_sizes": ([1, 4], [1, 4]),
+    "projection_grad_dims": ([2**15, 2**18], [2**15]),
+    "projection_proj_dims": ([512, 4096], [512]),
+    "projection_types": (["rademacher", "normal", "srht", "countsketch", "very_sparse"], ["rademacher", "srht", "countsketch"]),
+    "store_shapes": ([(4096, 4096), (256, 2**17)], [(1024, 4096)]),
+    "scoring_train_rows": ([4096, 32768], [4096]),
+    "scoring_dims": ([256, 4096], [512]),
+    "scoring_test_rows": ([16, 256], [16]),
+}
+
+
+def timed(fn, repeats):
+    """Runs `fn` once to warm up, then `repeats` times. Returns the wall-clock times (s)."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(suite, name, params, metric, value, times=None, higher_is_better=True):
+    return {"suite": suite, "name": name, "params": params, "metric": metric, "value": value, "higher_is_better": higher_is_better, "times": times}
+
+
+def bench_tokenize(work_dir, sizes, repeats):
+    num_rows = sizes["tokenize_rows"]
+    tokenizer = synthetic.make_tokenizer()
+    with open(os.path.join(synthetic.make_chat_dataset(os.path.join(work_dir, "tokenize_data"), num_rows), "train.jsonl"), encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    num_tokens = sum(int(sft_tulu_tokenize_and_truncate_v2(dict(row), tokenizer)["attention_mask"].sum()) for row in rows)
+
+    results = []
+    for name, tokenize in [("sft_tulu_tokenize_and_truncate_v1", sft_tulu_tokenize_and_truncate_v1), ("sft_tulu_tokenize_and_truncate_v2", sft_tulu_tokenize_and_truncate_v2)]:
+        times = timed(lambda: [tokenize(dict(row), tokenizer) for row in rows], repeats)
+        params = {"rows": num_rows, "tokens": num_tokens}
+        results.append(result("tokenize", name, params, "examples_per_s", num_rows / min(times), times))
+        results.append(result("tokenize", name, params, "tokens_per_s", num_tokens / min(times), times))
+    return results
+
+
+def bench_extract(work_dir, sizes, repeats):
+    """extract_gradients.py end to end (through offline_extract.py) on two dataset sizes. The per-example rate is
+    taken between them, so process start, model loading and tokenization (cached beforehand) drop out."""
+    from datasets import load_dataset
+    from transformers import GPT2TokenizerFast, AutoTokenizer
+
+    small, large = sizes["extract_rows"]
+    results = []
+    for architecture in synthetic.ARCHITECTURES:
+        model_dir = os.path.join(work_dir, "tiny-llama" if architecture == "llama" else "tiny-OLMo")
+        synthetic.make_model(model_dir, architecture)
+        tokenizer = GPT2TokenizerFast.from_pretrained(model_dir, max_len=512) if architecture == "llama" else AutoTokenizer.from_pretrained(model_dir)
+        datasets = {}
+        for n in [small, large]:
+            datasets[n] = synthetic.make_chat_dataset(os.path.join(work_dir, f"extract_data_{n}"), n)
+            # the same cache extract_gradients.py uses (--tokenized_cache_dir)
+            get_tokenized_sft_dataset(load_dataset(datasets[n], split="train"), tokenizer, os.path.join(work_dir, "tokenized", f"extract_data_{n}", "train"), num_proc=1)
+
+        for batch_size in sizes["extract_batch_sizes"]:
+            def run(n):
+                output = os.path.join(work_dir, "gradients")
+                shutil.rmtree(output, ignore_errors=True)
+                start = time.perf_counter()
+                subprocess.run(
+                    [sys.executable, os.path.join(HERE, "offline_extract.py"), model_dir, datasets[n], "0",
+                     "--paradigm", "sft", "--device", "cpu", "--batch_size", str(batch_size), "--gradients_per_file", "16",
+                     "--gradients_output_path", output, "--tokenized_cache_dir", os.path.join(work_dir, "tokenized"), "--num_proc", "1"],
+                    check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+                return time.perf_counter() - start
+
+            times = [(run(small), run(large)) for _ in range(repeats)]
+            per_example = min((t_large - t_small) / (large - small) for t_small, t_large in times)
+            params = {"architecture": architecture, "batch_size": batch_size, "rows": [small, large]}
+            results.append(result("extract", "extract_gradients", params, "examples_per_s", 1 / per_example, [list(t) for t in times]))
+    return results
+
+
+def bench_projection(work_dir, sizes, repeats, batch_size=8):
+    results = []
+    generator = torch.Generator().manual_seed(0)
+    for grad_dim in sizes["projection_grad_dims"]:
+        grads = torch.randn(batch_size, grad_dim, generator=generator).half()
+        for proj_dim in sizes["projection_proj_dims"]:
+            for proj_type in sizes["projection_types"]:
+                projector = get_projector(proj_type, grad_dim, proj_dim, seed=42, backend="cpu", device="cpu")
+                times = timed(lambda: projector.project(grads, model_id=0), repeats)
+                params = {"type": proj_type, "grad_dim": grad_dim, "proj_dim": proj_dim, "batch_size": batch_size}
+                results.append(result("projection", proj_type, params, "gradients_per_s", batch_size / min(times), times))
+    return results
+
+
+def bench_store(work_dir, sizes, repeats, batch_size=64):
+    results = []
+    for num_rows, dim in sizes["store_shapes"]:
+        gradients = torch.randn(num_rows, dim, generator=torch.Generator().manual_seed(0)).half()
+        directory = os.path.join(work_dir, "store")
+        megabytes = gradients.numel() * gradients.element_size() / 2**20
+
+        def write():
+            shutil.rmtree(directory, ignore_errors=True)
+            writer = AsyncShardWriter(directory)
+            writer.open_dense("0_{}".format(num_rows), 0, num_rows, dim)
+            for start in range(0, num_rows, batch_size):
+                writer.write("0_{}".format(num_rows), range(start, min(start + batch_size, num_rows)), gradients[start:start + batch_size])
+            writer.finalize("0_{}".format(num_rows))
+            writer.close()
+
+        def read():
+            # the file is in the page cache: this measures the read path, not the disk
+            store = GradientStore(directory)
+            for _, block in store.iter_blocks(4096):
+                block.float().sum()
+
+        params = {"rows": num_rows, "dim": dim, "dtype": "float16"}
+        times = timed(write, repeats)
+        results.append(result("store", "write", params, "mb_per_s", megabytes / min(times), times))
+        times = timed(read, repeats)
+        results.append(result("store", "read", params, "mb_per_s", megabytes / min(times), times))
+    return results
+
+
+def bench_scoring(work_dir, sizes, repeats):
+    """compute_scores (the engine of explain.py) for 'dot' and 'cosine' together, from gradient stores."""
+    results = []
+    generator = torch.Generator().manual_seed(0)
+    for dim in sizes["scoring_dims"]:
+        for num_train in sizes["scoring_train_rows"]:
+            train_dir = os.path.join(work_dir, f"scoring_train_{num_train}_{dim}")
+            writer = AsyncShardWriter(train_dir)
+            for start in range(0, num_train, 4096):
+                name = f"{start}_{start + 4096}"
+                writer.open_dense(name, start, min(4096, num_train - start), dim)
+                writer.write(name, range(min(4096, num_train - start)), torch.randn(min(4096, num_train - start), dim, generator=generator).half())
+                writer.finalize(name)
+            writer.close()
+            for num_test in sizes["scoring_test_rows"]:
+                test_dir = os.path.join(work_dir, f"scoring_test_{num_test}_{dim}")
+                if not os.path.isdir(test_dir):
+                    writer = AsyncShardWriter(test_dir)
+                    writer.open_dense(f"0_{num_test}", 0, num_test, dim)
+                    writer.write(f"0_{num_test}", range(num_test), torch.randn(num_test, dim, generator=generator).half())
+                    writer.finalize(f"0_{num_test}")
+                    writer.close()
+                times = timed(lambda: compute_scores([train_dir], [test_dir], ["dot", "cosine"]), repeats)
+                params = {"train_rows": num_train, "dim": dim, "test_rows": num_test}
+                results.append(result("scoring", "compute_scores", params, "train_gradients_per_s", num_train / min(times), times))
+                results.append(result("scoring", "compute_scores", params, "gflops", 2 * num_train * num_test * dim / min(times) / 1e9, times))
+    return results
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser("benchmarks")
+    parser.add_argument("--output", help="Where to write the results (JSON)", default="benchmark_results.json")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=SUITES)
+    parser.add_argument("--quick", help="Smaller sizes (a few minutes on a laptop)", default=False, action="store_true")
+    parser.add_argument("--repeats", help="Timed runs per benchmark (the fastest one counts)", type=int, default=3)
+    parser.add_argument("--num_threads", help="Number of torch threads (default: torch's default; recorded in the results)", type=int, default=None)
+    parser.add_argument("--work_dir", help="Where to build models, datasets and stores (default: a temporary folder)", default=None)
+    parser.add_argument("--baseline", help="Compare with the results of an earlier run (see compare.py)", default=None)
+    parser.add_argument("--tolerance", help="Relative slow-down that counts as a regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    sizes = {key: value[1 if args.quick else 0] for key, value in SIZES.items()}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmarks_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    try:
+        for suite in args.suites:
+            logging.info(f"running {suite} ...")
+            results += globals()[f"bench_{suite}"](os.path.join(work_dir, suite), sizes, args.repeats)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"environment": get_environment(), "quick": args.quick, "results": results}, f, indent=2)
+    logging.info(f"stored {len(results)} results to {args.output}")
+
+    for r in results:
+        print(f"{r['suite']:<11} {r['name']:<34} {json.dumps(r['params']):<70} {r['metric']:<22} {r['value']:.4g}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare.print_comparison(results, baseline["results"], args.tolerance)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,85 @@
+"""Tiny random-init models and synthetic chat datasets for the benchmarks, built locally (no Hub access)."""
+import os
+import json
+import random
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, Olmo2Config, Olmo2ForCausalLM, PreTrainedTokenizerFast
+
+ARCHITECTURES = ["llama", "olmo2"]
+
+SPECIAL_TOKENS = ["<unk>", "<pad>", "<|user|>", "<|assistant|>"]
+
+
+def get_words(num_words=2000, seed=0):
+    """A fixed vocabulary of random lower-case words."""
+    rng = random.Random(seed)
+    return ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(num_words)]
+
+
+def make_tokenizer(vocab_size=1024, seed=0):
+    """A byte-level BPE tokenizer trained on the random words (no merges from any real corpus)."""
+    rng = random.Random(seed)
+    words = get_words(seed=seed)
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator([" ".join(rng.choices(words, k=50)) for _ in range(1000)], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<pad>")
+
+
+def make_model(directory, architecture="llama", hidden_size=64, num_layers=2, num_heads=4, max_length=4096, seed=0):
+    """Saves a tokenizer and a random-init causal LM in the layout extract_gradients.py expects.
+
+    extract_gradients.py picks the model class by name, so `directory` should contain 'llama' or 'OLMo'.
+    Llama models are built from `checkpoints/checkpoint-1/config.json` (their weights are random anyway),
+    OLMo models are loaded with their (random) weights from `directory`.
+
+    Returns:
+        The checkpoint paths (see `get_checkpoints`)
+    """
+    tokenizer = make_tokenizer(seed=seed)
+    tokenizer.save_pretrained(directory)
+    config_class, model_class = (LlamaConfig, LlamaForCausalLM) if architecture == "llama" else (Olmo2Config, Olmo2ForCausalLM)
+    config = config_class(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_heads,
+        max_position_embeddings=max_length,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    if architecture == "llama":
+        os.makedirs(os.path.join(directory, "checkpoints", "checkpoint-1"), exist_ok=True)
+        config.save_pretrained(os.path.join(directory, "checkpoints", "checkpoint-1"))
+    else:
+        torch.manual_seed(seed)
+        model_class(config).save_pretrained(directory)
+    return get_checkpoints(directory)
+
+
+def get_checkpoints(directory):
+    """Stand-in for util.get_checkpoints_hub for a model of `make_model`."""
+    checkpoints = os.path.join(directory, "checkpoints")
+    if os.path.isdir(checkpoints):
+        return [os.path.join(checkpoints, f) for f in sorted(os.listdir(checkpoints))]
+    return ["main"]
+
+
+def make_chat_dataset(directory, num_rows, min_words=20, max_words=400, seed=0):
+    """Writes `num_rows` random user/assistant conversations (with an 'id' and 'messages') to
+    `directory/train.jsonl`, loadable with `load_dataset(directory)`."""
+    rng = random.Random(seed)
+    words = get_words(seed=seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "train.jsonl"), "w", encoding="utf-8") as f:
+        for i in range(num_rows):
+            messages = [
+                {"role": ["user", "assistant"][j % 2], "content": " ".join(rng.choices(words, k=rng.randint(min_words, max_words)))}
+                for j in range(2 * rng.randint(1, 2))
+            ]
+            f.write(json.dumps({"id": f"synthetic_{i}", "messages": messages}) + "\n")
+    return directory
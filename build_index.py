@@ -0,0 +1,32 @@
+import os
+import time
+import logging
+import argparse
+
+from gradient_store import GradientStore
+from ann_index import IVFPQIndex, INDEX_METRICS, index_file
+
+logging.basicConfig(
+                    level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+parser = argparse.ArgumentParser("build_index")
+parser.add_argument("path", help="A gradient store of projected gradients, e.g. ./gradients/rademacher_16384/OLMo-2-1124-7B-SFT/sampled-tulu-1000/train/main")
+parser.add_argument("--metric", help="Similarity the index is searched with: 'dot', 'cosine', or 'both' (one index each)", choices=INDEX_METRICS + ["both"], default="cosine")
+parser.add_argument("--num_lists", help="Number of inverted lists (default: about 4 * sqrt(number of gradients))", type=int, default=None)
+parser.add_argument("--num_subspaces", help="Number of product quantisation parts, i.e. bytes per gradient", type=int, default=64)
+parser.add_argument("--sample_size", help="Number of gradients the quantisers are trained on", type=int, default=2**16)
+parser.add_argument("--iterations", help="Number of k-means iterations", type=int, default=20)
+parser.add_argument("--seed", type=int, default=42)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    store = GradientStore(args.path)
+    for metric in INDEX_METRICS if args.metric == "both" else [args.metric]:
+        start_time = time.time()
+        index = IVFPQIndex.build(store, metric=metric, num_lists=args.num_lists, num_subspaces=args.num_subspaces, sample_size=args.sample_size, iterations=args.iterations, seed=args.seed)
+        out_path = os.path.join(args.path, index_file(metric))
+        index.save(out_path)
+        logging.info(f"stored {metric} index of {len(store)} gradients to {out_path} ({time.time() - start_time:.1f}s)")
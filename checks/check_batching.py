@@ -0,0 +1,32 @@
+"""Batched gradients (--batch_size, --max_tokens_per_batch) against one-at-a-time gradients."""
+import torch
+
+from gradient_store import GradientStore
+from fixtures import NUM_ROWS, get_extractor, extract
+
+
+def check_batched_loss_gradients(work_dir):
+    extractor = get_extractor(work_dir, "batching")
+    torch.manual_seed(0)
+    model = extractor.model
+    examples = [extractor.dataset[i] for i in range(6)]
+    batched = extractor.get_loss_gradients(model, *extractor.collate_examples(examples), extractor.device)
+    for i, example in enumerate(examples):
+        single = extractor.get_loss_gradients(model, *extractor.collate_examples([example]), extractor.device)[0]
+        assert single.shape == batched[i].shape, f"example {i}: {tuple(single.shape)} != {tuple(batched[i].shape)}"
+        # float32 roundoff of the padded matmuls only (about 1e-7 of the largest entry)
+        error = (single - batched[i]).abs().max().item()
+        assert error < 1e-5 * single.abs().max().item(), f"example {i}: max error {error}"
+
+
+def check_batched_stores(work_dir):
+    options = ["--gradients_per_file", "5", "--random_projection", "--proj_dim", "32", "--projector_backend", "cpu", "--store_full"]
+    expected = [GradientStore(path) for path in extract(work_dir, "batching_1", *options)]
+    for batch_options in [["--batch_size", "4"], ["--batch_size", "8", "--max_tokens_per_batch", "2048"]]:
+        stores = [GradientStore(path) for path in extract(work_dir, f"batching_{batch_options[1]}", *options, *batch_options)]
+        for store, reference in zip(stores, expected):
+            assert len(store) == len(reference) == NUM_ROWS, f"{store.directory}: {len(store)} rows"
+            rows, reference_rows = store.rows(0, len(store)).float(), reference.rows(0, len(reference)).float()
+            # float16 rounding of gradients that agree to about 1e-7
+            error = ((rows - reference_rows).norm(dim=1) / reference_rows.norm(dim=1)).max().item()
+            assert error < 1e-3, f"{' '.join(batch_options)}, {store.directory}: relative error {error}"
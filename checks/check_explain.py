@@ -0,0 +1,45 @@
+"""explain.py on quantized stores."""
+import os
+import torch
+
+import quantization
+from gradient_store import AsyncShardWriter, GradientStore
+from ann_index import IVFPQIndex, index_file
+from scoring import compute_scores
+from explain import Explainer, parse_args
+
+
+def write_store(directory, gradients, bits=None, block_size=None, rows_per_shard=64):
+    """A gradient store of `gradients`, dense float32 or quantized to `bits` bits."""
+    writer = AsyncShardWriter(directory, {"dataset_fingerprint": "check"})
+    for start in range(0, len(gradients), rows_per_shard):
+        rows = gradients[start:start + rows_per_shard]
+        name = f"{start}_{start + len(rows)}"
+        if bits is None:
+            writer.open_dense(name, start, len(rows), gradients.shape[1], torch.float32)
+        else:
+            writer.open_quantized(name, start, len(rows), gradients.shape[1], bits, block_size)
+        writer.write(name, range(len(rows)), rows) # rows of the shard
+        writer.finalize(name)
+    writer.close()
+    return directory
+
+
+def check_index_with_quantized_test_store(work_dir):
+    torch.manual_seed(0)
+    train = write_store(os.path.join(work_dir, "explain_train"), torch.randn(200, 96))
+    index = IVFPQIndex.build(GradientStore(train), metric="cosine", num_lists=4, num_subspaces=8, iterations=5)
+    index.save(os.path.join(train, index_file("cosine")))
+    for bits in quantization.BITS.values():
+        test = write_store(os.path.join(work_dir, f"explain_test_int{bits}"), torch.randn(6, 96), bits=bits, block_size=32)
+        explainer = Explainer(parse_args([
+            "--func", "cosine", "--dataset", "unused", "--test_data_path", test, "--device", "cpu",
+            "--index", os.path.join(train, index_file("cosine")), "--top_k", "5", "--nprobe", "4", "--rerank", "100",
+        ]))
+        values, indices = explainer.scores["cosine"]
+        # all lists visited and every candidate re-scored: the exact top-k of the dequantized test gradients
+        exact, _ = compute_scores([train], [test], ["cosine"], top_k=5)
+        exact_values, exact_indices = exact["cosine"]
+        assert torch.equal(indices, exact_indices), f"int{bits}: {indices} != {exact_indices}"
+        assert torch.allclose(values, exact_values, atol=1e-5), f"int{bits}: {(values - exact_values).abs().max()}"
+
@@ -0,0 +1,35 @@
+"""Factored projections against the projection of the materialised gradients."""
+import torch
+
+import factored_gradients
+from factored_gradients import FactoredProjector, split_factors
+
+
+def assert_projection_matches(layout, proj_dim, lengths=(3, 1, 5), seed=0):
+    torch.manual_seed(seed)
+    gradients = [torch.randn(length, sum(layer["in"] + layer["out"] for layer in layout)) for length in lengths]
+    projector = FactoredProjector(layout, "normal", proj_dim, seed=42)
+    projected = projector.project(gradients)
+    assert projected.shape == (len(lengths), len(layout) * proj_dim), f"proj_dim {proj_dim}: shape {tuple(projected.shape)}"
+
+    # (P ⊗ Q)^T vec(G^T A) = vec(P^T G^T A Q) of the [out, in] weight gradient
+    for i, rows in enumerate(gradients):
+        for l, ((a, g), (q, p)) in enumerate(zip(split_factors(rows.double(), layout), projector.matrices)):
+            expected = (p.double().T @ (g.T @ a) @ q.double()).flatten()
+            actual = projected[i, l * proj_dim:(l + 1) * proj_dim].double()
+            error = (actual - expected).abs().max().item()
+            assert error < 1e-4 * expected.abs().max().item(), f"proj_dim {proj_dim}, layer {l}: max error {error}"
+
+
+def check_square(work_dir):
+    layout = [{"name": "a", "in": 12, "out": 20}, {"name": "b", "in": 20, "out": 7}]
+    assert factored_gradients.factor_dims(16) == (4, 4)
+    assert_projection_matches(layout, 16)
+
+
+def check_non_square(work_dir):
+    # 8192 = 128 x 64, 32 = 8 x 4, 6 = 3 x 2
+    assert factored_gradients.factor_dims(8192) == (128, 64)
+    layout = [{"name": "a", "in": 12, "out": 20}, {"name": "b", "in": 20, "out": 7}]
+    for proj_dim in [32, 6]:
+        assert_projection_matches(layout, proj_dim)
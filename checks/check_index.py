@@ -0,0 +1,57 @@
+"""IVF-PQ searches of degenerate stores (duplicate gradients, empty lists), against the exact top-k."""
+import os
+import torch
+
+from gradient_store import AsyncShardWriter, GradientStore
+from ann_index import IVFPQIndex, kmeans
+
+
+def write_duplicates(directory, rows_per_vector=32, dim=16):
+    """A store of two distinct gradients, each repeated `rows_per_vector` times (interleaved)."""
+    generator = torch.Generator().manual_seed(0)
+    vectors = torch.randn(2, dim, generator=generator)
+    vectors[1] *= 0.5 # a . a > a . b for the query a
+    gradients = vectors.repeat(rows_per_vector, 1)
+    writer = AsyncShardWriter(directory, {"dataset_fingerprint": "check"})
+    writer.open_dense(f"0_{len(gradients)}", 0, len(gradients), dim, torch.float32)
+    writer.write(f"0_{len(gradients)}", range(len(gradients)), gradients)
+    writer.finalize(f"0_{len(gradients)}")
+    writer.close()
+    return GradientStore(directory), vectors
+
+
+def check_kmeans_duplicates(work_dir):
+    x = torch.tensor([[1.0, 0.0], [0.0, 2.0]]).repeat(32, 1)
+    centroids = kmeans(x, 16, 5, torch.Generator().manual_seed(0))
+    # two clusters, each centroid the nearest of some points
+    assert len(centroids) == 2, f"{len(centroids)} centroids"
+    assert torch.bincount(torch.cdist(x, centroids).argmin(dim=-1), minlength=len(centroids)).min() > 0
+
+
+def check_search_duplicates(work_dir):
+    store, vectors = write_duplicates(os.path.join(work_dir, "index_duplicates"))
+    index = IVFPQIndex.build(store, metric="dot", num_lists=16, num_subspaces=4, iterations=5)
+    expected = vectors[0] @ vectors[0]
+    for rerank in [0, 4]:
+        scores, rows = index.search(vectors[:1], 5, nprobe=1, rerank=rerank)
+        assert rows.shape == (1, 5) and (rows % 2 == 0).all(), f"rerank {rerank}: rows {rows}"
+        assert torch.allclose(scores, expected.expand(1, 5), rtol=1e-3), f"rerank {rerank}: scores {scores}"
+
+    # k larger than the store: every row, then padding
+    scores, rows = index.search(vectors[:1], 80, nprobe=1, rerank=0)
+    assert sorted(rows[0, :64].tolist()) == list(range(64)), f"rows {rows}"
+    assert (rows[0, 64:] == -1).all() and torch.isinf(scores[0, 64:]).all()
+
+
+def check_search_empty_lists(work_dir):
+    store, vectors = write_duplicates(os.path.join(work_dir, "index_empty_lists"))
+    index = IVFPQIndex.build(store, metric="dot", num_lists=2, num_subspaces=4, iterations=5)
+    # a centroid without gradients that every query probes first
+    empty = IVFPQIndex(
+        torch.cat([index.centroids, 10 * vectors[:1]]), index.codebooks, index.codes, index.ids,
+        torch.cat([index.list_offsets, index.list_offsets[-1:]]), index.metric,
+    )
+    empty.store = store
+    scores, rows = empty.search(vectors[:1], 5, nprobe=1, rerank=4)
+    assert rows.shape == (1, 5) and (rows % 2 == 0).all(), f"rows {rows}"
+    assert torch.allclose(scores, (vectors[0] @ vectors[0]).expand(1, 5), rtol=1e-5), f"scores {scores}"
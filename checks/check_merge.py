@@ -0,0 +1,19 @@
+"""A sharded extraction (--num_shards), merged with merge_worker_manifests, against a single worker's store."""
+import torch
+
+from gradient_store import GradientStore, merge_worker_manifests
+from fixtures import NUM_ROWS, extract
+
+
+def check_merged_store(work_dir):
+    options = ["--gradients_per_file", "4", "--random_projection", "--proj_dim", "32", "--projector_backend", "cpu", "--store_full"]
+    expected = extract(work_dir, "merge_1", *options)
+    for shard_index in range(2):
+        paths = extract(work_dir, "merge_2", *options, "--num_shards", "2", "--shard_index", str(shard_index))
+    for path, reference in zip(paths, expected):
+        manifest = merge_worker_manifests(path)
+        assert [shard["start"] for shard in manifest["shards"]] == list(range(0, NUM_ROWS, 4)), f"{path}: {manifest['shards']}"
+        store, reference = GradientStore(path), GradientStore(reference)
+        # every example is computed the same way by either worker
+        assert torch.equal(store.rows(0, len(store)), reference.rows(0, len(reference))), f"{path} differs from {reference.directory}"
+        assert len(store.rows(NUM_ROWS, NUM_ROWS)) == 0
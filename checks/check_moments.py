@@ -0,0 +1,34 @@
+"""GradientMoments: batch updates and merged partial moments against the moments of all gradients at once."""
+import torch
+
+from gradient_stats import GradientMoments
+
+
+def assert_moments(moments, gradients, what):
+    gradients = gradients.double()
+    norms = torch.linalg.vector_norm(gradients, dim=-1)
+    assert moments.count == len(gradients), f"{what}: count {moments.count}"
+    assert torch.allclose(moments.mean.double(), gradients.mean(dim=0), atol=1e-5), f"{what}: mean"
+    assert torch.allclose(moments.variance.double(), gradients.var(dim=0, unbiased=False), rtol=1e-4, atol=1e-5), f"{what}: variance"
+    stats = moments.stats()["norm"]
+    expected = {"mean": norms.mean().item(), "std": norms.std(unbiased=False).item(), "min": norms.min().item(), "max": norms.max().item()}
+    for key, value in expected.items():
+        assert abs(stats[key] - value) < 1e-4 * value, f"{what}: norm {key} {stats[key]} != {value}"
+
+
+def check_merged_moments(work_dir):
+    gradients = torch.randn(50, 32, generator=torch.Generator().manual_seed(0)) * 3 + 1
+    one_pass = GradientMoments(32, track_variance=True)
+    for batch in gradients.split(7):
+        one_pass.update(batch)
+    assert_moments(one_pass, gradients, "one pass")
+
+    # the partial moments of two workers (one of them saved and loaded), and of a worker without gradients
+    parts = [GradientMoments(32, track_variance=True) for _ in range(3)]
+    for batch in gradients[:20].split(6):
+        parts[0].update(batch)
+    parts[1].update(gradients[20:])
+    merged = GradientMoments.from_state_dict(parts[0].state_dict())
+    for part in parts[1:]:
+        merged.merge(part)
+    assert_moments(merged, gradients, "merged")
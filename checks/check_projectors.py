@@ -0,0 +1,68 @@
+"""Projections of the `cpu` backend and the structured types: one matrix per seed and model id, whatever the batch size,
+the thread count or the tiling."""
+import torch
+
+from projectors import CpuProjector, STRUCTURED_PROJECTION_TYPES, get_projector
+
+
+def assert_close(actual, expected, what, rtol=1e-5):
+    error = (actual.double() - expected.double()).abs().max().item()
+    assert error <= rtol * expected.abs().max().item(), f"{what}: max error {error}"
+
+
+def get_matrix(projector, model_id):
+    """The [grad_dim, proj_dim] projection matrix of a CpuProjector, assembled from its tiles."""
+    tile_rows, tile_cols = -(-projector.grad_dim // projector.TILE_ROWS), -(-projector.proj_dim // projector.TILE_COLS)
+    matrix = torch.cat([torch.cat([projector.generate_tile(model_id, r, c) for c in range(tile_cols)], dim=1) for r in range(tile_rows)])
+    return matrix[:projector.grad_dim, :projector.proj_dim]
+
+
+def check_cpu_projector(work_dir):
+    # 2 x 2 tiles, the last row and column of tiles cut off
+    grad_dim, proj_dim = CpuProjector.TILE_ROWS + 100, CpuProjector.TILE_COLS + 10
+    gradients = torch.randn(5, grad_dim, generator=torch.Generator().manual_seed(0))
+    gradients[1:3, :CpuProjector.TILE_ROWS] = 0 # a row tile some gradients skip
+    for proj_type in ["normal", "rademacher"]:
+        projector = CpuProjector(grad_dim, proj_dim, seed=42, proj_type=proj_type)
+        projected = projector.project(gradients, model_id=0)
+        assert_close(projected, gradients.double() @ get_matrix(projector, 0).double(), f"{proj_type}: tiles")
+
+        # the same matrix for another instance, thread count and batch size
+        again = CpuProjector(grad_dim, proj_dim, seed=42, proj_type=proj_type, num_threads=1).project(gradients, model_id=0)
+        assert torch.equal(again, projected), f"{proj_type}: one thread"
+        single = torch.cat([projector.project(gradient[None], model_id=0) for gradient in gradients])
+        assert_close(single, projected, f"{proj_type}: one gradient at a time")
+        # entry (i, j) does not depend on proj_dim or grad_dim
+        prefix = CpuProjector(grad_dim - 50, 100, seed=42, proj_type=proj_type).project(gradients[:, :grad_dim - 50], model_id=0)
+        assert_close(prefix, (gradients[:, :grad_dim - 50] @ get_matrix(projector, 0)[:grad_dim - 50, :100]), f"{proj_type}: prefix")
+
+        # another seed or model id, another matrix
+        assert not torch.allclose(projector.project(gradients, model_id=1), projected), f"{proj_type}: model id ignored"
+        other = CpuProjector(grad_dim, proj_dim, seed=43, proj_type=proj_type).project(gradients, model_id=0)
+        assert not torch.allclose(other, projected), f"{proj_type}: seed ignored"
+
+
+def check_structured_projectors(work_dir):
+    grad_dim, proj_dim = 1000, 64
+    gradients = torch.randn(5, grad_dim, generator=torch.Generator().manual_seed(0))
+    for proj_type in STRUCTURED_PROJECTION_TYPES:
+        projector = get_projector(proj_type, grad_dim, proj_dim, seed=42, backend="cpu", device="cpu")
+        projected = projector.project(gradients, model_id=0)
+        # a linear map: the projection of the identity is its matrix
+        matrix = projector.project(torch.eye(grad_dim), model_id=0)
+        assert_close(projected, gradients.double() @ matrix.double(), f"{proj_type}: matrix")
+        # scaled like the dense projections, E[|Px|^2] = proj_dim |x|^2
+        mean_square = matrix.square().sum(dim=1).mean().item()
+        assert abs(mean_square / proj_dim - 1) < 0.1, f"{proj_type}: mean squared row norm {mean_square}, expected {proj_dim}"
+
+        # hashed from the seed: the same matrix for another instance and batch size
+        again = get_projector(proj_type, grad_dim, proj_dim, seed=42, backend="cpu", device="cpu")
+        single = torch.cat([again.project(gradient[None], model_id=0) for gradient in gradients])
+        assert_close(single, projected, f"{proj_type}: one gradient at a time")
+        assert not torch.allclose(projector.project(gradients, model_id=1), projected), f"{proj_type}: model id ignored"
+        other = get_projector(proj_type, grad_dim, proj_dim, seed=43, backend="cpu", device="cpu").project(gradients, model_id=0)
+        assert not torch.allclose(other, projected), f"{proj_type}: seed ignored"
+
+    # srht samples the first k coordinates of a permutation: smaller projections are prefixes
+    prefix = get_projector("srht", grad_dim, 16, seed=42, backend="cpu", device="cpu").project(gradients, model_id=0)
+    assert torch.equal(prefix, get_projector("srht", grad_dim, proj_dim, seed=42, backend="cpu", device="cpu").project(gradients, model_id=0)[:, :16])
@@ -0,0 +1,27 @@
+"""Integer-domain scores of quantized stores against the scores of the dequantized gradients."""
+import torch
+
+import quantization
+
+
+def assert_dot_matches(dim, block_size, bits, num_train=20, num_test=5, seed=0):
+    torch.manual_seed(seed)
+    train = quantization.quantize(torch.randn(num_train, dim), bits, block_size)
+    test = quantization.quantize(torch.randn(num_test, dim), bits, block_size)
+    expected = quantization.dequantize(train).double() @ quantization.dequantize(test).double().T
+    error = (quantization.dot(train, test).double() - expected).abs().max().item()
+    # float32 rounding of the scaled block sums only, a wrong integer GEMM is off by orders of magnitude
+    assert error < 1e-3 * expected.abs().max().item(), f"dim {dim}, block size {block_size}, int{bits}: max error {error}"
+
+
+def check_odd_dimensions(work_dir):
+    # 1-wide tail blocks (257 = 4 * 64 + 1) and tails of other widths
+    for dim, block_size in [(257, 64), (129, 128), (100, 64), (64, 64), (7, 0)]:
+        for bits in quantization.BITS.values():
+            assert_dot_matches(dim, block_size, bits)
+
+
+def check_gemm_depth_chunks(work_dir):
+    # one scale per row: the block is split into MAX_GEMM_DEPTH chunks, the last one 1 wide
+    for bits in quantization.BITS.values():
+        assert_dot_matches(quantization.MAX_GEMM_DEPTH + 1, 0, bits, num_train=4, num_test=3)
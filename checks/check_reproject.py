@@ -0,0 +1,36 @@
+"""reproject.py: stores projected offline, against projecting the gradients directly, with the source's lineage."""
+import os
+import torch
+
+import reproject
+from gradient_store import AsyncShardWriter, GradientStore, merge_worker_manifests
+from projectors import get_projector
+
+
+def check_reprojected_stores(work_dir):
+    gradients = torch.randn(20, 300, generator=torch.Generator().manual_seed(0)).half()
+    source = os.path.join(work_dir, "reproject", "full", "model", "data", "train", "main")
+    lineage = {"model": "model", "model_revision": "main", "dataset": "data", "dataset_split": "train"}
+    writer = AsyncShardWriter(source, {**lineage, "projection": None})
+    for start in range(0, len(gradients), 8):
+        rows = gradients[start:start + 8]
+        writer.open_dense(f"{start}_{start + len(rows)}", start, len(rows), gradients.shape[1])
+        writer.write(f"{start}_{start + len(rows)}", range(len(rows)), rows)
+        writer.finalize(f"{start}_{start + len(rows)}")
+    writer.close()
+
+    options = reproject.parser.parse_args([source, "--num_threads", str(torch.get_num_threads())])
+    outputs = [(reproject.get_output_dir(source, f"{proj_type}_{proj_dim}"), proj_type, proj_dim) for proj_type, proj_dim in [("rademacher", 32), ("srht", 16)]]
+    # two workers, merged as reproject.py does
+    for worker in range(2):
+        reproject.reproject_shards(source, outputs, worker, 2, options)
+    for directory, proj_type, proj_dim in outputs:
+        assert directory == os.path.join(work_dir, "reproject", f"{proj_type}_{proj_dim}", "model", "data", "train", "main"), directory
+        merge_worker_manifests(directory, num_rows=len(gradients))
+        store = GradientStore(directory)
+        assert all(store.manifest[key] == value for key, value in lineage.items()), f"{directory}: lineage {store.manifest}"
+        assert store.manifest["source"]["path"] == os.path.abspath(source) and store.manifest["projection"]["type"] == proj_type
+
+        expected = get_projector(proj_type, gradients.shape[1], proj_dim, seed=42, backend="cpu", device="cpu").project(gradients, model_id=0).float()
+        error = ((store.rows(0, len(store)).float() - expected).norm(dim=1) / expected.norm(dim=1)).max().item()
+        assert error < 1e-3, f"{directory}: relative error {error}" # float16 rounding
@@ -0,0 +1,54 @@
+"""--resume: finished shards are skipped, unfinished ones continue from their journal."""
+import os
+import torch
+
+import ragged_gradients
+from gradient_store import AsyncShardWriter, GradientStore, read_journal, shard_exists
+
+
+def check_resume_dense(work_dir):
+    gradients = torch.randn(10, 16, generator=torch.Generator().manual_seed(0)).half()
+    directory = os.path.join(work_dir, "resume_dense")
+    writer = AsyncShardWriter(directory)
+    writer.open_dense("0_5", 0, 5, 16)
+    writer.write("0_5", range(5), gradients[:5])
+    writer.finalize("0_5")
+    writer.open_dense("5_10", 5, 5, 16)
+    writer.write("5_10", [3, 0], gradients[[8, 5]])
+    writer.close() # the job stops before 5_10 is complete
+
+    assert shard_exists(directory, "0_5") and read_journal(directory, "0_5") is None
+    assert not shard_exists(directory, "5_10")
+    writer = AsyncShardWriter(directory)
+    stored = writer.resume("5_10")
+    assert stored == {0, 3}, stored
+    missing = [row for row in range(5) if row not in stored]
+    writer.write("5_10", missing, gradients[5:][missing])
+    writer.finalize("5_10")
+    writer.close()
+
+    assert shard_exists(directory, "5_10") and read_journal(directory, "5_10") is None
+    assert torch.equal(GradientStore(directory).rows(0, 10), gradients)
+
+
+def check_resume_ragged(work_dir):
+    generator = torch.Generator().manual_seed(0)
+    gradients = [torch.randn(length, 8, generator=generator).half() for length in [3, 1, 4, 2]]
+    directory = os.path.join(work_dir, "resume_ragged")
+    writer = AsyncShardWriter(directory)
+    writer.open_ragged("0_4", 0, 4, 8, max_length=4)
+    writer.write("0_4", [2, 0], [gradients[2], gradients[0]])
+    writer.close()
+
+    writer = AsyncShardWriter(directory)
+    stored = writer.resume("0_4")
+    assert stored == {0, 2}, stored
+    writer.write("0_4", [1, 3], [gradients[1], gradients[3]])
+    writer.finalize("0_4")
+    writer.close()
+
+    store = GradientStore(directory)
+    rows = store.shard_rows(0)
+    for i, gradient in enumerate(gradients):
+        start, length = int(rows[ragged_gradients.STARTS_KEY][i]), int(rows[ragged_gradients.LENGTHS_KEY][i])
+        assert torch.equal(rows[ragged_gradients.VALUES_KEY][start:start + length], gradient), f"row {i}"
@@ -0,0 +1,41 @@
+"""Test gradients of influence_server.py against the train gradients of the same examples in the store."""
+import json
+import os
+import types
+import torch
+
+import influence_server
+from gradient_store import GradientStore
+from fixtures import get_fixtures, extract
+
+
+def check_train_examples(work_dir):
+    _, dataset_dir = get_fixtures(work_dir)
+    with open(os.path.join(dataset_dir, "train.jsonl"), encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f][:4]
+
+    for options in [[], ["--lean"]]:
+        store = GradientStore(extract(work_dir, f"server{''.join(options)}", "--batch_size", "4", "--random_projection", "--proj_dim", "32", "--projector_backend", "cpu", *options)[0])
+        assert store.manifest["lean"] == bool(options) and store.manifest["gradient_layers"] is None, store.manifest
+        torch.manual_seed(0) # the same random Llama weights as the extraction
+        extractor = influence_server.get_extractor(store.manifest, "cpu")
+        assert extractor.args.lean == bool(options), f"{options}: lean {extractor.args.lean}"
+        service = influence_server.InfluenceService(extractor, [store])
+
+        examples = [service.to_example({"messages": row["messages"]}) for row in rows]
+        gradients, expected = service.get_gradients(examples).float(), store.rows(0, len(rows)).float()
+        error = ((gradients - expected).norm(dim=1) / expected.norm(dim=1)).max().item()
+        assert error < 1e-3, f"{options}: relative error {error}"
+
+        results = service.query(examples, [1] * len(examples), ["cosine"] * len(examples))
+        assert [result["train_indices"] for result in results] == [[i] for i in range(len(rows))], results
+
+
+def check_rejected_stores(work_dir):
+    for manifest in [{"gradient_layers": ["lm_head"]}, {"tracin": {"checkpoints": ["a", "b"]}}, {"paradigm": "mlm"}]:
+        store = types.SimpleNamespace(directory="store", ragged=False, manifest=manifest)
+        try:
+            influence_server.check_store(store, "cpu")
+        except ValueError:
+            continue
+        raise AssertionError(f"{manifest} was not rejected")
@@ -0,0 +1,47 @@
+"""Rows of a gradient store across shard boundaries (and of empty ragged shards), against the gradients written."""
+import os
+import torch
+
+import ragged_gradients
+from gradient_store import AsyncShardWriter, GradientStore
+
+
+def check_dense_rows(work_dir):
+    gradients = torch.randn(10, 16, generator=torch.Generator().manual_seed(0)).half()
+    directory = os.path.join(work_dir, "store_dense")
+    writer = AsyncShardWriter(directory)
+    for start in range(0, len(gradients), 4):
+        rows = gradients[start:start + 4]
+        writer.open_dense(f"{start}_{start + len(rows)}", start, len(rows), gradients.shape[1])
+        writer.write(f"{start}_{start + len(rows)}", range(len(rows)), rows) # rows of the shard
+        writer.finalize(f"{start}_{start + len(rows)}")
+    writer.close()
+
+    store = GradientStore(directory)
+    assert len(store) == len(gradients) and store.dim == gradients.shape[1]
+    for start, end in [(0, 10), (3, 9), (4, 8), (9, 10), (2, 3)]:
+        assert torch.equal(store.rows(start, end), gradients[start:end]), f"rows {start}:{end}"
+    assert torch.equal(store[5], gradients[5])
+    # empty ranges, e.g. the last block of a split that ends at the store's end
+    for start, end in [(4, 4), (10, 10), (7, 3)]:
+        assert store.rows(start, end).shape == (0, gradients.shape[1]), f"rows {start}:{end}"
+    assert torch.equal(torch.cat([block for _, block in store.iter_blocks(3)]), gradients)
+
+
+def check_empty_ragged_shard(work_dir):
+    # a shard whose gradients are all empty (no real tokens) has an empty values file
+    gradients = [torch.empty(0, 8).half(), torch.empty(0, 8).half(), torch.randn(3, 8).half(), torch.randn(1, 8).half()]
+    directory = os.path.join(work_dir, "store_empty_ragged")
+    writer = AsyncShardWriter(directory)
+    for start in [0, 2]:
+        writer.open_ragged(f"{start}_{start + 2}", start, 2, 8, max_length=4)
+        writer.write(f"{start}_{start + 2}", range(2), gradients[start:start + 2])
+        writer.finalize(f"{start}_{start + 2}")
+    writer.close()
+
+    store = GradientStore(directory)
+    for k, start in enumerate([0, 2]):
+        rows = store.shard_rows(k)
+        for i, gradient in enumerate(gradients[start:start + 2]):
+            row_start, length = int(rows[ragged_gradients.STARTS_KEY][i]), int(rows[ragged_gradients.LENGTHS_KEY][i])
+            assert torch.equal(rows[ragged_gradients.VALUES_KEY][row_start:row_start + length], gradient), f"row {start + i}"
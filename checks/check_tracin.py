@@ -0,0 +1,39 @@
+"""CheckpointSum: the TracIn sum built one checkpoint at a time, against the weighted sum of the gradients."""
+import os
+import torch
+
+from gradient_stats import CheckpointSum
+
+
+def check_checkpoint_sum(work_dir):
+    directory = os.path.join(work_dir, "tracin")
+    os.makedirs(directory)
+    checkpoints, weights = ["step1", "step2", "step3"], [0.5, 2.0, 1.0]
+    generator = torch.Generator().manual_seed(0)
+    gradients = {checkpoint: torch.randn(6, 8, generator=generator).half() for checkpoint in checkpoints}
+
+    total = CheckpointSum(directory, checkpoints, weights)
+    for checkpoint in checkpoints[:2]:
+        total.add("0_6", checkpoint, [4, 5, 0], gradients[checkpoint][[4, 5, 0]], 6)
+        total.add("0_6", checkpoint, [1, 2, 3], gradients[checkpoint][1:4], 6)
+        total.commit("0_6")
+    # a job killed halfway through the last checkpoint: the restarted job adds it again from scratch
+    total.add("0_6", "step3", [0, 1], gradients["step3"][:2], 6)
+    del total
+
+    total = CheckpointSum(directory, checkpoints, weights)
+    assert total.added("0_6") == checkpoints[:2] and not total.complete("0_6")
+    total.add("0_6", "step3", range(6), gradients["step3"], 6)
+    total.commit("0_6")
+    assert total.complete("0_6") and total.names() == ["0_6"]
+    expected = sum(weight * gradients[checkpoint].float() for checkpoint, weight in zip(checkpoints, weights))
+    assert torch.allclose(total.load("0_6"), expected, atol=1e-6)
+    assert sorted(os.listdir(directory)) == ["0_6.sum-3.npy", "0_6.sum.json"], os.listdir(directory)
+
+    # another weighting is another sum
+    try:
+        CheckpointSum(directory, checkpoints, [1.0, 1.0, 1.0]).added("0_6")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a sum with other weights was extended")
@@ -0,0 +1,43 @@
+"""A tiny local model and dataset for the checks, and in-process extractions with them (see benchmarks/offline_extract.py)."""
+import os
+import glob
+import torch
+
+import extract_gradients
+import synthetic
+
+NUM_ROWS = 12
+
+
+def get_fixtures(work_dir):
+    """The directories of a tiny random-init Llama and a synthetic chat dataset, built once per `work_dir`."""
+    model_dir, dataset_dir = os.path.join(work_dir, "tiny-llama"), os.path.join(work_dir, "data")
+    if not os.path.isdir(model_dir):
+        synthetic.make_model(model_dir, "llama", hidden_size=32, num_layers=2)
+    if not os.path.isdir(dataset_dir):
+        synthetic.make_chat_dataset(dataset_dir, NUM_ROWS, max_words=100)
+    return model_dir, dataset_dir
+
+
+def get_extractor(work_dir, output, *options):
+    """A `GradientExtractor` of the fixtures writing to `work_dir/output`, with extract_gradients.py `options`."""
+    model_dir, dataset_dir = get_fixtures(work_dir)
+    extractor = extract_gradients.GradientExtractor(extract_gradients.parse_args([
+        model_dir, dataset_dir, "0", "--paradigm", "sft", "--device", "cpu", "--checkpoint_cache_dir", "",
+        "--tokenized_cache_dir", "", "--gradients_output_path", os.path.join(work_dir, output), *options,
+    ]))
+    extractor.checkpoints = synthetic.get_checkpoints(model_dir) # instead of listing the Hub
+    return extractor
+
+
+def extract(work_dir, output, *options):
+    """Runs an extraction of the fixtures. Llama checkpoints get random weights when they are loaded, so the torch
+    seed is fixed to give every extraction the same model.
+
+    Returns:
+        The store directory of every output of the run
+    """
+    extractor = get_extractor(work_dir, output, *options)
+    torch.manual_seed(0)
+    extractor.run()
+    return [glob.glob(os.path.join(path, "*"))[0] for path in extractor.gradient_output_dirs]
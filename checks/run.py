@@ -0,0 +1,57 @@
+"""CPU regression checks: equivalences the optimised code paths must keep (e.g. the same projection for every batch
+size and thread count).
+
+Everything is built locally from fixed seeds (benchmarks/synthetic.py), so the checks need no GPU and no Hub access:
+
+    python checks/run.py [--checks projectors]
+
+Every `check_*` function of the modules in CHECKS raises an AssertionError on a mismatch. Exits with status 1 if any
+check failed.
+"""
+import os
+import sys
+import logging
+import argparse
+import tempfile
+import importlib
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+os.environ["WANDB_MODE"] = "disabled"
+os.environ.pop("WANDB_API_KEY", None)
+
+CHECKS = ["projectors", "store", "resume", "moments", "reproject", "factored", "quantization", "tracin", "explain", "batching", "merge", "server", "index"]
+
+
+def run_checks(names, work_dir):
+    """Runs every `check_<...>(work_dir)` of the modules `check_<name>`. Returns the names of the failed checks."""
+    failed = []
+    for name in names:
+        module = importlib.import_module(f"check_{name}")
+        for function in [getattr(module, f) for f in dir(module) if f.startswith("check_")]:
+            try:
+                function(work_dir)
+                print(f"ok      {name}.{function.__name__}")
+            except Exception:
+                traceback.print_exc()
+                print(f"FAILED  {name}.{function.__name__}")
+                failed.append(f"{name}.{function.__name__}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("checks")
+    parser.add_argument("--checks", help="Modules to run", nargs="+", choices=CHECKS, default=CHECKS)
+    parser.add_argument("--work_dir", help="Where to build the models, datasets and stores (default: a temporary folder)", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        failed = run_checks(args.checks, args.work_dir or tmp)
+    print(f"{len(failed)} check(s) failed" + (": " + ", ".join(failed) if failed else ""))
+    sys.exit(1 if failed else 0)
@@ -1,96 +1,278 @@
 import torch
 import os
-from huggingface_hub import HfFolder, login
+import sys
+import time
+import numpy as np
 from datasets import load_dataset
 import json
-from dotenv import load_dotenv
+import functools
 import argparse
-import torch.nn.functional as F
+from dotenv import load_dotenv
 from tqdm import tqdm
-
-# Environment variables from .env file
-load_dotenv()
-
-# Hugging Face log-in
-hf_token = os.getenv("HUGGINGFACE_TOKEN")
-if hf_token is None:
-    raise ValueError("HUGGINGFACE_TOKEN not found in environment variables")
-
-login(token=hf_token)
+import quantization
+from scoring import compute_scores, iter_gradient_blocks
+from ann_index import IVFPQIndex
+from gradient_store import is_gradient_store, read_manifest
 
 # Command-line arguments parse
 parser = argparse.ArgumentParser("explainability")
 parser.add_argument("--func", help="Influence estimate method: 'dot', 'cosine', or 'both'.", choices=["dot", "cosine", "both"], required=True)
 parser.add_argument("--dataset", help="Dataset to load from Huggingface Hub.", required=True)
-parser.add_argument("--train_data_path", help="Path to training gradients.", required=True)
-parser.add_argument("--test_data_path", help="Path to test gradients.", required=True)
+parser.add_argument("--train_data_path", help="Path(s) to training gradients: gradient store directories or files, scored in this order.", nargs="+", required=False)
+parser.add_argument("--test_data_path", help="Path(s) to test gradients: gradient store directories or files.", nargs="+", required=True)
+parser.add_argument("--device", help="Device for the score computation (e.g., cuda:0 or cpu).", default="cuda" if torch.cuda.is_available() else "cpu")
+parser.add_argument("--block_size", help="Number of train gradients multiplied at a time (bounds the memory).", type=int, default=4096)
+parser.add_argument("--test_block_size", help="Number of test gradients multiplied at a time (default: all).", type=int, default=None)
+parser.add_argument("--num_threads", help="Number of CPU threads for the score computation (default: torch's default).", type=int, default=None)
 parser.add_argument("--where", required=False)
 parser.add_argument("--mapped", help="Whether to include the sample information in the output.", required=False, default="no")
-args = parser.parse_args()
+parser.add_argument("--top_k", help="Only keep the k most influential train samples per test sample.", type=int, default=None)
+parser.add_argument("--output_format", help="'json' (one file per test sample), 'npy' or 'parquet' (one score matrix or top-k table per method).", choices=["json", "npy", "parquet"], default="json")
+parser.add_argument("--index", help="Query an index built by build_index.py (inside the train gradient store) instead of scoring all train gradients.", default=None)
+parser.add_argument("--nprobe", help="Number of inverted lists of the index visited per test sample.", type=int, default=8)
+parser.add_argument("--rerank", help="Re-score the best rerank * top_k candidates of the index exactly (0: keep the index estimates).", type=int, default=10)
+parser.add_argument("--recall_report", help="Compare the index results with the exact top-k and store the recall.", default=False, action="store_true")
 
-# Dataset and gradients loading
-dataset = load_dataset(args.dataset, split="train")
-train_grads = torch.load(args.train_data_path)
-test_grads = torch.load(args.test_data_path)
 
-# Dimension compatibility check
-train_grads_size = train_grads.size()
-test_grads_size = test_grads.size()
+def parse_args(argv=None):
+    """Parses and checks the options of a run (`argv`: e.g. a list of command line arguments, default: sys.argv)."""
+    args = parser.parse_args(argv)
+    if args.index is None and args.train_data_path is None:
+        parser.error("--train_data_path is required (unless an --index is queried)")
+    if args.index is not None and args.top_k is None:
+        parser.error("--index needs --top_k")
+    return args
 
-print(f"Dimensions of train gradients: {train_grads_size}")
-print(f"Dimensions of test gradients: {test_grads_size} \n")
 
-if train_grads_size[-1] != test_grads_size[-1]:
-    raise ValueError(f"Incompatible gradient dimensions.")
+class Explainer:
+    """Influence scores of test against train gradients (see `parse_args` for the options), stored as
+    `./explainability/<grad_dim>/<where>/<method>/` output files.
 
-include_mapping = args.mapped.lower() == "yes"
+    Nothing is loaded when an explainer is created. The scores are computed on first use of `scores` and kept, and
+    the dataset is only loaded when its rows or ids are needed (--mapped yes, or --output_format npy/parquet).
 
-if include_mapping:
-    print("Including full test sample information in the output. \n")
-else:
-    print("Storing scores only. \n")
+    Example:
+        explainer = Explainer(parse_args(["--func", "cosine", "--dataset", "daryna3325/sampled-tulu-1000", "--train_data_path", train, "--test_data_path", test, "--top_k", "10"]))
+        values, indices = explainer.scores["cosine"]
+    """
 
-# A method to apply
-methods = ["dot", "cosine"] if args.func == "both" else [args.func]
+    def __init__(self, args):
+        self.args = args
+        # A method to apply
+        self.methods = ["dot", "cosine"] if args.func == "both" else [args.func]
+        self.include_mapping = args.mapped.lower() == "yes"
+        self.prefix = args.dataset.replace('/', '_')
+        self.grad_dim = None
+        self.recall_report = None
 
-# Normalized gradients for cosine
-train_grads_normalized = F.normalize(train_grads, p=2, dim=-1) if "cosine" in methods else None
+    @functools.cached_property
+    def dataset(self):
+        # Dataset loading
+        return load_dataset(self.args.dataset, split="train")
 
-# Compute influence scores
-for method in methods:
-    output_dir = f"./explainability/{train_grads_size[-1]}/{args.where}/{method}"
-    os.makedirs(output_dir, exist_ok=True)
+    @functools.cached_property
+    def scores(self):
+        """A dict mapping each method to its scores (see `compute_scores`), from the index or all train gradients."""
+        args, methods = self.args, self.methods
+        if args.index is not None:
+            # Approximate influence scores: search the index
+            index = IVFPQIndex.load(args.index)
+            if methods != [index.metric]:
+                raise ValueError(f"{args.index} is a {index.metric} index, use --func {index.metric}")
+            test_grads = torch.cat([
+                # the index searches float32 queries, blocks of quantized test stores are codes and scales
+                (quantization.dequantize(block) if quantization.is_quantized(block) else block.reshape(len(block), -1))
+                for _, block in iter_gradient_blocks(args.test_data_path, sys.maxsize)
+            ])
 
-    for idx, single_test_grad in tqdm(enumerate(test_grads), total=len(test_grads), desc=f"Computing {method} scores for each test sample"):
+            start_time = time.time()
+            all_scores, self.grad_dim = {index.metric: index.search(test_grads, args.top_k, nprobe=args.nprobe, rerank=args.rerank)}, index.dim
+            index_time = time.time() - start_time
 
-        if method == "dot":
-            scores = torch.sum(train_grads * single_test_grad, dim=-1)
+            if args.recall_report:
+                start_time = time.time()
+                exact_scores, _ = compute_scores(
+                    [index.store.directory], args.test_data_path, methods,
+                    device=args.device, block_size=args.block_size, test_block_size=args.test_block_size, num_threads=args.num_threads, top_k=args.top_k,
+                )
+                exact_time = time.time() - start_time
+                recalls = [
+                    len(set(found.tolist()) & set(exact.tolist())) / len(exact)
+                    for found, exact in zip(all_scores[index.metric][1], exact_scores[index.metric][1])
+                ]
+                self.recall_report = {
+                    "index": args.index, "top_k": args.top_k, "nprobe": args.nprobe, "rerank": args.rerank,
+                    "recall": sum(recalls) / len(recalls), "recall_per_test": recalls,
+                    "index_seconds": index_time, "exact_seconds": exact_time,
+                }
+                print(f"Recall@{args.top_k} of the index: {self.recall_report['recall']:.4f} ({index_time:.2f}s vs. {exact_time:.2f}s exact)")
+        else:
+            # Compute influence scores: all methods in one pass over the train gradients
+            all_scores, self.grad_dim = compute_scores(
+                args.train_data_path, args.test_data_path, methods,
+                device=args.device, block_size=args.block_size, test_block_size=args.test_block_size, num_threads=args.num_threads, top_k=args.top_k,
+            )
+        return all_scores
 
-        elif method == "cosine":
-            test_grad_normalized = F.normalize(single_test_grad, p=2, dim=-1)
-            scores = torch.sum(train_grads_normalized * test_grad_normalized, dim=-1)
+    @property
+    def num_train(self):
+        """Number of train samples (of the full score matrices, without --top_k)."""
+        return self.scores[self.methods[0]].shape[0]
 
-        # Combining scores with corresponding samples
-        structured_data = []
-        for i in range(len(scores)):
-            
-            if include_mapping:
-                structured_data.append({
-                    "score": float(scores[i].item()),
-                    **dataset[i]
-                })
-            else:
-                structured_data.append({
-                    "score": float(scores[i].item())
-                })
+    @property
+    def num_test(self):
+        scores = self.scores[self.methods[0]]
+        return scores[0].shape[0] if self.args.top_k is not None else scores.shape[1]
+
+    def get_metadata(self, indices):
+        """Dataset rows of the given train indices, fetched with a single `dataset.select`."""
+        indices = sorted(set(indices) - {-1}) # -1: fewer results than top_k
+        return dict(zip(indices, self.dataset.select(indices).to_list()))
 
-        # Sorting in descending order if include_mapping and saving
+    def get_train_ids(self, indices):
+        """The `id` column of the dataset for an array of train indices (or the indices themselves if there is none)."""
+        if "id" not in self.dataset.column_names:
+            return indices
+        ids = np.array(self.dataset["id"])
+        return ids[indices]
+
+    def store_json(self, method, output_dir):
+        args, all_scores, include_mapping = self.args, self.scores, self.include_mapping
+        metadata = None
         if include_mapping:
-            structured_data.sort(key=lambda x: x["score"], reverse=True)
+            # once for all test samples, only the rows that end up in the output
+            metadata = self.get_metadata(range(self.num_train) if args.top_k is None else all_scores[method][1].flatten().tolist())
+
+        for idx in tqdm(range(self.num_test), desc=f"Storing {method} scores for each test sample"):
+
+            # Combining scores with corresponding samples
+            if args.top_k is not None:
+                scores, indices = all_scores[method][0][idx].tolist(), all_scores[method][1][idx].tolist()
+                structured_data = [{"index": i, "score": score, **(metadata[i] if include_mapping else {})} for i, score in zip(indices, scores) if i >= 0]
+
+            elif include_mapping:
+                # Sorting in descending order if include_mapping
+                scores = all_scores[method][:, idx]
+                indices = torch.argsort(scores, descending=True, stable=True).tolist()
+                scores = scores.tolist()
+                structured_data = [{"score": scores[i], **metadata[i]} for i in indices]
+
+            else:
+                structured_data = [{"score": score} for score in all_scores[method][:, idx].tolist()]
+
+            output_file = os.path.join(output_dir, f"{self.prefix}_test_{idx}.json")
+
+            with open(output_file, "w", encoding="utf-8") as f:
+                json.dump(structured_data, f, indent=2)
+
+    def store_binary(self, method, output_dir):
+        args, all_scores, num_test = self.args, self.scores, self.num_test
+        test_ids = np.arange(num_test)
+        if args.top_k is None:
+            num_train = self.num_train
+            scores = all_scores[method].numpy() # [N_train, N_test]
+            indices = np.arange(num_train)
+        else:
+            scores, indices = all_scores[method][0].numpy(), all_scores[method][1].numpy() # [N_test, k]
+        train_ids = self.get_train_ids(indices)
+        name = f"{self.prefix}_scores" if args.top_k is None else f"{self.prefix}_top{args.top_k}"
+
+        if args.output_format == "npy":
+            np.save(os.path.join(output_dir, f"{name}.npy"), scores)
+            if args.top_k is not None:
+                np.save(os.path.join(output_dir, f"{name}_indices.npy"), indices)
+            np.save(os.path.join(output_dir, f"{name}_train_ids.npy"), train_ids)
+            np.save(os.path.join(output_dir, f"{name}_test_ids.npy"), test_ids)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # long format: one row per (test sample, train sample)
+            if args.top_k is None:
+                columns = {
+                    "test_index": np.repeat(test_ids[None, :], num_train, axis=0).T.ravel(),
+                    "train_index": np.tile(indices, num_test),
+                    "train_id": np.tile(train_ids, num_test),
+                    "score": scores.T.ravel(),
+                }
+            else:
+                columns = {
+                    "test_index": np.repeat(test_ids, scores.shape[1]),
+                    "rank": np.tile(np.arange(scores.shape[1]), num_test),
+                    "train_index": indices.ravel(),
+                    "train_id": train_ids.ravel(),
+                    "score": scores.ravel(),
+                }
+            pq.write_table(pa.table(columns), os.path.join(output_dir, f"{name}.parquet"))
+
+        if self.include_mapping:
+            rows = sorted(set(np.asarray(indices).ravel().tolist()))
+            self.dataset.select(rows).add_column("index", rows).to_parquet(os.path.join(output_dir, f"{name}_metadata.parquet"))
+
+    def get_run_manifest(self, method):
+        """Where the scores come from, so later analyses (e.g. fidelity.py) can tell runs apart."""
+        args = self.args
+
+        def describe(path):
+            if is_gradient_store(path):
+                manifest = read_manifest(path)
+                return {"path": path, **{key: manifest.get(key) for key in ["dim", "dtype", "quantization", "projection", "model_revision", "tracin", "dataset_fingerprint", "num_rows"]}}
+            return {"path": path, "mtime": os.path.getmtime(path)}
+
+        return {
+            "method": method,
+            "dataset": args.dataset,
+            "grad_dim": self.grad_dim,
+            "top_k": args.top_k,
+            "train": [describe(path) for path in args.train_data_path] if args.index is None else [describe(os.path.dirname(os.path.abspath(args.index)))],
+            "test": [describe(path) for path in args.test_data_path],
+            "index": None if args.index is None else {"path": args.index, "nprobe": args.nprobe, "rerank": args.rerank},
+        }
+
+    def run(self):
+        """Computes the scores and stores them (and the run manifest) for every method."""
+        args = self.args
+        all_scores = self.scores
+
+        if args.top_k is None:
+            print(f"Dimensions of train gradients: {(self.num_train, self.grad_dim)}")
+        else:
+            print(f"Keeping the top {args.top_k} train samples")
+        print(f"Dimensions of test gradients: {(self.num_test, self.grad_dim)} \n")
+
+        if self.include_mapping:
+            print("Including full test sample information in the output. \n")
+        else:
+            print("Storing scores only. \n")
+
+        # Store influence scores
+        for method in self.methods:
+            output_dir = f"./explainability/{self.grad_dim}/{args.where}/{method}"
+            os.makedirs(output_dir, exist_ok=True)
+
+            if args.output_format == "json":
+                self.store_json(method, output_dir)
+            else:
+                self.store_binary(method, output_dir)
+
+            with open(os.path.join(output_dir, f"{self.prefix}_run.json"), "w", encoding="utf-8") as f:
+                json.dump(self.get_run_manifest(method), f, indent=2)
+
+            if self.recall_report is not None:
+                with open(os.path.join(output_dir, f"{self.prefix}_recall.json"), "w", encoding="utf-8") as f:
+                    json.dump(self.recall_report, f, indent=2)
+
+            print(f"Saved {method} results to {output_dir}.")
+
 
-        output_file = os.path.join(output_dir, f"{args.dataset.replace('/', '_')}_test_{idx}.json")
+def main(argv=None):
+    args = parse_args(argv)
+    # Hugging Face token, as util.set_hf_token (without importing transformers): no log-in call, only read if the dataset is downloaded
+    load_dotenv()
+    if os.getenv("HUGGINGFACE_TOKEN") is not None:
+        os.environ.setdefault("HF_TOKEN", os.environ["HUGGINGFACE_TOKEN"])
+    Explainer(args).run()
 
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(structured_data, f, indent=2)
 
-    print(f"Saved {method} results to {output_dir}.")
+if __name__ == '__main__':
+    main()
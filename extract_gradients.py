@@ -1,25 +1,20 @@
 import os
-import sys
-import math
 import time
 import logging
 import argparse
 import traceback
-import random
-import numpy as np
+import contextlib
+import functools
+import glob
+import json
+import queue
+import threading
 import torch
 from tqdm import tqdm
 import wandb
-from dotenv import load_dotenv
-load_dotenv()
-
-# Ensure required tokens are set
-if os.getenv("HUGGINGFACE_TOKEN") is None:
-    raise EnvironmentError("Missing Hugging Face token: Please set the HF_TOKEN environment variable.")
 
 # HuggingFace Transformers
 from transformers import (
-    RobertaConfig,
     AutoConfig,
     RobertaForMaskedLM,
     RobertaTokenizerFast,
@@ -33,338 +28,1025 @@ from transformers import (
 
 # HuggingFace Datasets
 from datasets import load_dataset
+from huggingface_hub import snapshot_download
+from safetensors.torch import load_file
 
-# TRL and TRAK
-from trl import apply_chat_template, is_conversational
-from trak.projectors import CudaProjector, NoOpProjector, ProjectionType
+# TRAK
+from trak.projectors import CudaProjector, NoOpProjector
 
 # Custom utilities
 import util
-from util import get_checkpoints_hub, DeterministicDataCollatorForLanguageModeling
-from olmo_training_utils import sft_tulu_tokenize_and_truncate_v1
-
-# Multiprocessing
-from multiprocessing import Pool, Queue, Manager
-
+from util import DeterministicDataCollatorForLanguageModeling
+from olmo_training_utils import sft_tulu_tokenize_and_truncate_v2, get_tokenized_sft_dataset
+import ragged_gradients
+import loss_gradients
+from loss_gradients import get_example_length
+from factored_gradients import FactorCapture, FactoredProjector, select_layers, get_blocks, FACTORS_KEY
+from gradient_store import AsyncShardWriter, shard_exists, worker_manifest_file
+from gradient_stats import GradientMoments, CheckpointSum, worker_state_file
+from projectors import get_projector, PROJECTION_TYPES, PREFIX_PROJECTION_TYPES
+from profiling import ExtractionProfiler
+from quantization import STORAGE_DTYPES, BITS
 
-os.environ["TOKENIZERS_PARALLELISM"] = "True"
 
 parser = argparse.ArgumentParser("gradient_extraction")
 parser.add_argument("model", help="A model on the hf hub. Format: username/name_curriculum")
 parser.add_argument("dataset", help="A dataset on the hf hub. Format: username/name")
 parser.add_argument("--dataset_split", help="The split to access", default="train")
-parser.add_argument("checkpoint_nr", help="Id of the checkpoint to extract gradients for (starting at 0)",type=int)
+parser.add_argument("checkpoint_nr", help="Id of the checkpoint to extract gradients for (starting at 0)",type=int, nargs="?", default=None)
+parser.add_argument("--checkpoints", help="Ids of several checkpoints to extract in one job instead of checkpoint_nr: ids, inclusive ranges (e.g. 0-5) or 'all'. The dataset and projectors are set up once, the weights are swapped in place", nargs="+", default=None)
+parser.add_argument("--checkpoint_cache_dir", help="Where to keep the checkpoint list of every model, so later jobs start without listing the Hub. Set to '' to list it every time", default="./checkpoint_lists")
+parser.add_argument("--tracin", help="With --checkpoints, store the sum over the checkpoints of the weighted gradients (TracIn) in one store ('tracin' folder) instead of one store per checkpoint", default=False, action='store_true')
+parser.add_argument("--checkpoint_weights", help="Weight of every checkpoint in the --tracin sum, e.g. its learning rate (default: 1 each)", type=float, nargs="+", default=None)
 parser.add_argument("--gradients_per_file", help="Number of gradients per output file", type=int, nargs="?", const=1, default=1000) # 10000 = ~7.4 GB per file for BERT
 parser.add_argument("--paradigm", help="Eiter 'pre', 'mlm', or 'sft'", default="mlm")
 parser.add_argument("--gradients_output_path", help="The path where to store gradients at", default="./gradients")
 parser.add_argument("--mode", help="Eiter 'store', or 'store_mean'", default="store")
+parser.add_argument("--track_variance", help="In 'store_mean' mode, also store the per-coordinate variance", default=False, action='store_true')
 parser.add_argument("--skip_if_gradient_folder_exists", default=False, action='store_true')
 parser.add_argument("--random_projection", default=False, action='store_true')
-parser.add_argument("--proj_dim", type=int, nargs="?", const=1, default=2**14)
-parser.add_argument("--proj_type", type=str, default="rademacher", help="Type of projection to use: normal or rademacher.")
-args = parser.parse_args()
-
-# print("Args", args, flush=True)
-# print("Cuda version:", torch.version.cuda)
-
-
-model_name = args.model.split("/")[-1]
-dataset_name = args.dataset.split("/")[-1]
-dataset_split_name = args.dataset_split
-
-# create output dirs
-if args.random_projection:
-    proj_folder_name = f"{args.proj_type}_{args.proj_dim}"
-else:
-    proj_folder_name = "full"
-
-gradient_output_dir = os.path.join(args.gradients_output_path, proj_folder_name, model_name, dataset_name, dataset_split_name)
+parser.add_argument("--proj_dim", help="Dimension(s) of the projected gradients. Every gradient is computed once and projected to all dimensions and types, one output folder each", type=int, nargs="+", default=[2**14])
+parser.add_argument("--proj_type", type=str, nargs="+", default=["rademacher"], choices=PROJECTION_TYPES, help="Type(s) of projection to use: normal, rademacher, srht, countsketch, achlioptas or very_sparse.")
+parser.add_argument("--nested_projections", help="Project once per type to the largest --proj_dim and store its first proj_dim coordinates for the smaller ones", default=False, action='store_true')
+parser.add_argument("--store_full", help="With --random_projection, also store the full gradients in the same pass", default=False, action='store_true')
+parser.add_argument("--storage_dtype", help="How dense stores keep the gradients: float16, or int8 / 4-bit codes with a float32 scale per block (output folders get the dtype as a suffix)", choices=STORAGE_DTYPES, default="float16")
+parser.add_argument("--quant_block_size", help="Number of coordinates of a row that share a scale with --storage_dtype int8/int4 (0: one scale per row)", type=int, default=0)
+parser.add_argument("--projector_backend", help="Where to project: 'cuda' (trak CudaProjector / on --device) or 'cpu' (CpuProjector / on the CPU)", choices=["cuda", "cpu"], default="cuda")
+parser.add_argument("--batch_size", help="Maximum number of examples per forward/backward pass", type=int, default=1)
+parser.add_argument("--dataloader_workers", help="Number of processes that transform the examples of the next chunk while the gradients of the current one are computed (0: a background thread)", type=int, default=0)
+parser.add_argument("--prefetch_factor", help="Number of examples each dataloader worker transforms ahead, and of mini-batches collated ahead", type=int, default=2)
+parser.add_argument("--max_tokens_per_batch", help="Maximum number of (padded) tokens per forward/backward pass", type=int, default=None)
+parser.add_argument("--lean", help="Memory-lean extraction: frozen parameters (only the input embeddings get gradients), eval mode (no dropout), deterministic kernels and activation checkpointing of every transformer block", default=False, action='store_true')
+parser.add_argument("--attn_implementation", help="Attention kernel of the model (default: the model's own choice)", choices=["eager", "sdpa", "flash_attention_2"], default=None)
+parser.add_argument("--autocast", help="Run the forward pass under torch.autocast with this dtype", choices=["bf16", "fp16"], default=None)
+parser.add_argument("--device", help="The device to compute gradients on (e.g., cuda:0 or cpu). Default: cuda:<local rank>", default=None)
+parser.add_argument("--num_shards", help="Number of workers the dataset is split across (default: from torchrun / the SLURM job array, else 1)", type=int, default=None)
+parser.add_argument("--shard_index", help="Index of this worker (default: from torchrun / the SLURM job array, else 0)", type=int, default=None)
+parser.add_argument("--gradient_layers", help="Capture the per-example gradients of these linear layers instead of the input embeddings, stored as factors: module names or patterns (e.g. lm_head, 'model.layers.15.*'), or last_blocks:N for the last N transformer blocks", nargs="+", default=None)
+parser.add_argument("--ragged", help="Store full gradients without the rows of padding tokens", default=False, action='store_true')
+parser.add_argument("--resume", help="Continue unfinished shards from their journal instead of starting them over", default=False, action='store_true')
+parser.add_argument("--profile", help="Write per-stage timings, token counts and peak memory of every mini-batch and chunk to profile.jsonl in the output folder (and wandb)", default=False, action='store_true')
+parser.add_argument("--torch_profiler_steps", help="Record a torch.profiler trace of this many mini-batches (to torch_trace/ in the output folder)", type=int, default=0)
+parser.add_argument("--torch_profiler_wait", help="Number of mini-batches before the torch.profiler window starts", type=int, default=1)
+parser.add_argument("--writer_queue_size", help="Number of micro-batches that may wait for the background writer", type=int, default=4)
+parser.add_argument("--tokenized_cache_dir", help="Where to keep pre-tokenized (sft) datasets. Set to '' to tokenize on the fly", default="./tokenized")
+parser.add_argument("--num_proc", help="Number of processes for pre-tokenization", type=int, default=int(os.getenv("SLURM_CPUS_PER_TASK", os.cpu_count())))
+
+
+PROJECTOR_MAX_BATCH_SIZE = 8
+
+RETRY_FILE = "retry.jsonl"
+
+# checkpoint folder of the --tracin sum
+TRACIN_FOLDER = "tracin"
+
+
+def get_outputs(args):
+    """Every output gets the same gradients: (folder name, projection type, projection dim), (folder name, None, None)
+    for full gradients.
+
+    Factors of the --gradient_layers go to 'factors', and a projection of proj_dim per layer. Quantized dense stores
+    get the --storage_dtype as a suffix, ragged and factor stores are always float16.
+    """
+    folder_prefix = "factors_" if args.gradient_layers else ""
+    folder_suffix = "" if args.storage_dtype == "float16" else f"_{args.storage_dtype}"
+    outputs = []
+    if args.random_projection:
+        outputs += [(f"{folder_prefix}{proj_type}_{proj_dim}{folder_suffix}", proj_type, proj_dim) for proj_type in args.proj_type for proj_dim in args.proj_dim]
+    if not args.random_projection or args.store_full:
+        outputs.append(("factors" if args.gradient_layers else "full_ragged" if args.ragged else f"full{folder_suffix}", None, None))
+    return outputs
 
 
-if not os.path.exists(gradient_output_dir):
-    os.makedirs(gradient_output_dir, exist_ok=True)
+def parse_args(argv=None):
+    """Parses and checks the options of an extraction (`argv`: e.g. a list of command line arguments, default: sys.argv)."""
+    args = parser.parse_args(argv)
 
+    worker_index, num_workers, _ = util.get_worker_info()
+    args.num_shards = args.num_shards if args.num_shards is not None else num_workers
+    args.shard_index = args.shard_index if args.shard_index is not None else worker_index
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f"--shard_index must be in [0, {args.num_shards})")
 
+    if args.ragged and ((args.random_projection and not args.store_full) or args.mode != "store" or args.paradigm == "mlm"):
+        parser.error("--ragged is only supported for full gradients (no --random_projection, or --store_full) in 'store' mode of causal models")
 
-logging.basicConfig(
-                    level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.gradient_layers and (args.mode != "store" or args.paradigm == "mlm" or args.nested_projections):
+        parser.error("--gradient_layers is only supported in 'store' mode of causal models, without --nested_projections")
 
+    if (args.checkpoint_nr is None) == (args.checkpoints is None):
+        parser.error("give either checkpoint_nr or --checkpoints")
+    if args.checkpoint_weights is not None and not args.tracin:
+        parser.error("--checkpoint_weights are the weights of the --tracin sum")
+    if args.tracin and (args.mode != "store" or args.ragged or (args.gradient_layers and (not args.random_projection or args.store_full))):
+        parser.error("--tracin sums up dense gradients in 'store' mode (no --ragged or factor stores)")
 
+    args.proj_dim, args.proj_type = list(dict.fromkeys(args.proj_dim)), list(dict.fromkeys(args.proj_type))
+    if args.nested_projections and not set(args.proj_type) <= set(PREFIX_PROJECTION_TYPES):
+        parser.error(f"--nested_projections only works for {PREFIX_PROJECTION_TYPES}")
 
-device = "cuda:0"
+    if args.mode == "store_mean" and len(get_outputs(args)) > 1:
+        parser.error("'store_mean' stores the mean of the full gradients, use a single --proj_dim and --proj_type")
+    return args
 
 
-def get_loss_gradient(model, example,device):
-    """Computes gradient of the loss function irt to the input embeddings.
+def get_length_buckets(indices, lengths, batch_size, max_tokens_per_batch=None):
+    """Groups dataset indices into mini-batches of examples with a similar number of real tokens.
 
     Args:
-        model: A model with a `forward` method wich returns `loss`
-        example: An instance from the training data
-        device: What GPU to use (e.g., cuda:0)
+        indices: The dataset indices to group
+        lengths: A dict mapping each index to its real length (see `get_example_length`)
+        batch_size: Maximum number of examples per mini-batch
+        max_tokens_per_batch: Maximum number of tokens per mini-batch after padding to its longest example
 
     Returns:
-        A 1D tensor: gradient of the loss function irt to the input embeddings
+        A list of lists of indices, longest examples first (so an OOM shows up at the beginning of a chunk)
     """
-    # uncomment this to debug out of memory errors:
-
-    # free_mem, total_mem = torch.cuda.mem_get_info(device=device)
-    # print(f"Free memory {device}:  {(free_mem/total_mem)} {free_mem / (1024 ** 2):.2f}/{total_mem / (1024 ** 2):.2f}",flush=True)
-
-
-    model.zero_grad()
+    buckets, bucket = [], []
+    for i in sorted(indices, key=lambda i: lengths[i], reverse=True):
+        if bucket:
+            # sorted descending: the first example of a bucket is its longest
+            padded_tokens = (len(bucket) + 1) * lengths[bucket[0]]
+            if len(bucket) >= batch_size or (max_tokens_per_batch is not None and padded_tokens > max_tokens_per_batch):
+                buckets.append(bucket)
+                bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
 
-    # we process one example at a time 
-    example = data_collator(
-        [ # <- but the dataloader expects a batch
-            {
-            key: value  
-            for key, value in example.items() if key in ["input_ids", "attention_mask", "labels"] # only keep relevant cols
-            }
-        ]) 
-    
-    # n.b.: according to the documentaiton: "Shifting the inputs and labels to align them happens inside the model, so the data collator just copies the inputs to create the labels." https://huggingface.co/learn/nlp-course/chapter7/6#initializing-a-new-model
 
+class _Examples(torch.utils.data.Dataset):
+    """`(dataset[i], real length)` for the given indices: the dataset's transform runs in the DataLoader workers."""
 
-    # obtain input embeddings
-    inputs_embeds=model.get_input_embeddings().weight[example["input_ids"]].to(device)
-    inputs_embeds.retain_grad()
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
 
+    def __len__(self):
+        return len(self.indices)
 
-    outputs = model.forward(
-            inputs_embeds=inputs_embeds,
-            labels=example["labels"].to(device)
-        )
+    def __getitem__(self, k):
+        example = self.dataset[self.indices[k]]
+        return example, get_example_length(example)
 
 
-    loss = outputs.loss 
-    loss.retain_grad()
-    return torch.autograd.grad(loss, inputs_embeds, retain_graph=False)[0].squeeze()
-    
+class _ReadAhead:
+    """Iterates over `iterable` in a background thread, at most `size` items ahead of the consumer.
 
-def get_for_checkpoint(model, projector, checkpoint_path, i_start, i_end):
-    """Calculates gradients at a given checkpoint for a given subset and stores it to disk
-
-    Args:
-        checkpoint_path: Path to the checkpoint folder
-        i_start: Start id from the dataset
-        i_end: Stop id from the dataset (non-inclusive)
-
-    Raises:
-        e: Any error but most likely OOM
-    """                
-    log_prefix = f"[batch {checkpoint_path}_{i_start}_{i_end}]"
-    try:      
-        logging.debug(f"{log_prefix} is starting...")
-        if not any([a in args.model for a in ["llama", "OLMo"]]):
-            data_collator.set_epoch(util.get_epoch(checkpoint_path)) # to ensure the same masking as during training
-
-
-        out_dir = os.path.join(gradient_output_dir, os.path.basename(checkpoint_path))
-        out_path = os.path.join(gradient_output_dir, os.path.basename(checkpoint_path), "mean") if args.mode == "store_mean" else os.path.join(gradient_output_dir, os.path.basename(checkpoint_path),str(i_start) + "_" + str(i_end))
-        os.makedirs(out_dir,exist_ok=True)
-        if os.path.isfile(out_path):
-            logging.info(f"{log_prefix} skipping {out_path}, already stored")
-            return 
-      
-        
-    
-        gradients = None
-        
-        logging.debug(f"{log_prefix} is getting gradients...")
-
-
-        def project(x):
-            p = projector.project(x, model_id=0)
-            return p
-
-              
-        gradients = torch.stack([ 
-                                    project(
-                                        get_loss_gradient(
-                                            model, 
-                                            dataset[i],
-                                            device
-                                        ).detach().flatten().unsqueeze(0).half()
-                                    ).cpu() 
-                                    for i in tqdm(range(i_start, i_end), desc=f"{log_prefix} is getting gradients...")
-                                ])
-        logging.debug(f"{log_prefix} ... got gradients")
-        if args.mode == "store":
-            torch.save( gradients, out_path)
-            logging.info(f"{log_prefix} stored gradients to {out_path}")
-        else:
-            logging.info(f"{log_prefix} partial sum")
-            return torch.sum(gradients, axis=0)
-        del gradients
-        return
-    except:
-        print(f"Exception during {checkpoint_path}_{i_start}_{i_end}", traceback.format_exc(),flush=True)
-
-
-
-tokenizer = None
-
-
-if "llama" in args.model:
-    tokenizer = GPT2TokenizerFast.from_pretrained(args.model, max_len=512)
-elif "OLMo" in args.model:
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
-else: # RoBERTa
-    tokenizer = RobertaTokenizerFast.from_pretrained(args.model, max_len=512)
-   
-
-
-dataset = None
-
-paradigm = args.paradigm
-
-if "alpaca" in args.dataset:
-    # https://wandb.ai/capecape/alpaca_ft/reports/How-to-Fine-tune-an-LLM-Part-3-The-HuggingFace-Trainer--Vmlldzo1OTEyNjMy#sampling-from-the-model-during-training
-    def prompt_no_input(output,_,instruction):
-        return ("Below is an instruction that describes a task. "
-                "Write a response that appropriately completes the request.\n\n"
-                "### Instruction:\n{instruction}\n\n### Response:\n{output}").format(instruction=instruction, output=output)
-
-
-    def prompt_input(output,input,instruction):
-        return ("Below is an instruction that describes a task, paired with an input that provides further context. "
-                "Write a response that appropriately completes the request.\n\n"
-                "### Instruction:\n{instruction}\n\n### Input:\n{input}\n\n### Response:\n{output}").format(instruction=instruction, input=input, output=output)
-
-
-    def create_alpaca_prompt(rows):
-
-        return [prompt_no_input(*row) if row[1] == "" else prompt_input(*row) for row in zip(*rows.values())]
-    
-    dataset = load_dataset(args.dataset, split=args.dataset_split) 
-    dataset.set_transform(lambda x : tokenizer(create_alpaca_prompt(x), return_special_tokens_mask=True, truncation=True, padding="max_length", max_length=4096))
-    
-    paradigm = "pre"
-    logging.info(f"dataset format: alpaca (pre)")
-
-elif paradigm in ["pre", "mlm"]:
-    dataset = load_dataset(args.dataset, split=args.dataset_split)
-
-    if "completion" in dataset.column_names: # hotfix for custom tulu dataset format used during olmo fine-tuning
-        def transform_example(x):
-            # re format...
-            chat_template = \
-                {"messages":  [
-                    {"role": "user", "content": x["prompt"][0]},
-                    {"role": "assistant", "content": x["completion"][0]}
-                    ]
-                }
-            return sft_tulu_tokenize_and_truncate_v1(chat_template, tokenizer=tokenizer)  # ... so we can use Olmo sft code
-        dataset.set_transform(transform_example)
-
-        logging.info(f"dataset format: chat format (pre)")
-    elif "text" in dataset.column_names:   
-        dataset.set_transform(lambda x : tokenizer(x["text"], return_special_tokens_mask=True, truncation=True, padding="max_length", max_length=4096 if "OLMo" in args.model else 512))
-
-        logging.info(f"dataset format: pre")
-    else:
-        raise NotImplementedError
-elif paradigm == "sft":
-    dataset = load_dataset(args.dataset, split=args.dataset_split)
-    dataset.set_transform(lambda x : sft_tulu_tokenize_and_truncate_v1(x, tokenizer=tokenizer))
-    logging.info(f"dataset format: tulu (sft)")
-
-else:
-    raise NotImplementedError
-
-def get_data_collator(paradigm):
-    if paradigm in ["mlm"]:
-        return DeterministicDataCollatorForLanguageModeling(
-            tokenizer=tokenizer, mlm=True, mlm_probability=0.15
-        ) 
-    if paradigm in ["pre"]:
-        return DataCollatorForLanguageModeling(
-            tokenizer=tokenizer, mlm=False
-        )
-    if paradigm in ["sft"]:
-            return DataCollatorForSeq2Seq(
-                tokenizer=tokenizer
-            )
+    Errors of the thread are raised again by the consumer. `close` stops the thread, e.g. when the consumer fails.
+    """
 
-data_collator = get_data_collator(paradigm)
+    _END = object()
+
+    def __init__(self, iterable, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.done = None
+        self.thread = threading.Thread(target=self._run, args=(iterable,), name="ReadAhead", daemon=True)
+        self.thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+            self._put((self._END, None))
+        except BaseException as e:
+            self._put((self._END, e))
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done is None:
+            item = self.queue.get()
+            if not (isinstance(item, tuple) and item and item[0] is self._END):
+                return item
+            self.done = item
+        if self.done[1] is not None:
+            raise self.done[1]
+        raise StopIteration
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class _ChunkExamples:
+    """The examples of consecutive chunks of an extraction, transformed one chunk ahead in the background (by the
+    `--dataloader_workers`), so the transforms of the next chunk run while the gradients of the current one are
+    computed. One stream (and one DataLoader) serves all chunks of a checkpoint."""
+
+    def __init__(self, indices, examples, chunk_size):
+        """
+        Args:
+            indices: The dataset indices of all chunks, ascending
+            examples: (example, real length) of every index, e.g. from `GradientExtractor.prefetch`
+            chunk_size: Number of examples read ahead
+        """
+        self.items = _ReadAhead(zip(indices, examples), chunk_size)
+        self.next_item = None
+
+    def take(self, indices):
+        """Examples and lengths of `indices` (ascending). Rows before them that were not taken (e.g. of a chunk that
+        was skipped) are dropped, rows the stream does not hold are missing from the result."""
+        wanted = set(indices)
+        examples, lengths = {}, {}
+        while wanted:
+            if self.next_item is None:
+                self.next_item = next(self.items, None)
+                if self.next_item is None:
+                    break
+            i, (example, length) = self.next_item
+            if i > indices[-1]:
+                break
+            self.next_item = None
+            if i in wanted:
+                examples[i], lengths[i] = example, length
+                wanted.discard(i)
+        return examples, lengths
+
+    def close(self):
+        self.items.close()
+
+
+def is_out_of_memory(error):
+    """Whether an error of a forward/backward pass is an out of memory error (of CUDA or the CPU allocator): only
+    these are retried in `low_memory_mode`, anything else (e.g. a failed gradient writer) stops the extraction."""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(error, RuntimeError) and any(message in str(error) for message in ["out of memory", "can't allocate memory"])
+
+
+def _keep(item):
+    return item
+
+
+def _init_worker(_):
+    torch.set_num_threads(1) # the workers share the CPUs
+
+
+def checkpoint_blocks(model):
+    """Recomputes the activations of every transformer block during the backward pass (--lean).
+
+    Unlike `gradient_checkpointing_enable`, this also works in eval mode: only the block inputs are kept.
+    """
+    _, blocks = get_blocks(model)
+    for block in blocks:
+        block.forward = functools.partial(torch.utils.checkpoint.checkpoint, block.forward, use_reentrant=False)
 
 
-checkpoints =  get_checkpoints_hub(args.model)
+class GradientExtractor:
+    """Extracts the gradients of a dataset at one or more checkpoints of a model (see `parse_args` for the options).
 
+    Nothing is loaded when an extractor is created. The tokenizer, the dataset, the checkpoint list, the model and
+    the projectors are set up on first use and kept, so one extractor can serve several extractions in a process
+    (e.g. a notebook), and a job that only needs some of them does not pay for the others. The checkpoint list is
+    kept in `--checkpoint_cache_dir`, so with the model and dataset in the local Hugging Face caches (and
+    HF_HUB_OFFLINE=1), an extraction starts without any network call.
 
-if __name__ == '__main__':
-    
-    checkpoint = checkpoints[args.checkpoint_nr]
-    
-    out_path = os.path.join(gradient_output_dir, os.path.basename(checkpoint))
-    
-
-    if args.mode == "store_mean" and os.path.isfile(os.path.join(out_path,"mean")):
-        logging.info("Skipping {}, already calculated".format(out_path) )
-    elif args.mode == "store" and os.path.isdir(out_path) and len(os.listdir(out_path)) == 0 and args.skip_if_gradient_folder_exists:
-        logging.info("Skipping {}, because folder exists (--skip_if_gradient_folder_exists) and is empty".format(out_path) )
-    else:
-        
-        logging.info(f"writing results to {out_path}")
+    Example:
+        extractor = GradientExtractor(parse_args(["allenai/OLMo-2-1124-7B-SFT", "daryna3325/sampled-tulu-1000", "0", "--paradigm", "sft"]))
+        extractor.run()
+    """
 
-        run = None
-        if os.getenv("WANDB_API_KEY") is not None:
-            run = wandb.init(project="gradient_extraction")
-            run.name = os.path.join(args.model, os.getenv("SLURM_JOB_NAME", "?"))
+    def __init__(self, args):
+        self.args = args
+        _, _, local_rank = util.get_worker_info()
+        self.device = args.device if args.device is not None else f"cuda:{local_rank}"
+
+        self.model_name = args.model.split("/")[-1]
+        self.dataset_name = args.dataset.split("/")[-1]
+        self.dataset_split_name = args.dataset_split
+
+        # alpaca prompts are extracted as pre-training text
+        self.paradigm = "pre" if "alpaca" in args.dataset else args.paradigm
+        self.batch_size = args.batch_size
+        if self.paradigm == "mlm" and (self.batch_size > 1 or args.max_tokens_per_batch is not None):
+            logging.warning("batched extraction needs a causal model, falling back to --batch_size=1")
+            self.batch_size = 1
+
+        self.outputs = get_outputs(args)
+        self.gradient_output_dirs = [os.path.join(args.gradients_output_path, folder, self.model_name, self.dataset_name, self.dataset_split_name) for folder, _, _ in self.outputs]
+
+        if args.lean:
+            os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG", ":4096:8") # deterministic cuBLAS, read when CUDA is initialised
+            torch.use_deterministic_algorithms(True, warn_only=True)
+            torch.backends.cudnn.benchmark = False
+
+        # dataset indices whose gradients could not be computed, even with the low memory strategy
+        self.failed_indices = []
+
+        # replaced by an enabled one with --profile
+        self.profiler = ExtractionProfiler(enabled=False)
+
+        # with --gradient_layers: captures the factors of the layers' gradients instead of the embedding gradients
+        self.capture = None
+
+        # the checkpoint whose weights the model holds
+        self.loaded = None
+
+        # the examples of the chunks of the current checkpoint, read ahead (see `run`)
+        self.chunk_examples = None
+
+    @functools.cached_property
+    def tokenizer(self):
+        if "llama" in self.args.model:
+            return GPT2TokenizerFast.from_pretrained(self.args.model, max_len=512)
+        if "OLMo" in self.args.model:
+            return AutoTokenizer.from_pretrained(self.args.model)
+        return RobertaTokenizerFast.from_pretrained(self.args.model, max_len=512) # RoBERTa
+
+    @functools.cached_property
+    def dataset(self):
+        """The dataset split, with a transform (or a tokenized cache) that yields model inputs."""
+        args, tokenizer = self.args, self.tokenizer
+
+        if "alpaca" in args.dataset:
+            # https://wandb.ai/capecape/alpaca_ft/reports/How-to-Fine-tune-an-LLM-Part-3-The-HuggingFace-Trainer--Vmlldzo1OTEyNjMy#sampling-from-the-model-during-training
+            def prompt_no_input(output,_,instruction):
+                return ("Below is an instruction that describes a task. "
+                        "Write a response that appropriately completes the request.\n\n"
+                        "### Instruction:\n{instruction}\n\n### Response:\n{output}").format(instruction=instruction, output=output)
+
+
+            def prompt_input(output,input,instruction):
+                return ("Below is an instruction that describes a task, paired with an input that provides further context. "
+                        "Write a response that appropriately completes the request.\n\n"
+                        "### Instruction:\n{instruction}\n\n### Input:\n{input}\n\n### Response:\n{output}").format(instruction=instruction, input=input, output=output)
+
+
+            def create_alpaca_prompt(rows):
+
+                return [prompt_no_input(*row) if row[1] == "" else prompt_input(*row) for row in zip(*rows.values())]
+
+            dataset = load_dataset(args.dataset, split=args.dataset_split)
+            dataset.set_transform(lambda x : tokenizer(create_alpaca_prompt(x), return_special_tokens_mask=True, truncation=True, padding="max_length", max_length=4096))
+
+            logging.info(f"dataset format: alpaca (pre)")
+
+        elif self.paradigm in ["pre", "mlm"]:
+            dataset = load_dataset(args.dataset, split=args.dataset_split)
+
+            if "completion" in dataset.column_names: # hotfix for custom tulu dataset format used during olmo fine-tuning
+                def transform_example(x):
+                    # re format...
+                    chat_template = \
+                        {"messages":  [
+                            {"role": "user", "content": x["prompt"][0]},
+                            {"role": "assistant", "content": x["completion"][0]}
+                            ]
+                        }
+                    return sft_tulu_tokenize_and_truncate_v2(chat_template, tokenizer=tokenizer)  # ... so we can use Olmo sft code
+                dataset.set_transform(transform_example)
+
+                logging.info(f"dataset format: chat format (pre)")
+            elif "text" in dataset.column_names:
+                dataset.set_transform(lambda x : tokenizer(x["text"], return_special_tokens_mask=True, truncation=True, padding="max_length", max_length=4096 if "OLMo" in args.model else 512))
+
+                logging.info(f"dataset format: pre")
+            else:
+                raise NotImplementedError
+        elif self.paradigm == "sft":
+            dataset = load_dataset(args.dataset, split=args.dataset_split)
+            if args.tokenized_cache_dir:
+                dataset = get_tokenized_sft_dataset(dataset, tokenizer, os.path.join(args.tokenized_cache_dir, self.dataset_name, self.dataset_split_name), num_proc=args.num_proc)
+            else:
+                dataset.set_transform(lambda x : sft_tulu_tokenize_and_truncate_v2(x, tokenizer=tokenizer))
+            logging.info(f"dataset format: tulu (sft)")
 
-      
-        model = None
- 
+        else:
+            raise NotImplementedError
+        return dataset
+
+    @functools.cached_property
+    def data_collator(self):
+        if self.paradigm in ["mlm"]:
+            return DeterministicDataCollatorForLanguageModeling(
+                tokenizer=self.tokenizer, mlm=True, mlm_probability=0.15
+            )
+        if self.paradigm in ["pre"]:
+            return DataCollatorForLanguageModeling(
+                tokenizer=self.tokenizer, mlm=False
+            )
+        if self.paradigm in ["sft"]:
+                return DataCollatorForSeq2Seq(
+                    tokenizer=self.tokenizer
+                )
+
+    @functools.cached_property
+    def checkpoints(self):
+        """All checkpoints of the model (see `util.get_checkpoints`)."""
+        return util.get_checkpoints(self.args.model, self.args.checkpoint_cache_dir)
+
+    @functools.cached_property
+    def selected_checkpoints(self):
+        """The checkpoints of this extraction: checkpoint_nr or --checkpoints."""
+        if self.args.checkpoints is not None:
+            return util.select_checkpoints(self.checkpoints, self.args.checkpoints)
+        return [self.checkpoints[self.args.checkpoint_nr]]
+
+    @functools.cached_property
+    def checkpoint_weights(self):
+        weights = self.args.checkpoint_weights or [1.0] * len(self.selected_checkpoints)
+        if len(weights) != len(self.selected_checkpoints):
+            raise ValueError(f"--checkpoint_weights needs one weight per checkpoint ({len(self.selected_checkpoints)})")
+        return weights
+
+    @functools.cached_property
+    def model(self):
+        """The model, for the first selected checkpoint unless `load_checkpoint` was called."""
+        self.loaded = self.selected_checkpoints[0]
+        return self.load_model(self.loaded)
+
+    @functools.cached_property
+    def grad_dim(self):
+        """Dimension of the (unprojected) gradients: padded length x hidden size, no backward pass needed."""
+        return len(self.dataset[0]["input_ids"]) * self.model.get_input_embeddings().weight.shape[-1]
+
+    @functools.cached_property
+    def projectors(self):
+        """One (projector, output dimension) per output (see `get_projectors`)."""
+        return self.get_projectors(self.model)
+
+    def autocast(self):
+        """`torch.autocast` for the forward pass with --autocast, else a no-op."""
+        return loss_gradients.autocast(self.device, self.args.autocast)
+
+    def collate_examples(self, examples):
+        """See `loss_gradients.collate_examples`."""
+        return loss_gradients.collate_examples(examples, self.data_collator)
+
+    def get_loss_gradients(self, model, batch, lengths, device):
+        """Per-example gradients of a mini-batch with the --autocast, --gradient_layers and --profile of this run
+        (see `loss_gradients.get_loss_gradients`)."""
+        return loss_gradients.get_loss_gradients(model, batch, lengths, device, autocast_dtype=self.args.autocast, capture=self.capture, profiler=self.profiler, causal=self.paradigm != "mlm")
+
+    def prefetch(self, items):
+        """Iterates over a map-style dataset, prepared `--prefetch_factor` items ahead by `--dataloader_workers`
+        processes. Items come back in order, so the result is the same for any number of workers (0: synchronously)."""
+        workers = self.args.dataloader_workers
+        return iter(torch.utils.data.DataLoader(
+            items,
+            batch_size=None,
+            collate_fn=_keep,
+            num_workers=workers,
+            prefetch_factor=self.args.prefetch_factor if workers else None,
+            worker_init_fn=_init_worker if workers else None,
+        ))
+
+    def load_examples(self, indices):
+        """(example, real length) of the dataset `indices` (ascending), from the chunk stream of `run` if there is one.
+
+        Returns:
+            A dict of examples and a dict of lengths, by index
+        """
+        examples, lengths = self.chunk_examples.take(indices) if self.chunk_examples is not None and indices else ({}, {})
+        for i in indices:
+            if i not in examples: # e.g. get_for_checkpoint called outside of `run`
+                examples[i] = self.dataset[i]
+                lengths[i] = get_example_length(examples[i])
+        return examples, lengths
+
+    def iter_batches(self, examples, buckets, pin_memory=False):
+        """The collated mini-batch of every bucket (see `collate_examples`), in pinned memory for a copy to the GPU that
+        does not block."""
+        for bucket in buckets:
+            batch = self.collate_examples([examples[i] for i in bucket])[0]
+            yield {key: value.pin_memory() for key, value in batch.items()} if pin_memory else batch
+
+    @contextlib.contextmanager
+    def low_memory_mode(self, model):
+        """Trades compute for memory: activations are recomputed during the backward pass (gradient checkpointing)."""
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if self.args.lean: # the blocks are checkpointed already
+            yield
+            return
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        try:
+            yield
+        finally:
+            model.gradient_checkpointing_disable()
+
+    def record_failure(self, out_dir, checkpoint_path, indices, error, low_memory):
+        """Appends examples whose gradients failed (e.g. out of memory) to the retry list of the output folder."""
+        logging.warning(f"gradients of {len(indices)} example(s) failed{' in low memory mode' if low_memory else ''}: {error}")
+        with open(os.path.join(out_dir, RETRY_FILE), "a", encoding="utf-8") as f:
+            for i in indices:
+                f.write(json.dumps({"checkpoint": os.path.basename(checkpoint_path), "index": i, "low_memory": low_memory, "error": str(error)}) + "\n")
+
+    def get_output_paths(self, checkpoint_path):
+        """The folder of every output for a checkpoint ('tracin' for the sum over all checkpoints)."""
+        return [os.path.join(output_dir, TRACIN_FOLDER if self.args.tracin else os.path.basename(checkpoint_path)) for output_dir in self.gradient_output_dirs]
+
+    def open_dense_shard(self, writer, shard_name, i_start, num_rows, gradients):
+        """Starts a dense shard of the --storage_dtype for (n x dim) `gradients`."""
+        if self.args.storage_dtype == "float16":
+            writer.open_dense(shard_name, i_start, num_rows, dim=gradients.shape[-1], dtype=gradients.dtype)
+        else:
+            writer.open_quantized(shard_name, i_start, num_rows, dim=gradients.shape[-1], bits=BITS[self.args.storage_dtype], block_size=self.args.quant_block_size)
+
+    def get_for_checkpoint(self, model, projectors, checkpoint_path, i_start, i_end, writers=None, moments=None, sums=None):
+        """Calculates gradients at a given checkpoint for a given subset and stores it to disk
+
+        Args:
+            projectors: One (projector, output dimension) per output (see `outputs`). Outputs that share a projector
+                (--nested_projections) share its projection and store its first `output dimension` coordinates
+            checkpoint_path: Path to the checkpoint folder
+            i_start: Start id from the dataset
+            i_end: Stop id from the dataset (non-inclusive)
+            writers: One AsyncShardWriter per output, gradients are handed to them as they are computed ('store' mode)
+            moments: The GradientMoments gradients are added to as they are computed ('store_mean' mode)
+            sums: One CheckpointSum per output (--tracin): gradients are added to it, and the shard is only handed to
+                the writer once the sum holds all checkpoints
+
+        Mini-batches that run out of memory are recorded in the retry list and computed again one example at a time in
+        `low_memory_mode`. Examples that still fail are added to `failed_indices`, and their shard stays unfinished,
+        so `--resume` can complete it later.
+
+        Raises:
+            e: Any other error (see `is_out_of_memory`)
+        """
+        args, dataset, outputs, profiler, capture, device = self.args, self.dataset, self.outputs, self.profiler, self.capture, self.device
+        log_prefix = f"[batch {checkpoint_path}_{i_start}_{i_end}]"
+        profiler.start_chunk()
+        try:
+            logging.debug(f"{log_prefix} is starting...")
+            if not any([a in args.model for a in ["llama", "OLMo"]]):
+                self.data_collator.set_epoch(util.get_epoch(checkpoint_path)) # to ensure the same masking as during training
+
+
+            out_dirs = self.get_output_paths(checkpoint_path)
+            out_dir = out_dirs[0]
+            shard_name = str(i_start) + "_" + str(i_end)
+            for d in out_dirs:
+                os.makedirs(d, exist_ok=True)
+
+            indices = range(i_start, min(i_end, len(dataset)))
+
+            def store_sum(k):
+                gradients = sums[k].load(shard_name)
+                gradients = gradients if args.storage_dtype != "float16" else gradients.half()
+                self.open_dense_shard(writers[k], shard_name, i_start, len(indices), gradients)
+                writers[k].write(shard_name, list(range(len(indices))), gradients)
+                writers[k].finalize(shard_name) # the sum files are removed once the shard is written, see run
+
+            # the outputs that still need this shard
+            pending = list(range(len(outputs)))
+            if args.mode == "store":
+                pending = [k for k in pending if not shard_exists(out_dirs[k], shard_name)]
+                if sums is not None:
+                    for k in pending:
+                        if sums[k].complete(shard_name): # all checkpoints were added before the job stopped
+                            store_sum(k)
+                    pending = [k for k in pending if checkpoint_path not in sums[k].added(shard_name)]
+                if not pending:
+                    logging.info(f"{log_prefix} skipping {shard_name}, already stored")
+                    return
+
+            stored_rows = {k: set() for k in pending}
+            shard_opened = {k: False for k in pending}
+            if args.mode == "store" and args.resume and sums is None: # sums are only ever added whole
+                for k in pending:
+                    rows = writers[k].resume(shard_name)
+                    shard_opened[k] = rows is not None
+                    stored_rows[k] = rows or set()
+                    if stored_rows[k]:
+                        logging.info(f"{log_prefix} resuming {shard_name} in {out_dirs[k]}, {len(stored_rows[k])} gradients already stored")
+
+
+
+            logging.debug(f"{log_prefix} is getting gradients...")
+
+
+            def project(projector, x):
+                # the CudaProjector only supports batches of up to PROJECTOR_MAX_BATCH_SIZE gradients
+                chunks = x.split(PROJECTOR_MAX_BATCH_SIZE) if isinstance(projector, CudaProjector) else [x]
+                p = torch.cat([projector.project(chunk, model_id=0) for chunk in chunks])
+                return p
+
+            remaining = [i for i in indices if any(i - i_start not in stored_rows[k] for k in pending)]
+            with profiler.stage("transform"): # only the wait for the chunk stream, if it runs ahead (see `run`)
+                examples, lengths = self.load_examples(remaining)
+
+            def flatten(bucket, batch_gradients):
+                with profiler.stage("pad"):
+                    if self.paradigm != "mlm":
+                        batch_gradients = [ragged_gradients.pad_rows(g, len(examples[i]["input_ids"])) for i, g in zip(bucket, batch_gradients)]
+                    return torch.stack([g.detach().flatten() for g in batch_gradients])
+
+            def process(bucket, batches=None):
+                profiler.start_batch()
+                if self.paradigm == "mlm": # bidirectional attention sees the padding, so keep the example as it is
+                    batch_gradients = []
+                    for i in bucket:
+                        with profiler.stage("collate"):
+                            batch = self.data_collator([{key: value for key, value in examples[i].items() if key in loss_gradients.MODEL_INPUT_KEYS}])
+                        batch_gradients += self.get_loss_gradients(model, batch, [len(examples[i]["input_ids"])], device)
+                    padded_tokens = sum(len(examples[i]["input_ids"]) for i in bucket)
+                else:
+                    with profiler.stage("collate"): # collated ahead: only the wait for the background thread
+                        batch = next(batches) if batches is not None else self.collate_examples([examples[i] for i in bucket])[0]
+                    batch_gradients = self.get_loss_gradients(model, batch, [lengths[i] for i in bucket], device)
+                    padded_tokens = len(bucket) * max(lengths[i] for i in bucket)
+
+                if args.mode == "store_mean":
+                    with profiler.stage("accumulate"):
+                        moments.update(flatten(bucket, batch_gradients)) # float32, no rounding to fp16 first
+                    profiler.end_batch(len(bucket), sum(lengths[i] for i in bucket), padded_tokens)
+                    progress.update(len(bucket))
+                    return
+
+                flat_gradients = None
+                projected = {} # by projector: nested outputs are prefixes of the same projection
+                for k in pending:
+                    # after a resume, an output may already have some of the rows
+                    positions = [j for j, i in enumerate(bucket) if i - i_start not in stored_rows[k]]
+                    if not positions:
+                        continue
+                    rows = [bucket[j] - i_start for j in positions]
+                    if outputs[k][1] is None and (args.ragged or capture is not None):
+                        if not shard_opened[k]:
+                            writers[k].open_ragged(shard_name, i_start, len(indices), hidden_size=batch_gradients[0].shape[-1], max_length=len(examples[bucket[0]]["input_ids"]))
+                            shard_opened[k] = True
+                        with profiler.stage("to_host"):
+                            gradients = [batch_gradients[j].detach().half().cpu() for j in positions]
+                        with profiler.stage("save"):
+                            writers[k].write(shard_name, rows, gradients)
+                        stored_rows[k].update(rows) # ragged rows are appended: a retry of the bucket must not write them again
+                        continue
+
+                    if flat_gradients is None and capture is None:
+                        flat_gradients = flatten(bucket, batch_gradients).half()
+                    projector, proj_dim = projectors[k]
+                    if id(projector) not in projected:
+                        with profiler.stage("projection"):
+                            if capture is not None:
+                                gradients = projector.project(batch_gradients).half() # on the factors
+                            else:
+                                gradients = project(projector, flat_gradients)
+                        with profiler.stage("to_host"):
+                            projected[id(projector)] = gradients.cpu()
+                    gradients = projected[id(projector)][positions, :proj_dim]
+                    if sums is not None:
+                        with profiler.stage("accumulate"):
+                            sums[k].add(shard_name, checkpoint_path, rows, gradients, num_rows=len(indices))
+                        stored_rows[k].update(rows)
+                        continue
+                    if not shard_opened[k]:
+                        self.open_dense_shard(writers[k], shard_name, i_start, len(indices), gradients)
+                        shard_opened[k] = True
+                    with profiler.stage("save"): # blocks while the writer's queue is full
+                        writers[k].write(shard_name, rows, gradients)
+                    stored_rows[k].update(rows)
+                profiler.end_batch(len(bucket), sum(lengths[i] for i in bucket), padded_tokens)
+                progress.update(len(bucket))
+
+            failed = []
+            buckets = get_length_buckets(remaining, lengths, self.batch_size, args.max_tokens_per_batch)
+            # the mlm collator masks depending on the order of the calls, so it stays in this thread
+            batches = _ReadAhead(self.iter_batches(examples, buckets, pin_memory=torch.device(device).type == "cuda"), args.prefetch_factor) if self.paradigm != "mlm" else None
+            try:
+                with tqdm(total=len(remaining), desc=f"{log_prefix} is getting gradients...") as progress:
+                    for bucket in buckets:
+                        try:
+                            process(bucket, batches)
+                        except RuntimeError as e:
+                            if not is_out_of_memory(e):
+                                raise
+                            self.record_failure(out_dir, checkpoint_path, bucket, e, low_memory=False)
+                            failed.extend(bucket)
+
+                    # smaller memory footprint: one example at a time, activations recomputed in the backward pass
+                    if failed:
+                        with self.low_memory_mode(model):
+                            for i in failed:
+                                try:
+                                    process([i])
+                                except RuntimeError as e:
+                                    if not is_out_of_memory(e):
+                                        raise
+                                    self.record_failure(out_dir, checkpoint_path, [i], e, low_memory=True)
+                                    self.failed_indices.append(i)
+            finally:
+                if batches is not None:
+                    batches.close()
+            del examples, batches
+
+            still_failed = [i for i in failed if i in self.failed_indices]
+
+            logging.debug(f"{log_prefix} ... got gradients")
+            profiler.end_chunk(checkpoint=os.path.basename(checkpoint_path), shard=shard_name, failed=len(still_failed), lean=args.lean, autocast=args.autocast, batch_size=self.batch_size)
+            if args.mode == "store":
+                if still_failed and sums is not None:
+                    for k in pending:
+                        sums[k].discard(shard_name)
+                    logging.error(f"{log_prefix} {len(still_failed)} gradients are missing (see {RETRY_FILE}), {checkpoint_path} is not added to the sum of {shard_name}, rerun the job")
+                    return
+                if still_failed:
+                    logging.error(f"{log_prefix} {shard_name} is unfinished, {len(still_failed)} gradients are missing (see {RETRY_FILE}), rerun with --resume")
+                    return
+                for k in pending:
+                    if sums is None:
+                        writers[k].finalize(shard_name)
+                        continue
+                    sums[k].commit(shard_name)
+                    if sums[k].complete(shard_name):
+                        store_sum(k)
+                logging.info(f"{log_prefix} queued gradients for {shard_name}")
+            else:
+                if still_failed: # a mean without them would be wrong
+                    raise RuntimeError(f"{log_prefix} gradients of {still_failed} failed (see {RETRY_FILE})")
+                logging.info(f"{log_prefix} added to the mean, {moments.count} gradients so far")
+            return
+        except:
+            # the journal of an opened shard is kept, so --resume continues where this stopped
+            print(f"Exception during {checkpoint_path}_{i_start}_{i_end}", traceback.format_exc(),flush=True)
+            raise
+
+    def load_model(self, checkpoint):
+        """Builds the model of a checkpoint, set up for the extraction (--lean, the captured --gradient_layers)."""
+        args, device = self.args, self.device
         logging.info(f"loading model {args.model}...")
 
+        attention = {"attn_implementation": args.attn_implementation} if args.attn_implementation else {}
         if "llama" in args.model:
-            model_config = AutoConfig.from_pretrained(checkpoint)
+            model_config = AutoConfig.from_pretrained(checkpoint, **attention)
             model = LlamaForCausalLM(config=model_config).to(device)
         elif "OLMo" in args.model:
-            model = AutoModelForCausalLM.from_pretrained(args.model, revision=checkpoint, torch_dtype=torch.float16).to(device)
+            model = AutoModelForCausalLM.from_pretrained(args.model, revision=checkpoint, torch_dtype=torch.float16, **attention).to(device)
         else:
-            model_config = AutoConfig.from_pretrained(checkpoint)
+            model_config = AutoConfig.from_pretrained(checkpoint, **attention)
             model = RobertaForMaskedLM(config=model_config).to(device)
-        model.train()
-        logging.info(f"... loading done")
-
-        
-        
-        projector = None
+        if args.lean:
+            # autograd keeps no activations for parameter gradients, and nothing of a block but its input
+            model.requires_grad_(False)
+            model.eval()
+            checkpoint_blocks(model)
+        else:
+            model.train()
+        logging.info(f"... loading done ({model.config._attn_implementation} attention{', lean' if args.lean else ''})")
+
+        if args.gradient_layers:
+            self.capture = FactorCapture(select_layers(model, args.gradient_layers))
+            logging.info(f"capturing the gradients of {len(self.capture.layers)} layer(s): {', '.join(self.capture.layers)}")
+        return model
+
+    def load_weights(self, model, checkpoint):
+        """Loads the weights of another revision of the (OLMo) model into `model`, in place, so everything set up around
+        it (checkpointed blocks, captured layers, projectors, the dataset) is kept."""
+        args = self.args
+        folder = snapshot_download(args.model, revision=checkpoint, allow_patterns=["*.safetensors"])
+        files = sorted(glob.glob(os.path.join(folder, "*.safetensors")))
+        if not files:
+            raise FileNotFoundError(f"no safetensors weights in revision {checkpoint} of {args.model}")
+        loaded = set()
+        for path in files:
+            weights = load_file(path) # on the CPU, one file at a time, and copied into the parameters
+            unexpected = model.load_state_dict(weights, strict=False).unexpected_keys
+            if unexpected:
+                raise ValueError(f"{path} holds weights the model does not have: {unexpected[:5]}")
+            loaded.update(weights)
+            del weights
+        tied = set(getattr(model, "_tied_weights_keys", None) or []) if model.config.tie_word_embeddings else set()
+        missing = set(model.state_dict()) - loaded - tied
+        if missing:
+            raise ValueError(f"revision {checkpoint} of {args.model} has no weights for {sorted(missing)[:5]}")
+
+    def load_checkpoint(self, checkpoint):
+        """Makes `model` the model of `checkpoint`. The dataset, projectors and writers stay, only the weights change."""
+        if "model" not in self.__dict__ or "OLMo" not in self.args.model:
+            self.__dict__.pop("model", None) # models other than OLMo are built from the checkpoint's config, there are no weights to swap
+            self.model = self.load_model(checkpoint)
+        elif self.loaded != checkpoint:
+            logging.info(f"loading the weights of {checkpoint}...")
+            self.load_weights(self.model, checkpoint)
+            logging.info(f"... loading done")
+        self.loaded = checkpoint
+        return self.model
+
+    def get_projectors(self, model):
+        """One (projector, output dimension) per output."""
+        args, capture = self.args, self.capture
+        projectors = []
         if args.random_projection and args.mode != "store_mean":
-            grad_dim = None
             logging.debug(f"inferring projection parameters ...")
-            grad_dim = get_loss_gradient(model, dataset[0], device).detach().flatten().unsqueeze(0).shape[-1]
+            grad_dim = self.grad_dim
             logging.debug(f"... using grad_dim={grad_dim} proj_dim={args.proj_dim} ...")
 
-            proj_type = ProjectionType[args.proj_type]
-
-            logging.info(f"Projection type: {proj_type}")
-
-            projector = CudaProjector(grad_dim=grad_dim, proj_dim=args.proj_dim,seed=42, proj_type=proj_type,device=device, max_batch_size=8)
-            logging.info(f"... set up projector done")
+            shared = {}
+            for _, proj_type, proj_dim in self.outputs:
+                if proj_type is None:
+                    logging.info(f"also storing full gradients")
+                    projectors.append((NoOpProjector(), None))
+                    continue
+                # nested: one projection per type to the largest dimension, the smaller ones are its prefixes
+                key = (proj_type, max(args.proj_dim) if args.nested_projections else proj_dim)
+                if key not in shared and capture is not None:
+                    logging.info(f"Projection type: {proj_type}, dimension: {proj_dim} per layer")
+                    shared[key] = FactoredProjector(capture.layout, proj_type, proj_dim, seed=42, device=self.device)
+                if key not in shared:
+                    logging.info(f"Projection type: {proj_type}, dimension: {key[1]}")
+                    shared[key] = get_projector(proj_type, grad_dim, key[1], seed=42, backend=args.projector_backend, device=self.device, max_batch_size=PROJECTOR_MAX_BATCH_SIZE)
+                projectors.append((shared[key], proj_dim * len(capture.layout) if capture is not None else proj_dim))
+            logging.info(f"... set up {len(shared)} projector(s) for {len(self.outputs)} output(s) done")
         else:
             logging.info(f"storing full gradients")
-            projector = NoOpProjector()
-       
-        
-        results = []
-        for i in range(0, len(dataset), args.gradients_per_file): 
-            start_time = time.time()
-
-            results.append(get_for_checkpoint(model, projector, checkpoint,i, i + args.gradients_per_file))   
-
-            if run is not None:
-                run.log({"gradients/time_per_chunk": time.time()-start_time},commit=False)
-                run.log({"gradients/time_per_example": (time.time()-start_time)/args.gradients_per_file},commit=False)
-        
-        if args.mode == "store_mean":
-            logging.info("aggregating mean gradients")
-            t = torch.stack(results).sum(axis=0) / len(dataset)
-            torch.save(t, os.path.join(out_path, "mean"))
-            logging.info(f"stored mean gradients")
+            projectors = [(NoOpProjector(), None)]
+        return projectors
+
+    def get_writers(self, out_paths, revision, extra_metadata=None):
+        """One AsyncShardWriter per output, with everything needed to tell where the gradients in the store come from."""
+        args, capture = self.args, self.capture
+        metadata = {
+            "model": args.model,
+            "model_revision": revision,
+            "dataset": args.dataset,
+            "dataset_split": args.dataset_split,
+            "dataset_fingerprint": self.dataset._fingerprint,
+            "dataset_num_rows": len(self.dataset),
+            "paradigm": self.paradigm,
+            # how the model was set up, for the stores' consumers to repeat it (influence_server.py)
+            "lean": args.lean,
+            "gradient_layers": args.gradient_layers,
+            **(extra_metadata or {}),
+        }
+        writers = []
+        for path, (_, proj_type, proj_dim) in zip(out_paths, self.outputs):
+            projection = None
+            if proj_type is not None:
+                projection = {"type": proj_type, "dim": proj_dim, "seed": 42, "backend": args.projector_backend}
+                if args.nested_projections: # the first proj_dim coordinates of this projection
+                    projection["prefix_of"] = max(args.proj_dim)
+                if capture is not None: # one block of proj_dim per layer, see FactoredProjector
+                    projection.update({"backend": "cpu", "layers": list(capture.layers)})
+            layer_metadata = {FACTORS_KEY: capture.layout} if capture is not None and proj_type is None else {}
+            writers.append(AsyncShardWriter(path, {**metadata, **layer_metadata, "projection": projection}, max_queue_size=args.writer_queue_size, manifest_file=worker_manifest_file(args.shard_index, args.num_shards)))
+        return writers
+
+    def run(self):
+        """Extracts the gradients of this worker's chunks for every selected checkpoint.
+
+        Raises:
+            RuntimeError: If gradients of some examples could not be computed (see the retry lists)
+        """
+        args = self.args
+        selected, checkpoint_weights = self.selected_checkpoints, self.checkpoint_weights
+
+        for output_dir in self.gradient_output_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # store_mean workers of a sharded extraction save partial moments, `merge_gradients.py` combines them
+        mean_file = "mean" if args.num_shards == 1 else worker_state_file(args.shard_index, args.num_shards)
+
+        # chunks are dealt out round robin, so every worker gets a similar share of the dataset
+        chunk_starts = list(range(0, len(self.dataset), args.gradients_per_file))[args.shard_index::args.num_shards]
+        logging.info(f"worker {args.shard_index + 1}/{args.num_shards}: {len(chunk_starts)} chunks of {len(selected)} checkpoint(s)")
+
+        sums = None
+        if args.tracin:
+            sums = []
+            for path in self.get_output_paths(None):
+                os.makedirs(path, exist_ok=True)
+                sums.append(CheckpointSum(path, selected, checkpoint_weights))
+
+        def get_chunks(checkpoint):
+            """The chunks of this worker that still need `checkpoint`."""
+            out_paths = self.get_output_paths(checkpoint)
+            if args.mode == "store_mean":
+                if os.path.isfile(os.path.join(out_paths[0], mean_file)):
+                    logging.info("Skipping {}, already calculated".format(out_paths[0]) )
+                    return []
+                return chunk_starts
+            if all(os.path.isdir(p) and len(os.listdir(p)) == 0 for p in out_paths) and args.skip_if_gradient_folder_exists:
+                logging.info("Skipping {}, because folder exists (--skip_if_gradient_folder_exists) and is empty".format(", ".join(out_paths)) )
+                return []
+
+            def needed(k, name):
+                if shard_exists(out_paths[k], name):
+                    return False
+                # a complete sum that is not stored yet is written by the next chunk that comes along
+                return sums is None or checkpoint not in sums[k].added(name) or sums[k].complete(name)
+
+            chunks = [i for i in chunk_starts if any(needed(k, f"{i}_{i + args.gradients_per_file}") for k in range(len(self.outputs)))]
+            if not chunks:
+                logging.info(f"Skipping {checkpoint}, all shards are stored")
+            return chunks
+
+        run = None
+        if os.getenv("WANDB_API_KEY") is not None:
+            run = wandb.init(project="gradient_extraction")
+            run.name = os.path.join(args.model, os.getenv("SLURM_JOB_NAME", "?"))
+
+        if args.profile or args.torch_profiler_steps:
+            # one profile for all checkpoints (records name their checkpoint), in the folder of the first one
+            profile_path = self.get_output_paths(selected[0])[0]
+            os.makedirs(profile_path, exist_ok=True)
+            profile_file = "profile.jsonl" if args.num_shards == 1 else f"profile.{args.shard_index}-of-{args.num_shards}.jsonl"
+            self.profiler = ExtractionProfiler(os.path.join(profile_path, profile_file), run=run, device=self.device, enabled=args.profile)
+            if args.torch_profiler_steps:
+                self.profiler.start_torch_profiler(os.path.join(profile_path, "torch_trace"), args.torch_profiler_steps, wait=args.torch_profiler_wait)
+
+        writers = None
+        try:
+            for checkpoint in selected:
+                chunks = get_chunks(checkpoint)
+                if not chunks:
+                    continue
+                out_paths = self.get_output_paths(checkpoint)
+                out_path = out_paths[0]
+                logging.info(f"writing results of {checkpoint} to {', '.join(out_paths)}")
+
+                self.load_checkpoint(checkpoint)
+
+                if args.mode == "store" and writers is None:
+                    tracin = {"tracin": {"checkpoints": selected, "weights": checkpoint_weights}} if args.tracin else None
+                    writers = self.get_writers(out_paths, selected if args.tracin else checkpoint, tracin)
+
+                moments = None
+                if args.mode == "store_mean":
+                    moments = GradientMoments(self.grad_dim, track_variance=args.track_variance, device=self.device)
+
+                # one stream for all chunks: the next chunk is transformed while the gradients of the current one are computed
+                # (set up after the projectors, which read an example in this thread)
+                projectors = self.projectors
+                rows = [i for start in chunks for i in range(start, min(start + args.gradients_per_file, len(self.dataset)))]
+                self.chunk_examples = _ChunkExamples(rows, self.prefetch(_Examples(self.dataset, rows)), args.gradients_per_file)
+                try:
+                    for i in chunks:
+                        start_time = time.time()
+
+                        self.get_for_checkpoint(self.model, projectors, checkpoint,i, i + args.gradients_per_file, writers=writers, moments=moments, sums=sums)
+
+                        if run is not None:
+                            run.log({"gradients/time_per_chunk": time.time()-start_time},commit=False)
+                            run.log({"gradients/time_per_example": (time.time()-start_time)/args.gradients_per_file},commit=False)
+                finally:
+                    self.chunk_examples.close()
+                    self.chunk_examples = None
+
+                if not args.tracin:
+                    for writer in writers or []:
+                        writer.close() # waits for the last shards (and their journals)
+                    writers = None
+
+                if args.mode == "store_mean":
+                    logging.info("saving mean gradients")
+                    if args.num_shards == 1:
+                        moments.save(out_path)
+                    else:
+                        torch.save(moments.state_dict(), os.path.join(out_path, mean_file))
+                    logging.info(f"stored mean gradients of {moments.count} examples")
+
+                if args.num_shards > 1 and not args.tracin:
+                    for path in out_paths:
+                        logging.info(f"run merge_gradients.py {path} --mode {args.mode} once all {args.num_shards} workers are done")
+        finally:
+            for writer in writers or []:
+                writer.close()
+            self.profiler.close()
+
+        if sums is not None:
+            # the sums of shards that are written now are no longer needed
+            for k, path in enumerate(self.get_output_paths(None)):
+                for name in sums[k].names():
+                    if shard_exists(path, name):
+                        sums[k].remove(name)
+            if args.num_shards > 1:
+                for path in self.get_output_paths(None):
+                    logging.info(f"run merge_gradients.py {path} --mode {args.mode} once all {args.num_shards} workers are done")
+
+        if self.failed_indices:
+            raise RuntimeError(f"gradients of {len(self.failed_indices)} examples are missing (see {RETRY_FILE} of the output folders), rerun with --resume")
 
         logging.info(f"task complete!")
         if run is not None:
-            run.finish()
\ No newline at end of file
+            run.finish()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    util.set_hf_token()
+    os.environ["TOKENIZERS_PARALLELISM"] = "True"
+
+    GradientExtractor(args).run()
+
+
+if __name__ == '__main__':
+    main()
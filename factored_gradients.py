@@ -0,0 +1,254 @@
+import math
+import logging
+import fnmatch
+import torch
+
+import ragged_gradients
+from projectors import get_projector
+
+FACTORS_KEY = "factors"
+LAST_BLOCKS_PREFIX = "last_blocks:"
+
+
+def get_blocks(model):
+    """Name and modules of the transformer blocks (e.g. `model.layers` of Llama and OLMo)."""
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == model.config.num_hidden_layers:
+            return name, module
+    raise ValueError(f"Cannot find the {model.config.num_hidden_layers} transformer blocks of {type(model).__name__}")
+
+
+def select_layers(model, patterns):
+    """The linear layers whose per-example gradients are captured, in the order of the model.
+
+    Args:
+        model: A transformers model
+        patterns: Module names or patterns (e.g. 'lm_head', 'model.layers.15.mlp.*'),
+            or 'last_blocks:N' for all linear layers of the last N transformer blocks
+
+    Returns:
+        A dict mapping module names to `torch.nn.Linear` modules
+    """
+    expanded = []
+    for pattern in patterns:
+        if pattern.startswith(LAST_BLOCKS_PREFIX):
+            name, blocks = get_blocks(model)
+            num_blocks = int(pattern[len(LAST_BLOCKS_PREFIX):])
+            expanded += [f"{name}.{i}.*" for i in range(len(blocks) - num_blocks, len(blocks))]
+        else:
+            expanded.append(pattern)
+    layers = {
+        name: module for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and any(fnmatch.fnmatchcase(name, pattern) for pattern in expanded)
+    }
+    if not layers:
+        raise ValueError(f"No linear layers of the model match {patterns}")
+    return layers
+
+
+def get_layout(layers):
+    """Columns of a factor row: per layer, its input (plus a constant 1 for the bias) and its output gradient."""
+    return [
+        {"name": name, "in": module.in_features + (module.bias is not None), "out": module.out_features}
+        for name, module in layers.items()
+    ]
+
+
+def grad_dim(layout):
+    """Dimension of the equivalent dense (flattened, weight-shaped) gradient."""
+    return sum(layer["in"] * layer["out"] for layer in layout)
+
+
+def split_factors(rows, layout):
+    """Splits factor rows into one (activations, output gradients) pair per layer."""
+    factors, offset = [], 0
+    for layer in layout:
+        factors.append((rows[..., offset:offset + layer["in"]], rows[..., offset + layer["in"]:offset + layer["in"] + layer["out"]]))
+        offset += layer["in"] + layer["out"]
+    return factors
+
+
+class FactorCapture:
+    """Per-example gradients of linear layers in factored form.
+
+    The gradient of a linear layer's weight is a sum of outer products over tokens, G^T A, with A the layer's
+    inputs and G the gradients irt its outputs ([tokens, in] and [tokens, out]). Forward hooks record A and the
+    outputs, `factors` gets all G in one `autograd.grad` call (which stops at the earliest captured layer) and
+    returns the rows [a_t, g_t] of every token instead of the [out, in] gradient, i.e. tokens x (in + out) numbers
+    instead of in x out. Biases are covered by a constant 1 appended to the inputs.
+
+    Example:
+        capture = FactorCapture(select_layers(model, ["lm_head"]))
+        with capture:
+            losses = ...
+        rows = capture.factors(losses.sum(), lengths)
+    """
+
+    def __init__(self, layers):
+        """
+        Args:
+            layers: A dict mapping names to `torch.nn.Linear` modules (see `select_layers`)
+        """
+        self.layers = layers
+        self.layout = get_layout(layers)
+        self.records = {}
+        self.handles = []
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            # gradient checkpointing runs the forward pass again during the backward pass: keep the first one
+            if name not in self.records:
+                self.records[name] = (inputs[0].detach(), output)
+        return hook
+
+    def __enter__(self):
+        self.records = {}
+        self.handles = [module.register_forward_hook(self._hook(name)) for name, module in self.layers.items()]
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def factors(self, loss, lengths):
+        """Per-example factor rows of the gradient of `loss`.
+
+        Args:
+            loss: The sum of the per-example losses of the recorded forward pass
+            lengths: The real length of every example (padding is expected on the right)
+
+        Returns:
+            A list of 2D tensors (one per example): [length, width] factor rows (see `split_factors`)
+        """
+        missing = [name for name in self.layers if name not in self.records]
+        if missing:
+            raise RuntimeError(f"Layers {missing} were not called in the forward pass")
+        inputs, outputs = zip(*(self.records.pop(name) for name in self.layers))
+        output_gradients = torch.autograd.grad(loss, outputs, retain_graph=False)
+        columns = []
+        for (name, module), a, g in zip(self.layers.items(), inputs, output_gradients):
+            if module.bias is not None:
+                a = torch.cat([a, a.new_ones(*a.shape[:-1], 1)], dim=-1)
+            columns += [a, g.to(a.dtype)]
+        rows = torch.cat(columns, dim=-1)
+        return [r[:length] for r, length in zip(rows, lengths)]
+
+
+def is_factored(gradients):
+    return ragged_gradients.is_ragged(gradients) and FACTORS_KEY in gradients
+
+
+def num_examples(factored):
+    return ragged_gradients.num_examples(factored)
+
+
+def norms(factored):
+    """L2 norm of every example's (weight-shaped) gradient: |G^T A|^2 = sum((G G^T) * (A A^T)), in float32."""
+    starts, lengths = ragged_gradients.starts_and_lengths(factored)
+    squared = torch.zeros(len(lengths))
+    for i, (start, length) in enumerate(zip(starts.tolist(), lengths.tolist())):
+        rows = factored[ragged_gradients.VALUES_KEY][start:start + length].float()
+        for a, g in split_factors(rows, factored[FACTORS_KEY]):
+            squared[i] += ((a @ a.T) * (g @ g.T)).sum()
+    return squared.sqrt()
+
+
+def dot(train, test, max_block_size=2**24):
+    """Dot products between all train and test gradients without materialising them.
+
+    <G^T A, H^T B> = sum over token pairs (s, t) of (a_s . b_t)(g_s . h_t), so every layer costs a
+    [train tokens, test tokens] kernel of its inputs and one of its output gradients.
+
+    Args:
+        train: A factored gradient dict (N examples)
+        test: A factored gradient dict (M examples)
+        max_block_size: Number of token pairs per kernel block (bounds the memory)
+
+    Returns:
+        A [N, M] float32 tensor of scores
+    """
+    if train[FACTORS_KEY] != test[FACTORS_KEY]:
+        raise ValueError("Train and test gradients are factors of different layers.")
+    train_ids, train_rows, _ = ragged_gradients.row_index(train)
+    test_ids, test_rows, _ = ragged_gradients.row_index(test)
+    test_factors = split_factors(test[ragged_gradients.VALUES_KEY][test_rows].float(), test[FACTORS_KEY])
+
+    scores = torch.zeros(num_examples(train), num_examples(test))
+    step = max(1, max_block_size // max(1, len(test_rows)))
+    for start in range(0, len(train_rows), step):
+        rows = train[ragged_gradients.VALUES_KEY][train_rows[start:start + step]].float()
+        kernel = sum(
+            (a @ b.T) * (g @ h.T)
+            for (a, g), (b, h) in zip(split_factors(rows, train[FACTORS_KEY]), test_factors)
+        )
+        block = torch.zeros(len(scores), len(test_rows)).index_add_(0, train_ids[start:start + step], kernel)
+        scores.index_add_(1, test_ids, block)
+    return scores
+
+
+def factor_dims(proj_dim):
+    """The (k_out, k_in) of a factored projection to `proj_dim`: the factor pair closest to a square, k_out >= k_in."""
+    k_in = next(k for k in range(math.isqrt(proj_dim), 0, -1) if proj_dim % k == 0)
+    return proj_dim // k_in, k_in
+
+
+def cosine(train, test, eps=1e-12):
+    """Cosine similarities between all train and test gradients (same clamping as `F.normalize`)."""
+    return dot(train, test) / (norms(train).clamp_min(eps)[:, None] * norms(test).clamp_min(eps)[None, :])
+
+
+class FactoredProjector:
+    """Projects factored gradients with a Kronecker-structured random matrix, one block per layer.
+
+    Layer l's gradient G^T A is projected to (G P)^T (A Q), i.e. (P ⊗ Q)^T vec(G^T A), with P and Q random
+    [out, k_out] and [in, k_in] matrices of `proj_type` and k_out x k_in = proj_dim (see `factor_dims`, k_out = k_in
+    for a square proj_dim): the cost is tokens x (in x k_in + out x k_out) instead of in x out x proj_dim. As for the
+    dense projections, E[|Px|^2] = proj_dim |x|^2.
+
+    P and Q are the matrices of the CPU projectors (`get_projector`, seed `seed + 1e4 * model_id` with one model id
+    per factor), materialised once, so projections are the same whatever the device.
+    """
+
+    MATRIX_BLOCK_ROWS = 2**8
+
+    def __init__(self, layout, proj_type, proj_dim, seed, device="cpu"):
+        self.k_out, self.k_in = factor_dims(proj_dim)
+        if self.k_in == 1 and proj_dim > 1:
+            logging.warning(f"proj_dim {proj_dim} is prime: the layer inputs are projected to a single dimension, pick a proj_dim with a factor pair close to a square")
+        self.layout = layout
+        self.proj_dim = proj_dim
+        self.device = device
+        self.matrices = []
+        for l, layer in enumerate(layout):
+            self.matrices.append(tuple(
+                self._get_matrix(proj_type, dim, k, seed, model_id=2 * l + side).to(device)
+                for side, (dim, k) in enumerate([(layer["in"], self.k_in), (layer["out"], self.k_out)])
+            ))
+
+    def _get_matrix(self, proj_type, dim, k, seed, model_id):
+        # every projection here is linear, so its matrix is the projection of the identity
+        projector = get_projector(proj_type, dim, k, seed=seed, backend="cpu", device="cpu")
+        blocks = []
+        for start in range(0, dim, self.MATRIX_BLOCK_ROWS):
+            rows = torch.arange(start, min(start + self.MATRIX_BLOCK_ROWS, dim))
+            identity = torch.zeros(len(rows), dim)
+            identity[torch.arange(len(rows)), rows] = 1.0
+            blocks.append(projector.project(identity, model_id=model_id).float())
+        return torch.cat(blocks)
+
+    def project(self, gradients):
+        """
+        Args:
+            gradients: A list of [length, width] factor rows (see `FactorCapture.factors`)
+
+        Returns:
+            A [len(gradients), num_layers * proj_dim] float32 tensor on the projector's device
+        """
+        lengths = [len(g) for g in gradients]
+        rows = torch.cat(gradients).to(self.device, torch.float32)
+        projected = torch.empty(len(gradients), len(self.layout), self.proj_dim, device=self.device)
+        for l, ((a, g), (q, p)) in enumerate(zip(split_factors(rows, self.layout), self.matrices)):
+            for i, (a_i, g_i) in enumerate(zip((a @ q).split(lengths), (g @ p).split(lengths))):
+                projected[i, l] = (g_i.T @ a_i).flatten()
+        return projected.flatten(1)
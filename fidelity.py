@@ -0,0 +1,276 @@
+import os
+import re
+import csv
+import glob
+import json
+import hashlib
+import logging
+import argparse
+import numpy as np
+import torch
+
+METRICS = ["kendall", "spearman", "ndcg", "ndcg_at_k", "top_k_overlap"]
+
+# train samples whose (cosine) scores are NaN in the OLMo runs, see Data_sets_sample_and_analysis.ipynb
+KNOWN_NAN_IDS = ["open_orca_t0.1598436"]
+
+
+class ScoreRun:
+    """The [N_train, N_test] score matrix of one explain.py run, with the train ids (if known) and a key that
+    identifies the run (its run manifest, or the files it was read from)."""
+
+    def __init__(self, scores, train_ids=None, key=None, name=None):
+        self.scores = scores
+        self.train_ids = train_ids
+        self.key = key
+        self.name = name
+
+    @classmethod
+    def load(cls, path):
+        """Reads the scores of one method written by explain.py.
+
+        Args:
+            path: A `<dataset>_scores.npy` or `<dataset>_scores.parquet` file, or an output folder
+                (e.g. ./explainability/16384/OLMO/rademacher/cosine) with one of them or with per-test JSON files
+        """
+        if os.path.isdir(path):
+            candidates = sorted(glob.glob(os.path.join(path, "*_scores.npy"))) or sorted(glob.glob(os.path.join(path, "*_scores.parquet")))
+            if candidates:
+                return cls.load(candidates[0])
+            return cls._load_json(path)
+        if path.endswith(".npy"):
+            scores = np.load(path)
+            ids_path = path[:-len(".npy")] + "_train_ids.npy"
+            train_ids = np.load(ids_path) if os.path.isfile(ids_path) else None
+        elif path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            table = pq.read_table(path).to_pandas()
+            if "rank" in table.columns:
+                raise ValueError(f"{path} only holds the top-k scores, fidelity needs all scores")
+            num_train, num_test = table["train_index"].max() + 1, table["test_index"].max() + 1
+            scores = np.full((num_train, num_test), np.nan, dtype=np.float32)
+            scores[table["train_index"].to_numpy(), table["test_index"].to_numpy()] = table["score"].to_numpy()
+            train_ids = table.drop_duplicates("train_index").sort_values("train_index")["train_id"].to_numpy()
+        else:
+            raise ValueError(f"Unknown score file {path}")
+        return cls(torch.from_numpy(scores), train_ids, key=_run_key(os.path.dirname(path), [path]), name=path)
+
+    @classmethod
+    def _load_json(cls, folder):
+        """Per-test JSON files (older runs): sorted and with ids if written with --mapped yes."""
+        files = {}
+        for path in glob.glob(os.path.join(folder, "*.json")):
+            match = re.fullmatch(r".*_test_(\d+)\.json", os.path.basename(path))
+            if match:
+                files[int(match.group(1))] = path
+        if not files:
+            raise FileNotFoundError(f"No scores in {folder}")
+
+        columns, train_ids = [], None
+        for idx in sorted(files):
+            with open(files[idx], encoding="utf-8") as f:
+                items = json.load(f)
+            if items and "index" in items[0]:
+                raise ValueError(f"{folder} only holds the top-k scores, fidelity needs all scores")
+            if items and "id" in items[0]:
+                if train_ids is None:
+                    train_ids = np.array([item["id"] for item in items])
+                    positions = {id_: i for i, id_ in enumerate(train_ids)}
+                column = np.empty(len(items), dtype=np.float32)
+                column[[positions[item["id"]] for item in items]] = [item["score"] for item in items]
+            else:
+                column = np.array([item["score"] for item in items], dtype=np.float32)
+            columns.append(column)
+        return cls(torch.from_numpy(np.stack(columns, axis=1)), train_ids, key=_run_key(folder, sorted(files.values())), name=folder)
+
+
+def _run_key(folder, files):
+    """The run manifest written by explain.py if there is one, plus the size and modification time of the files."""
+    manifests = sorted(glob.glob(os.path.join(folder, "*_run.json")))
+    manifest = None
+    if manifests:
+        with open(manifests[0], encoding="utf-8") as f:
+            manifest = json.load(f)
+    stats = [(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in files]
+    return hashlib.sha256(json.dumps([manifest, stats], sort_keys=True).encode()).hexdigest()
+
+
+def _align(reference, run, exclude_ids=(), exclude_nan=True):
+    """Brings the rows of both runs into the same (train id) order and drops excluded rows."""
+    scores_a, scores_b = reference.scores, run.scores
+    ids = reference.train_ids
+    if reference.train_ids is not None and run.train_ids is not None:
+        order = np.argsort(run.train_ids, kind="stable")
+        positions = order[np.clip(np.searchsorted(run.train_ids[order], ids), 0, len(order) - 1)]
+        if not np.array_equal(run.train_ids[positions], ids):
+            raise ValueError(f"{run.name} does not have the same train samples as {reference.name}")
+        scores_b = scores_b[torch.from_numpy(positions)]
+    elif scores_a.shape[0] != scores_b.shape[0]:
+        raise ValueError(f"{run.name} does not have the same number of train samples as {reference.name}")
+    if scores_a.shape[1] != scores_b.shape[1]:
+        raise ValueError(f"{run.name} does not have the same number of test samples as {reference.name}")
+
+    keep = torch.ones(len(scores_a), dtype=torch.bool)
+    if len(exclude_ids) > 0:
+        if ids is None:
+            ids = run.train_ids
+        if ids is None:
+            raise ValueError("Samples can only be excluded by id if the scores come with train ids")
+        keep &= torch.from_numpy(~np.isin(ids, list(exclude_ids)))
+    if exclude_nan:
+        keep &= ~(scores_a.isnan().any(dim=1) | scores_b.isnan().any(dim=1))
+    return scores_a[keep], scores_b[keep]
+
+
+def ranks(scores):
+    """Rank (0 = highest score) of every train sample in every column. Ties keep the train order, like the
+    sorted JSON output of explain.py."""
+    order = torch.argsort(scores, dim=0, descending=True, stable=True)
+    result = torch.empty_like(order)
+    result.scatter_(0, order, torch.arange(len(scores), device=scores.device)[:, None].expand_as(order))
+    return result
+
+
+def _count_inversions(x):
+    """Number of inversions of every row of a [M, n] tensor of permutations of 0, ..., n-1.
+
+    A bottom-up merge sort for all rows at once: at every level, the elements of each right run that are smaller
+    than elements of the left run next to it are counted with one `searchsorted` (runs are shifted by offsets,
+    so all left runs form one sorted sequence). O(n log^2 n) per row.
+    """
+    num_rows, n = x.shape
+    size = 1 << max(0, (n - 1).bit_length())
+    # larger, increasing padding adds no inversions
+    x = torch.cat([x, torch.arange(n, size, device=x.device).expand(num_rows, -1)], dim=1)
+    inversions = torch.zeros(num_rows, dtype=torch.long, device=x.device)
+    run = 1
+    while run < size:
+        num_pairs = size // (2 * run)
+        pairs = x.view(num_rows, num_pairs, 2, run)
+        offsets = torch.arange(num_rows * num_pairs, device=x.device).view(num_rows, num_pairs, 1) * size
+        left = (pairs[:, :, 0] + offsets).flatten()
+        right = (pairs[:, :, 1] + offsets).flatten()
+        not_greater = torch.searchsorted(left, right, right=True).view(num_rows, num_pairs, run) - offsets // size * run
+        inversions += (run - not_greater).sum(dim=(1, 2))
+        x = torch.sort(pairs.reshape(num_rows, num_pairs, 2 * run), dim=-1).values.view(num_rows, size)
+        run *= 2
+    return inversions
+
+
+def kendall_tau(ranks_a, ranks_b):
+    """Kendall's tau of every column (ranks are permutations, so tau-a = tau-b)."""
+    n = ranks_a.shape[0]
+    # ranks of b in the order of a: every inversion is a discordant pair
+    in_order_of_a = torch.gather(ranks_b, 0, torch.argsort(ranks_a, dim=0)).T.contiguous()
+    discordant = _count_inversions(in_order_of_a).double()
+    return 1 - 4 * discordant / (n * (n - 1))
+
+
+def spearman_rho(ranks_a, ranks_b):
+    """Spearman's rho of every column."""
+    n = ranks_a.shape[0]
+    d = (ranks_a - ranks_b).double()
+    return 1 - 6 * (d ** 2).sum(dim=0) / (n * (n ** 2 - 1))
+
+
+def ndcg(ranks_a, ranks_b, k=None):
+    """NDCG(@k) of every column, with relevance 1 / (rank in a + 1) and the order of b
+    (as `sklearn.metrics.ndcg_score([1 / (ranks_a + 1)], [1 / (ranks_b + 1)], k=k)`)."""
+    n = ranks_a.shape[0]
+    k = n if k is None else min(k, n)
+    relevance = 1 / (ranks_a.double() + 1)
+    discount = 1 / torch.log2(ranks_b.double() + 2)
+    dcg = (relevance * discount * (ranks_b < k)).sum(dim=0)
+    positions = torch.arange(k, dtype=torch.float64, device=ranks_a.device)
+    ideal = (1 / (positions + 1) / torch.log2(positions + 2)).sum()
+    return dcg / ideal
+
+
+def top_k_overlap(ranks_a, ranks_b, k):
+    """Fraction of the top-k train samples of a that are also in the top-k of b, for every column."""
+    k = min(k, ranks_a.shape[0])
+    return ((ranks_a < k) & (ranks_b < k)).sum(dim=0).double() / k
+
+
+def compare(reference, run, metrics=METRICS, k=100, exclude_ids=(), exclude_nan=True, device="cpu"):
+    """Rank agreement between two runs, for every test sample at once.
+
+    Args:
+        reference: A ScoreRun, e.g. of full gradients
+        run: A ScoreRun, e.g. of projected gradients
+        metrics: A subset of METRICS
+        k: The k of 'ndcg_at_k' and 'top_k_overlap'
+        exclude_ids: Train sample ids to leave out (e.g. KNOWN_NAN_IDS)
+        exclude_nan: Whether to leave out train samples with a NaN score in either run
+
+    Returns:
+        A dict mapping each metric to a numpy array with one value per test sample
+    """
+    scores_a, scores_b = _align(reference, run, exclude_ids=exclude_ids, exclude_nan=exclude_nan)
+    ranks_a, ranks_b = ranks(scores_a.to(device)), ranks(scores_b.to(device))
+    results = {}
+    for metric in metrics:
+        if metric == "kendall":
+            values = kendall_tau(ranks_a, ranks_b)
+        elif metric == "spearman":
+            values = spearman_rho(ranks_a, ranks_b)
+        elif metric == "ndcg":
+            values = ndcg(ranks_a, ranks_b)
+        elif metric == "ndcg_at_k":
+            values = ndcg(ranks_a, ranks_b, k=k)
+        elif metric == "top_k_overlap":
+            values = top_k_overlap(ranks_a, ranks_b, k=k)
+        else:
+            raise KeyError(f"Metric {metric} not recognized.")
+        results[metric] = values.cpu().numpy()
+    return results
+
+
+def compare_cached(reference, run, cache_dir, metrics=METRICS, k=100, exclude_ids=(), exclude_nan=True, device="cpu"):
+    """`compare`, with the results kept in `cache_dir` under a key of both runs (see ScoreRun) and the options."""
+    key = hashlib.sha256(json.dumps([reference.key, run.key, sorted(metrics), k, sorted(exclude_ids), exclude_nan]).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.isfile(path):
+        with np.load(path) as cached:
+            return {metric: cached[metric] for metric in metrics}
+    results = compare(reference, run, metrics=metrics, k=k, exclude_ids=exclude_ids, exclude_nan=exclude_nan, device=device)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path + ".tmp.npz", **results)
+    os.replace(path + ".tmp.npz", path)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser("fidelity")
+    parser.add_argument("reference", help="Scores of the reference run (e.g. full gradients): an explain.py output folder or score file")
+    parser.add_argument("runs", help="Scores of the runs to compare with the reference (e.g. projections)", nargs="+")
+    parser.add_argument("--metrics", nargs="+", choices=METRICS, default=METRICS)
+    parser.add_argument("--k", help="k of 'ndcg_at_k' and 'top_k_overlap'", type=int, default=100)
+    parser.add_argument("--exclude_ids", help="Train sample ids to leave out (default: the known NaN sample)", nargs="*", default=KNOWN_NAN_IDS)
+    parser.add_argument("--keep_nan", help="Keep train samples with NaN scores", default=False, action="store_true")
+    parser.add_argument("--cache_dir", help="Where to cache results. Set to '' to disable", default="./fidelity_cache")
+    parser.add_argument("--device", help="Where to rank (e.g., cuda:0 or cpu)", default="cpu")
+    parser.add_argument("--output", help="CSV file for the value of every run, metric and test sample", default=None)
+    args = parser.parse_args()
+
+    reference = ScoreRun.load(args.reference)
+    rows = []
+    for path in args.runs:
+        run = ScoreRun.load(path)
+        options = dict(metrics=args.metrics, k=args.k, exclude_ids=args.exclude_ids, exclude_nan=not args.keep_nan, device=args.device)
+        results = compare_cached(reference, run, args.cache_dir, **options) if args.cache_dir else compare(reference, run, **options)
+        for metric in args.metrics:
+            values = results[metric]
+            print(f"{path}\t{metric}\tmean={np.nanmean(values):.4f}\tstd={np.nanstd(values):.4f}")
+            rows.extend((path, metric, idx, value) for idx, value in enumerate(values.tolist()))
+
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["run", "metric", "test_index", "value"])
+            writer.writerows(rows)
+        logging.info(f"stored results to {args.output}")
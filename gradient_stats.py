@@ -0,0 +1,266 @@
+import os
+import re
+import glob
+import json
+import math
+import shutil
+import numpy as np
+import torch
+
+
+class GradientMoments:
+    """Running mean (and optionally variance) of gradients, updated one mini-batch at a time.
+
+    Batches are combined with the parallel form of Welford's algorithm (Chan et al.): the float32 mean is moved
+    towards every batch mean instead of summing all gradients, so nothing grows with the number of examples (no
+    fp16 overflow, no loss of precision of a huge sum) and memory stays at one or two `dim`-sized vectors.
+
+    The count and the mean, minimum and maximum of the gradient norms are tracked as well.
+    """
+
+    def __init__(self, dim, track_variance=False, device="cpu"):
+        """
+        Args:
+            dim: Dimension of the (flattened) gradients
+            track_variance: Whether to also accumulate the per-coordinate variance (one more `dim`-sized vector)
+            device: Where to accumulate, ideally where the gradients are computed
+        """
+        self.dim = dim
+        self.count = 0
+        self.mean = torch.zeros(dim, dtype=torch.float32, device=device)
+        self.m2 = torch.zeros(dim, dtype=torch.float32, device=device) if track_variance else None
+        # norms are scalars: python floats (double precision) are enough
+        self.norm_mean = 0.0
+        self.norm_m2 = 0.0
+        self.norm_min = math.inf
+        self.norm_max = 0.0
+
+    def update(self, gradients):
+        """Adds a (batch x dim) tensor of gradients."""
+        gradients = gradients.to(self.mean.device, torch.float32).reshape(-1, self.dim)
+        n = len(gradients)
+        if n == 0:
+            return
+        total = self.count + n
+
+        batch_mean = gradients.mean(dim=0)
+        delta = batch_mean - self.mean
+        self.mean += delta * (n / total)
+        if self.m2 is not None:
+            self.m2 += ((gradients - batch_mean) ** 2).sum(dim=0) + delta ** 2 * (self.count * n / total)
+
+        for norm in torch.linalg.vector_norm(gradients, dim=-1).tolist():
+            self.count += 1
+            norm_delta = norm - self.norm_mean
+            self.norm_mean += norm_delta / self.count
+            self.norm_m2 += norm_delta * (norm - self.norm_mean)
+            self.norm_min = min(self.norm_min, norm)
+            self.norm_max = max(self.norm_max, norm)
+
+    def merge(self, other):
+        """Combines the moments of another (disjoint) set of gradients into these."""
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean.to(self.mean.device) - self.mean
+        if self.m2 is not None:
+            if other.m2 is None:
+                raise ValueError("Cannot merge moments without variance into moments with variance")
+            self.m2 += other.m2.to(self.mean.device) + delta ** 2 * (self.count * other.count / total)
+        self.mean += delta * (other.count / total)
+
+        norm_delta = other.norm_mean - self.norm_mean
+        self.norm_m2 += other.norm_m2 + norm_delta ** 2 * self.count * other.count / total
+        self.norm_mean += norm_delta * other.count / total
+        self.norm_min = min(self.norm_min, other.norm_min)
+        self.norm_max = max(self.norm_max, other.norm_max)
+        self.count = total
+
+    @property
+    def variance(self):
+        """Per-coordinate (population) variance, if tracked."""
+        if self.m2 is None:
+            return None
+        return self.m2 / max(self.count, 1)
+
+    def stats(self):
+        """Summary statistics (JSON serialisable)."""
+        return {
+            "count": self.count,
+            "dim": self.dim,
+            "mean_norm": float(torch.linalg.vector_norm(self.mean)),
+            "norm": {
+                "mean": self.norm_mean,
+                "std": math.sqrt(self.norm_m2 / self.count) if self.count else 0.0,
+                "min": self.norm_min if self.count else 0.0,
+                "max": self.norm_max,
+            },
+        }
+
+    def state_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean.cpu(),
+            "m2": self.m2.cpu() if self.m2 is not None else None,
+            "norm_mean": self.norm_mean,
+            "norm_m2": self.norm_m2,
+            "norm_min": self.norm_min,
+            "norm_max": self.norm_max,
+        }
+
+    @classmethod
+    def from_state_dict(cls, state, device="cpu"):
+        moments = cls(len(state["mean"]), track_variance=state["m2"] is not None, device=device)
+        moments.count = state["count"]
+        moments.mean.copy_(state["mean"])
+        if state["m2"] is not None:
+            moments.m2.copy_(state["m2"])
+        moments.norm_mean, moments.norm_m2 = state["norm_mean"], state["norm_m2"]
+        moments.norm_min, moments.norm_max = state["norm_min"], state["norm_max"]
+        return moments
+
+    def save(self, directory):
+        """Writes `mean` (a (1 x dim) float32 tensor, like the summed mean of earlier versions),
+        `variance` (if tracked), `mean_stats.json` and the full state `mean_state.pt` (see `merge`)."""
+        torch.save(self.mean.cpu().unsqueeze(0), f"{directory}/mean")
+        if self.m2 is not None:
+            torch.save(self.variance.cpu().unsqueeze(0), f"{directory}/variance")
+        torch.save(self.state_dict(), f"{directory}/mean_state.pt")
+        with open(f"{directory}/mean_stats.json", "w", encoding="utf-8") as f:
+            json.dump(self.stats(), f, indent=2)
+
+
+class CheckpointSum:
+    """Weighted sums over checkpoints of per-example gradients (TracIn: sum_t w_t g_t(z), with w_t e.g. the
+    learning rate at checkpoint t), built one checkpoint at a time.
+
+    The float32 sum of a shard is kept in the output folder (`<shard>.sum-<n>.npy` after n checkpoints) and
+    `<shard>.sum.json` lists the checkpoints it holds. A checkpoint is added to a new copy, which only becomes the
+    sum once all its rows are in, so a job that is killed never adds a checkpoint twice or halfway.
+    """
+
+    def __init__(self, directory, checkpoints, weights):
+        """
+        Args:
+            directory: The output folder of the store the sums end up in
+            checkpoints: Names of all checkpoints of the sum
+            weights: Weight of every checkpoint
+        """
+        self.directory = directory
+        self.weights = dict(zip(checkpoints, weights))
+        self.open = {} # shard name -> (checkpoint, sum file, memmap) being added
+
+    def _state_path(self, name):
+        return os.path.join(self.directory, f"{name}.sum.json")
+
+    def _state(self, name):
+        if not os.path.isfile(self._state_path(name)):
+            return {"checkpoints": [], "file": None}
+        with open(self._state_path(name), encoding="utf-8") as f:
+            state = json.load(f)
+        for checkpoint, weight in state["checkpoints"]:
+            if self.weights.get(checkpoint) != weight:
+                raise ValueError(f"The sum of {name} in {self.directory} holds {checkpoint} with weight {weight}, which is not part of this sum")
+        return state
+
+    def added(self, name):
+        """Checkpoints the sum of shard `name` already holds."""
+        return [checkpoint for checkpoint, _ in self._state(name)["checkpoints"]]
+
+    def complete(self, name):
+        return set(self.added(name)) == set(self.weights)
+
+    def names(self):
+        """Shards with a (partial) sum."""
+        return [path[:-len(".sum.json")] for path in os.listdir(self.directory) if path.endswith(".sum.json")]
+
+    def add(self, name, checkpoint, rows, gradients, num_rows):
+        """Adds the gradients of `checkpoint` (times its weight) to rows `rows` of shard `name` ([num_rows, dim])."""
+        if name not in self.open:
+            state = self._state(name)
+            path = os.path.join(self.directory, f"{name}.sum-{len(state['checkpoints']) + 1}.npy")
+            if state["file"] is None:
+                array = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_rows, gradients.shape[-1]))
+            else:
+                shutil.copyfile(os.path.join(self.directory, state["file"]), path)
+                array = np.lib.format.open_memmap(path, mode="r+")
+            self.open[name] = (checkpoint, path, array)
+        array = self.open[name][2]
+        array[rows] += gradients.float().numpy() * self.weights[checkpoint]
+
+    def commit(self, name):
+        """Makes the checkpoint being added to shard `name` part of its sum."""
+        checkpoint, path, array = self.open.pop(name)
+        array.flush()
+        del array
+        state = self._state(name)
+        previous = state["file"]
+        state = {"checkpoints": state["checkpoints"] + [[checkpoint, self.weights[checkpoint]]], "file": os.path.basename(path)}
+        with open(self._state_path(name) + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self._state_path(name) + ".tmp", self._state_path(name)) # atomic
+        if previous is not None:
+            os.remove(os.path.join(self.directory, previous))
+
+    def discard(self, name):
+        """Drops the partly added checkpoint of shard `name`."""
+        _, path, array = self.open.pop(name)
+        del array
+        os.remove(path)
+
+    def load(self, name):
+        """The sum of shard `name` as a float32 tensor."""
+        return torch.from_numpy(np.load(os.path.join(self.directory, self._state(name)["file"])))
+
+    def remove(self, name):
+        state = self._state(name)
+        os.remove(self._state_path(name))
+        if state["file"] is not None:
+            os.remove(os.path.join(self.directory, state["file"]))
+
+
+WORKER_STATE_PATTERN = re.compile(r"mean_state\.(\d+)-of-(\d+)\.pt")
+
+
+def worker_state_file(shard_index, num_shards):
+    """The file a worker of a sharded 'store_mean' extraction saves its moments to (see `merge_worker_moments`)."""
+    return f"mean_state.{shard_index}-of-{num_shards}.pt"
+
+
+def merge_worker_moments(directory, num_rows=None):
+    """Merges the moments saved by all workers of a sharded 'store_mean' extraction and saves the result
+    (see `GradientMoments.save`).
+
+    Args:
+        directory: The output folder of the checkpoint
+        num_rows: Expected number of gradients (checked if given)
+
+    Returns:
+        The merged GradientMoments
+    """
+    states = {}
+    for path in glob.glob(os.path.join(directory, "mean_state.*-of-*.pt")):
+        match = WORKER_STATE_PATTERN.fullmatch(os.path.basename(path))
+        if match:
+            states[(int(match.group(1)), int(match.group(2)))] = path
+    if not states:
+        raise FileNotFoundError(f"No worker means in {directory}")
+    num_shards = {n for _, n in states}
+    if len(num_shards) != 1:
+        raise ValueError(f"Worker means of different runs (--num_shards {sorted(num_shards)}) in {directory}")
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - {k for k, _ in states})
+    if missing:
+        raise ValueError(f"Means of workers {missing} (of {num_shards}) are missing in {directory}")
+
+    moments = None
+    for key in sorted(states):
+        worker_moments = GradientMoments.from_state_dict(torch.load(states[key]))
+        if moments is None:
+            moments = worker_moments
+        else:
+            moments.merge(worker_moments)
+    if num_rows is not None and moments.count != num_rows:
+        raise ValueError(f"The workers' means cover {moments.count} instead of {num_rows} gradients")
+    moments.save(directory)
+    return moments
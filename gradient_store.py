@@ -0,0 +1,579 @@
+import os
+import re
+import glob
+import json
+import queue
+import logging
+import threading
+import numpy as np
+import torch
+
+import ragged_gradients
+import factored_gradients
+import quantization
+
+MANIFEST_FILE = "manifest.json"
+WORKER_MANIFEST_PATTERN = re.compile(r"manifest\.(\d+)-of-(\d+)\.json")
+FORMAT_VERSION = 1
+
+
+def _numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+def _write_json(path, content):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(content, f, indent=2)
+    os.replace(path + ".tmp", path) # atomic
+
+
+def worker_manifest_file(shard_index, num_shards):
+    """The manifest a worker of a sharded extraction writes (see `merge_worker_manifests`)."""
+    return MANIFEST_FILE if num_shards == 1 else f"manifest.{shard_index}-of-{num_shards}.json"
+
+
+def journal_file(name):
+    return f"{name}.journal"
+
+
+def read_journal(directory, name):
+    """Reads the journal of an unfinished shard.
+
+    The first line is a JSON header with the shard's parameters, every further line lists the numbers written
+    for one row (dense: row; ragged: row, first value row, length). A line is only complete (and counted) once
+    it ends with a newline: the last one may have been cut off by a crash.
+
+    Returns:
+        (header, list of int lists), or None if the shard has no journal
+    """
+    path = os.path.join(directory, journal_file(name))
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        lines = [line for line in f.read().split("\n")[:-1] if line]
+    if not lines:
+        return None
+    return json.loads(lines[0]), [[int(x) for x in line.split()] for line in lines[1:]]
+
+
+def dense_shard_file(name):
+    return f"{name}.npy"
+
+
+def quantized_scales_file(name):
+    """Scales of a quantized shard, next to its codes (`dense_shard_file`), which are renamed last."""
+    return f"{name}.scales.npy"
+
+
+def ragged_shard_files(name):
+    """(values, index) files of a ragged shard. The values file is renamed last and marks the shard as complete."""
+    return f"{name}.values", f"{name}.index.npy"
+
+
+class _Journal:
+    """The append-only list of rows of an unfinished shard that are on disk (see `read_journal`)."""
+
+    def __init__(self, directory, name, header=None):
+        self.path = os.path.join(directory, journal_file(name))
+        if header is None: # continue an existing journal
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.file.write(json.dumps(header) + "\n")
+            self.file.flush()
+
+    def append(self, entries):
+        # only called once the rows themselves were written
+        self.file.write("".join(" ".join(str(x) for x in entry) + "\n" for entry in entries))
+        self.file.flush()
+
+    def remove(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class _DenseShard:
+    """A shard of `num_rows` gradients of dimension `dim`, written row by row (in any order) into a preallocated .npy file."""
+
+    kind = "dense"
+
+    def __init__(self, directory, name, start, num_rows, dim, dtype, journal_entries=None):
+        self.name, self.start, self.num_rows, self.dim, self.dtype = name, start, num_rows, dim, dtype
+        self.path = os.path.join(directory, dense_shard_file(name))
+        if journal_entries is None:
+            self.array = np.lib.format.open_memmap(self.path + ".tmp", mode="w+", dtype=_numpy_dtype(dtype), shape=(num_rows, dim))
+            self.journal = _Journal(directory, name, {"kind": self.kind, "start": start, "num_rows": num_rows, "dim": dim, "dtype": str(dtype)})
+        else: # rows of the journal are already in the preallocated file
+            self.array = np.lib.format.open_memmap(self.path + ".tmp", mode="r+")
+            self.journal = _Journal(directory, name)
+
+    def write(self, rows, gradients):
+        self.array[rows] = gradients.to(self.dtype).reshape(len(rows), self.dim).numpy()
+        self.journal.append([[row] for row in rows])
+
+    def finalize(self):
+        self.array.flush()
+        del self.array
+        os.replace(self.path + ".tmp", self.path)
+        self.journal.remove()
+        return {"name": self.name, "file": dense_shard_file(self.name), "start": self.start, "end": self.start + self.num_rows}
+
+    def abort(self):
+        del self.array
+        os.remove(self.path + ".tmp")
+        self.journal.remove()
+
+
+class _QuantizedShard(_DenseShard):
+    """A dense shard stored as int8 (or packed 4-bit) codes, and a second .npy file with the float32 scales of
+    every block of `block_size` coordinates of a row (see quantization)."""
+
+    kind = "quantized"
+
+    def __init__(self, directory, name, start, num_rows, dim, bits, block_size, journal_entries=None):
+        self.name, self.start, self.num_rows, self.dim, self.bits = name, start, num_rows, dim, bits
+        self.block_size = quantization.get_block_size(dim, block_size)
+        self.dtype = torch.int8 if bits == 8 else torch.uint8
+        self.path = os.path.join(directory, dense_shard_file(name))
+        self.scales_path = os.path.join(directory, quantized_scales_file(name))
+        if journal_entries is None:
+            self.array = np.lib.format.open_memmap(self.path + ".tmp", mode="w+", dtype=_numpy_dtype(self.dtype), shape=(num_rows, quantization.code_dim(dim, bits)))
+            self.scales = np.lib.format.open_memmap(self.scales_path + ".tmp", mode="w+", dtype=np.float32, shape=(num_rows, quantization.num_blocks(dim, self.block_size)))
+            self.journal = _Journal(directory, name, {"kind": self.kind, "start": start, "num_rows": num_rows, "dim": dim, "bits": bits, "block_size": self.block_size})
+        else:
+            self.array = np.lib.format.open_memmap(self.path + ".tmp", mode="r+")
+            self.scales = np.lib.format.open_memmap(self.scales_path + ".tmp", mode="r+")
+            self.journal = _Journal(directory, name)
+
+    def write(self, rows, gradients):
+        quantized = quantization.quantize(gradients.reshape(len(rows), self.dim).float(), self.bits, self.block_size)
+        self.array[rows] = quantized[quantization.CODES_KEY].numpy()
+        self.scales[rows] = quantized[quantization.SCALES_KEY].numpy()
+        self.journal.append([[row] for row in rows])
+
+    def finalize(self):
+        self.scales.flush()
+        del self.scales
+        os.replace(self.scales_path + ".tmp", self.scales_path)
+        entry = super().finalize()
+        entry["scales_file"] = quantized_scales_file(self.name)
+        return entry
+
+    def abort(self):
+        del self.scales
+        os.remove(self.scales_path + ".tmp")
+        super().abort()
+
+
+class _RaggedShard:
+    """A shard of variable-length (length x hidden) gradients, appended in arrival order (see ragged_gradients)."""
+
+    kind = "ragged"
+
+    def __init__(self, directory, name, start, num_rows, hidden_size, max_length, dtype, journal_entries=None):
+        self.name, self.start, self.num_rows, self.hidden_size, self.dtype = name, start, num_rows, hidden_size, dtype
+        values_file, index_file = ragged_shard_files(name)
+        self.values_path = os.path.join(directory, values_file)
+        self.index_path = os.path.join(directory, index_file)
+        self.starts = np.zeros(num_rows, dtype=np.int64)
+        self.lengths = np.zeros(num_rows, dtype=np.int64)
+        self.total_rows = 0
+        if journal_entries is None:
+            self.file = open(self.values_path + ".tmp", "wb")
+            self.journal = _Journal(directory, name, {"kind": self.kind, "start": start, "num_rows": num_rows, "hidden_size": hidden_size, "max_length": max_length, "dtype": str(dtype)})
+        else:
+            for row, row_start, length in journal_entries:
+                self.starts[row], self.lengths[row] = row_start, length
+                self.total_rows = max(self.total_rows, row_start + length)
+            # values after the last journaled row belong to a write that was cut off
+            self.file = open(self.values_path + ".tmp", "r+b")
+            self.file.truncate(self.total_rows * hidden_size * _numpy_dtype(dtype).itemsize)
+            self.file.seek(0, os.SEEK_END)
+            self.journal = _Journal(directory, name)
+
+    def write(self, rows, gradients):
+        entries = []
+        for row, gradient in zip(rows, gradients):
+            self.starts[row] = self.total_rows
+            self.lengths[row] = len(gradient)
+            self.file.write(gradient.to(self.dtype).contiguous().view(torch.uint8).numpy().tobytes())
+            entries.append([row, self.total_rows, len(gradient)])
+            self.total_rows += len(gradient)
+        self.file.flush()
+        self.journal.append(entries)
+
+    def finalize(self):
+        self.file.close()
+        with open(self.index_path + ".tmp", "wb") as f:
+            np.save(f, np.stack([self.starts, self.lengths]))
+        os.replace(self.index_path + ".tmp", self.index_path)
+        os.replace(self.values_path + ".tmp", self.values_path)
+        self.journal.remove()
+        values_file, index_file = ragged_shard_files(self.name)
+        return {"name": self.name, "file": values_file, "index_file": index_file, "start": self.start, "end": self.start + self.num_rows, "num_values": self.total_rows}
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.values_path + ".tmp")
+        self.journal.remove()
+
+
+class AsyncShardWriter:
+    """Writes the shards of a gradient store from a background thread, so the GPU keeps computing while gradients
+    go to disk.
+
+    Gradients are handed over in micro-batches through a bounded queue (`write` blocks while the queue is full),
+    so host memory holds a few micro-batches instead of a whole shard. A shard is written to a temporary file and
+    renamed once it is complete (`finalize`), then added to the store's manifest: a shard file is never half-written,
+    and a shard only counts as stored once the manifest lists it (see `shard_exists`).
+    Until then, a journal lists the rows already in the temporary file, so an interrupted shard can be continued
+    (`resume`) instead of recomputed.
+
+    Errors of the writer thread are raised again by the next call from the main thread.
+    """
+
+    def __init__(self, directory, metadata=None, max_queue_size=4, manifest_file=MANIFEST_FILE):
+        """
+        Args:
+            directory: The gradient store directory (created if needed)
+            metadata: Written to the manifest (projection, model revision, dataset fingerprint, ...)
+            max_queue_size: Number of queued operations after which `write` blocks
+            manifest_file: Name of the manifest (workers of a sharded extraction each write their own)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.manifest_file = manifest_file
+        self.metadata = metadata or {}
+        if not os.path.isfile(os.path.join(directory, manifest_file)):
+            # an (empty) manifest from the start: a worker without any shards has done its part, too
+            _write_json(os.path.join(directory, manifest_file), {"format_version": FORMAT_VERSION, **self.metadata, "shards": [], "num_rows": 0})
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.shards = {}
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="AsyncShardWriter", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task[0](*task[1:])
+            except BaseException as e:
+                logging.error(f"writer failed: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _put(self, *task):
+        if self.error is not None:
+            raise RuntimeError("gradient writer failed") from self.error
+        self.queue.put(task)
+
+    def open_dense(self, name, start, num_rows, dim, dtype=torch.float16):
+        """Starts shard `name` holding the `num_rows` gradients of dimension `dim` of dataset rows start, start + 1, ..."""
+        self._put(self._open, _DenseShard, (name, start, num_rows, dim, dtype))
+
+    def open_quantized(self, name, start, num_rows, dim, bits, block_size=None):
+        """Starts shard `name` like `open_dense`, stored as `bits`-bit codes with a scale per block of `block_size`
+        coordinates (default: per row)."""
+        self._put(self._open, _QuantizedShard, (name, start, num_rows, dim, bits, block_size))
+
+    def open_ragged(self, name, start, num_rows, hidden_size, max_length, dtype=torch.float16):
+        """Starts ragged shard `name` holding `num_rows` gradients with `hidden_size` columns."""
+        self.metadata["max_length"] = max_length
+        self._put(self._open, _RaggedShard, (name, start, num_rows, hidden_size, max_length, dtype))
+
+    def resume(self, name):
+        """Reopens an unfinished shard `name` from its journal.
+
+        Returns:
+            The set of rows of the shard that are already stored, or None if there is nothing to resume
+            (the shard then has to be opened as usual)
+        """
+        journal = read_journal(self.directory, name)
+        if journal is None:
+            return None
+        header, entries = journal
+        if header["kind"] == "quantized":
+            self._put(self._open, _QuantizedShard, (name, header["start"], header["num_rows"], header["dim"], header["bits"], header["block_size"], entries))
+            return {entry[0] for entry in entries}
+        dtype = getattr(torch, header["dtype"].replace("torch.", ""))
+        if header["kind"] == "dense":
+            self._put(self._open, _DenseShard, (name, header["start"], header["num_rows"], header["dim"], dtype, entries))
+        else:
+            self.metadata["max_length"] = header["max_length"]
+            self._put(self._open, _RaggedShard, (name, header["start"], header["num_rows"], header["hidden_size"], header["max_length"], dtype, entries))
+        return {entry[0] for entry in entries}
+
+    def write(self, name, rows, gradients):
+        """Queues gradients (a tensor, or a list of tensors for ragged shards) for the given rows of a shard."""
+        self._put(self._write, name, list(rows), gradients)
+
+    def finalize(self, name):
+        """Queues the completion of a shard, after all its queued writes."""
+        self._put(self._finalize, name)
+
+    def abort(self, name):
+        """Queues the removal of an unfinished shard."""
+        if self.error is None:
+            self._put(self._abort, name)
+
+    def close(self):
+        """Waits until everything queued is on disk and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("gradient writer failed") from self.error
+
+    def _open(self, shard_class, shard_args):
+        shard = shard_class(self.directory, *shard_args)
+        self.shards[shard.name] = shard
+
+    def _write(self, name, rows, gradients):
+        self.shards[name].write(rows, gradients)
+
+    def _finalize(self, name):
+        shard = self.shards.pop(name)
+        entry = shard.finalize()
+        self._add_to_manifest(shard, entry)
+        logging.info(f"stored gradients to {os.path.join(self.directory, entry['file'])}")
+
+    def _abort(self, name):
+        shard = self.shards.pop(name, None)
+        if shard is not None:
+            shard.abort()
+
+    def _add_to_manifest(self, shard, entry):
+        path = os.path.join(self.directory, self.manifest_file)
+        manifest = read_manifest(self.directory, self.manifest_file) if os.path.isfile(path) else {"format_version": FORMAT_VERSION, "shards": []}
+        manifest.update(self.metadata)
+        manifest["kind"] = shard.kind
+        manifest["dtype"] = str(_numpy_dtype(shard.dtype))
+        if shard.kind == "dense":
+            manifest["dim"] = shard.dim
+        elif shard.kind == "quantized":
+            manifest["dim"] = shard.dim
+            manifest["quantization"] = {"bits": shard.bits, "block_size": shard.block_size}
+        else:
+            manifest["hidden_size"] = shard.hidden_size
+            if factored_gradients.FACTORS_KEY in manifest: # factors of linear layers, see factored_gradients
+                manifest["dim"] = factored_gradients.grad_dim(manifest[factored_gradients.FACTORS_KEY])
+            else:
+                manifest["dim"] = shard.hidden_size * manifest["max_length"]
+        manifest["shards"] = sorted([s for s in manifest["shards"] if s["name"] != entry["name"]] + [entry], key=lambda s: s["start"])
+        manifest["num_rows"] = sum(s["end"] - s["start"] for s in manifest["shards"])
+        _write_json(path, manifest)
+
+
+def read_manifest(directory, manifest_file=MANIFEST_FILE):
+    with open(os.path.join(directory, manifest_file), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# must be the same for all workers of one store
+CONSISTENT_MANIFEST_KEYS = ["format_version", "kind", "dim", "dtype", "hidden_size", "max_length", "factors", "quantization", "projection", "tracin", "model_revision", "dataset_fingerprint", "dataset_num_rows"]
+
+
+def merge_worker_manifests(directory, num_rows=None):
+    """Combines the manifests of the workers of a sharded extraction into the store's manifest.json.
+
+    Checks that all workers wrote their manifest, that they agree on the gradients (dimension, dtype, projection,
+    model revision, dataset fingerprint), that every listed shard file exists, and that the shards cover the
+    dataset rows 0, ..., num_rows - 1 without gaps or overlaps.
+
+    Args:
+        directory: The gradient store directory
+        num_rows: Expected number of rows (default: the dataset size recorded by the workers)
+
+    Returns:
+        The merged manifest
+    """
+    manifests = {}
+    for path in glob.glob(os.path.join(directory, "manifest.*-of-*.json")):
+        match = WORKER_MANIFEST_PATTERN.fullmatch(os.path.basename(path))
+        if match:
+            manifests[(int(match.group(1)), int(match.group(2)))] = read_manifest(directory, os.path.basename(path))
+    if not manifests:
+        raise FileNotFoundError(f"No worker manifests in {directory}")
+    num_shards = {n for _, n in manifests}
+    if len(num_shards) != 1:
+        raise ValueError(f"Worker manifests of different runs (--num_shards {sorted(num_shards)}) in {directory}")
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - {k for k, _ in manifests})
+    if missing:
+        raise ValueError(f"Manifests of workers {missing} (of {num_shards}) are missing in {directory}")
+
+    with_shards = [manifest for _, manifest in sorted(manifests.items()) if manifest["shards"]]
+    merged = dict(with_shards[0] if with_shards else manifests[(0, num_shards)])
+    for (k, _), manifest in sorted(manifests.items()):
+        if not manifest["shards"]:
+            continue
+        for key in CONSISTENT_MANIFEST_KEYS:
+            if manifest.get(key) != merged.get(key):
+                raise ValueError(f"Worker {k} disagrees on {key}: {manifest.get(key)} != {merged.get(key)}")
+
+    shards = sorted((s for m in manifests.values() for s in m["shards"]), key=lambda s: s["start"])
+    num_rows = num_rows if num_rows is not None else merged.get("dataset_num_rows")
+    end = 0
+    for shard in shards:
+        if shard["start"] != end:
+            raise ValueError(f"Rows {min(end, shard['start'])} to {max(end, shard['start'])} are {'missing' if shard['start'] > end else 'stored twice'} in {directory}")
+        if not os.path.isfile(os.path.join(directory, shard["file"])):
+            raise FileNotFoundError(f"Shard {shard['file']} of the manifest is missing in {directory}")
+        end = shard["end"]
+    if num_rows is not None and end != num_rows:
+        raise ValueError(f"Rows {end} to {num_rows} are missing in {directory}")
+
+    merged["shards"] = shards
+    merged["num_rows"] = end
+    _write_json(os.path.join(directory, MANIFEST_FILE), merged)
+    return merged
+
+
+def is_gradient_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def shard_exists(directory, name):
+    """Whether shard `name` is stored: listed in the manifest (or a worker manifest) of the store, and on disk.
+
+    A shard file is renamed before it is added to the manifest, so after a crash in between, its file is there but
+    the shard does not count (and is written again).
+    """
+    for path in glob.glob(os.path.join(directory, "manifest*.json")):
+        manifest_file = os.path.basename(path)
+        if manifest_file != MANIFEST_FILE and not WORKER_MANIFEST_PATTERN.fullmatch(manifest_file):
+            continue
+        for shard in read_manifest(directory, manifest_file)["shards"]:
+            if shard["name"] == name and os.path.isfile(os.path.join(directory, shard["file"])):
+                return True
+    return False
+
+
+class GradientStore:
+    """Read access to a gradient store directory: shards are memory-mapped, so rows are sliced without loading
+    the store into memory.
+
+    Row `i` is the gradient of dataset row `i`. Dense rows are returned as (n x dim) tensors, ragged ones as dicts
+    (see ragged_gradients). Quantized stores return dequantized float32 rows, except for `shard_rows` and
+    `iter_blocks(..., dequantize=False)`, which return the codes and scales (see quantization).
+
+    Example:
+        store = GradientStore("gradients/rademacher_16384/OLMo-2-1124-7B-SFT/sampled-tulu-1000/train/main")
+        for start, block in store.iter_blocks(4096):
+            ...
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        if self.manifest.get("format_version", 0) > FORMAT_VERSION:
+            raise ValueError(f"Unsupported gradient store version {self.manifest['format_version']}")
+        self.shards = self.manifest["shards"]
+        self.dim = self.manifest["dim"]
+        self.dtype = np.dtype(self.manifest["dtype"])
+        self.ragged = self.manifest["kind"] == "ragged"
+        self.quantized = self.manifest["kind"] == "quantized"
+        self.starts = [s["start"] for s in self.shards]
+        for previous, shard in zip(self.shards, self.shards[1:]):
+            if previous["end"] != shard["start"]:
+                raise ValueError(f"Rows {previous['end']} to {shard['start']} are missing in {directory}")
+        self._arrays = {}
+
+    def __len__(self):
+        return self.shards[-1]["end"] if self.shards else 0
+
+    def _shard(self, k):
+        if k not in self._arrays:
+            shard = self.shards[k]
+            path = os.path.join(self.directory, shard["file"])
+            if self.ragged:
+                index = np.load(os.path.join(self.directory, shard["index_file"]))
+                shape = (shard["num_values"], self.manifest["hidden_size"])
+                # np.memmap cannot map the empty file of a shard of empty gradients
+                values = np.memmap(path, dtype=self.dtype, mode="c", shape=shape) if shape[0] else np.empty(shape, self.dtype)
+                self._arrays[k] = (values, index)
+            elif self.quantized:
+                self._arrays[k] = (np.load(path, mmap_mode="c"), np.load(os.path.join(self.directory, shard["scales_file"]), mmap_mode="c"))
+            else:
+                # copy-on-write: zero-copy tensors without ever modifying the file
+                self._arrays[k] = np.load(path, mmap_mode="c")
+        return self._arrays[k]
+
+    def shard_rows(self, k):
+        """All rows of shard `k` as a (memory-mapped) tensor, or a ragged (or factored) or quantized dict."""
+        if self.ragged:
+            values, index = self._shard(k)
+            rows = {
+                ragged_gradients.VALUES_KEY: torch.from_numpy(values),
+                ragged_gradients.STARTS_KEY: torch.from_numpy(index[0]),
+                ragged_gradients.LENGTHS_KEY: torch.from_numpy(index[1]),
+                ragged_gradients.MAX_LENGTH_KEY: self.manifest["max_length"],
+            }
+            if factored_gradients.FACTORS_KEY in self.manifest:
+                rows[factored_gradients.FACTORS_KEY] = self.manifest[factored_gradients.FACTORS_KEY]
+            return rows
+        if self.quantized:
+            codes, scales = self._shard(k)
+            quantization_info = self.manifest["quantization"]
+            return {
+                quantization.CODES_KEY: torch.from_numpy(codes),
+                quantization.SCALES_KEY: torch.from_numpy(scales),
+                quantization.BITS_KEY: quantization_info["bits"],
+                quantization.BLOCK_SIZE_KEY: quantization_info["block_size"],
+                quantization.DIM_KEY: self.dim,
+            }
+        return torch.from_numpy(self._shard(k))
+
+    def _dense_rows(self, k, index):
+        """Rows `index` (a slice or indices) of shard `k` as a tensor, dequantized if needed."""
+        rows = self.shard_rows(k)
+        if self.quantized:
+            return quantization.dequantize(quantization.select(rows, index))
+        return rows[index]
+
+    def rows(self, start, end):
+        """Dense rows start:end as a tensor (a view into the memory map if they lie in one shard, empty if start >= end)."""
+        if self.ragged:
+            raise NotImplementedError("use shard_rows for ragged stores")
+        parts = []
+        k = max(0, np.searchsorted(self.starts, start, side="right") - 1)
+        while start < end and k < len(self.shards):
+            shard = self.shards[k]
+            stop = min(end, shard["end"])
+            parts.append(self._dense_rows(k, slice(start - shard["start"], stop - shard["start"])))
+            start = stop
+            k += 1
+        if not parts:
+            return self.take([])
+        return parts[0] if len(parts) == 1 else torch.cat(parts)
+
+    def __getitem__(self, i):
+        return self.rows(i, i + 1)[0]
+
+    def take(self, indices):
+        """Dense rows at the given (sorted) indices, as one [len(indices), dim] tensor."""
+        if self.ragged:
+            raise NotImplementedError("use shard_rows for ragged stores")
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        shard_ids = torch.as_tensor(np.searchsorted(self.starts, indices.numpy(), side="right") - 1)
+        dtype = torch.float32 if self.quantized else torch.from_numpy(np.empty(0, self.dtype)).dtype
+        rows = torch.empty(len(indices), self.dim, dtype=dtype)
+        for k in shard_ids.unique().tolist():
+            mask = shard_ids == k
+            rows[mask] = self._dense_rows(k, indices[mask] - self.shards[k]["start"])
+        return rows
+
+    def iter_blocks(self, block_size, dequantize=True):
+        """Yields (first row, rows) blocks of at most `block_size` rows, never crossing a shard boundary.
+        With `dequantize=False`, blocks of a quantized store are quantized dicts."""
+        for k, shard in enumerate(self.shards):
+            for start in range(0, shard["end"] - shard["start"], block_size):
+                block = slice(start, start + block_size)
+                if self.quantized and not dequantize:
+                    yield shard["start"] + start, quantization.select(self.shard_rows(k), block)
+                else:
+                    yield shard["start"] + start, self._dense_rows(k, block)
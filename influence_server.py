@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import queue
+import socket
+import hashlib
+import logging
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from trak.projectors import CudaProjector
+
+import util
+import loss_gradients
+import ragged_gradients
+import extract_gradients
+from extract_gradients import GradientExtractor, PROJECTOR_MAX_BATCH_SIZE
+from factored_gradients import FACTORS_KEY
+from gradient_store import GradientStore
+from olmo_training_utils import sft_tulu_tokenize_and_truncate_v2
+from scoring import METHODS, compute_scores
+
+# the seed extract_gradients.py projects with
+PROJECTION_SEED = 42
+
+
+def check_store(store, device):
+    """Rejects a store whose train gradients the server cannot compute test gradients for.
+
+    Raises:
+        ValueError: For ragged and factor stores (--gradient_layers), TracIn sums over several checkpoints (the server computes gradients
+            at one checkpoint), other paradigms than sft, and projections the server cannot repeat on `device`
+    """
+    manifest, projection = store.manifest, store.manifest.get("projection") or {}
+    if store.ragged or FACTORS_KEY in manifest or projection.get("layers") or manifest.get("gradient_layers"):
+        raise ValueError(f"{store.directory} is a ragged or factor store, serve a dense (projected or full) store")
+    if manifest.get("tracin") is not None:
+        raise ValueError(f"{store.directory} holds the TracIn sum over {len(manifest['tracin']['checkpoints'])} checkpoints, serve the store of a single checkpoint")
+    if manifest.get("paradigm", "sft") != "sft":
+        raise ValueError(f"{store.directory} holds {manifest['paradigm']} gradients, the server computes sft gradients")
+    if projection.get("seed", PROJECTION_SEED) != PROJECTION_SEED:
+        raise ValueError(f"{store.directory} was projected with seed {projection['seed']}, extract_gradients.py uses {PROJECTION_SEED}")
+    if projection.get("backend") == "cuda" and torch.device(device).type != "cuda":
+        raise ValueError(f"{store.directory} was projected with the 'cuda' projector backend, which the CPU cannot repeat: serve it with a --device cuda")
+
+
+def get_projection(stores, device):
+    """The projection the train gradients were stored with (None for full gradients), the same for all stores
+    (see `check_store`)."""
+    projections = [store.manifest.get("projection") for store in stores]
+    for store, projection in zip(stores, projections):
+        check_store(store, device)
+        if projection != projections[0] or store.dim != stores[0].dim:
+            raise ValueError(f"{store.directory} was projected differently than {stores[0].directory}")
+    return projections[0]
+
+
+def get_extractor(manifest, device, model=None, revision=None, max_seq_length=4096, attn_implementation=None, autocast=None):
+    """A `GradientExtractor` that builds the model and projector of a store the way extract_gradients.py did.
+
+    The model is loaded with the store's --lean (frozen parameters, eval mode), or with it for stores whose manifest
+    does not record it (the same gradients for models without dropout). The dataset is not needed: the gradient
+    dimension is `max_seq_length` x hidden size.
+
+    Args:
+        manifest: The manifest of the store
+        device: Where to compute the gradients
+        model: The model (default: the store's)
+        revision: Its revision or a local checkpoint directory (default: the store's)
+    """
+    projection = manifest.get("projection")
+    argv = [model or manifest["model"], manifest.get("dataset") or "unused", "0", "--paradigm", "sft", "--device", device, "--checkpoint_cache_dir", ""]
+    if manifest.get("lean", True):
+        argv += ["--lean"]
+    if projection is not None:
+        # nested projections: the first dim coordinates of a projection to prefix_of
+        argv += ["--random_projection", "--proj_type", projection["type"], "--proj_dim", str(projection.get("prefix_of", projection["dim"])), "--projector_backend", projection["backend"]]
+    if attn_implementation is not None:
+        argv += ["--attn_implementation", attn_implementation]
+    if autocast is not None:
+        argv += ["--autocast", autocast]
+    extractor = GradientExtractor(extract_gradients.parse_args(argv))
+    if "llama" in extractor.args.model:
+        logging.warning("llama checkpoints are built from their config with random weights (as in extract_gradients.py): the test gradients only match the store if the extraction ran with the same torch seed")
+    extractor.load_checkpoint(revision or manifest.get("model_revision"))
+    extractor.grad_dim = max_seq_length * extractor.model.get_input_embeddings().weight.shape[-1]
+    return extractor
+
+
+def to_example(request, tokenizer, max_seq_length):
+    """Tokenizes a request like an sft train example (see `sft_tulu_tokenize_and_truncate_v1`).
+
+    Args:
+        request: A dict with the `messages` of a conversation, or a `prompt` and its `completion`
+        tokenizer: The tokenizer of the model
+        max_seq_length: Length the train examples were truncated and padded to
+
+    Returns:
+        A dict with the (max_seq_length,) `input_ids`, `labels` and `attention_mask`
+    """
+    if "messages" in request:
+        row = {"messages": request["messages"]}
+    elif "prompt" in request and "completion" in request:
+        row = {"messages": [{"role": "user", "content": request["prompt"]}, {"role": "assistant", "content": request["completion"]}]}
+    else:
+        raise ValueError("a request needs 'messages', or a 'prompt' and a 'completion'")
+    row = sft_tulu_tokenize_and_truncate_v2(row, tokenizer=tokenizer, max_seq_length=max_seq_length)
+    example = {key: row[key][0] for key in loss_gradients.MODEL_INPUT_KEYS}
+    if not (example["labels"] != -100).any():
+        raise ValueError("the request has no assistant tokens to compute the loss on")
+    return example
+
+
+def get_cache_key(example):
+    """Identifies the test gradient of an example by its real tokens and labels."""
+    length = loss_gradients.get_example_length(example)
+    h = hashlib.sha1(example["input_ids"][:length].numpy().tobytes())
+    h.update(example["labels"][:length].numpy().tobytes())
+    return h.hexdigest()
+
+
+class InfluenceService:
+    """Scores new test examples against train gradient stores, with the model, the projector and the
+    memory-mapped stores loaded once.
+
+    Test gradients are computed by a `GradientExtractor` set up like the extraction of the stores (see
+    `get_extractor`): the loss gradient irt to the input embeddings, zero-padded to `max_seq_length` and projected
+    like the train gradients. The most recent ones are kept in an LRU cache.
+
+    Example:
+        stores = [GradientStore(path)]
+        service = InfluenceService(get_extractor(stores[0].manifest, "cpu"), stores)
+        results = service.query([service.to_example({"messages": messages})], [10], ["cosine"])
+    """
+
+    def __init__(self, extractor, stores, max_seq_length=4096, block_size=4096, cache_size=1024, train_ids=None):
+        self.extractor = extractor
+        self.stores = stores
+        self.device = extractor.device
+        self.max_seq_length = max_seq_length
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self.train_ids = train_ids
+        self.num_train = sum(len(store) for store in stores)
+        self.cache = OrderedDict()
+
+        self.projection = get_projection(stores, self.device)
+        self.projector = None
+        if self.projection is not None:
+            self.projector = extractor.projectors[0][0]
+        elif stores[0].dim != extractor.grad_dim:
+            raise ValueError(f"the stores hold full gradients of dimension {stores[0].dim}, but max_seq_length x hidden size is {extractor.grad_dim}")
+        self.dim = stores[0].dim
+
+    def to_example(self, request):
+        return to_example(request, self.extractor.tokenizer, self.max_seq_length)
+
+    def get_gradients(self, examples):
+        """Projected test gradients (float16, on the CPU) of a list of examples, one forward/backward pass."""
+        batch, lengths = self.extractor.collate_examples(examples)
+        batch_gradients = self.extractor.get_loss_gradients(self.extractor.model, batch, lengths, self.device)
+        flat_gradients = torch.stack([ragged_gradients.pad_rows(g, self.max_seq_length).detach().flatten() for g in batch_gradients]).half()
+        if self.projector is None:
+            return flat_gradients.cpu()
+        chunks = flat_gradients.split(PROJECTOR_MAX_BATCH_SIZE) if isinstance(self.projector, CudaProjector) else [flat_gradients]
+        projected = torch.cat([self.projector.project(chunk, model_id=0) for chunk in chunks])
+        return projected[:, :self.dim].half().cpu()
+
+    def get_cached_gradients(self, examples):
+        """Test gradients of `examples`, from the cache where possible. Duplicates are computed once.
+
+        Returns:
+            (an [n, dim] tensor, whether each gradient came from the cache)
+        """
+        keys = [get_cache_key(example) for example in examples]
+        cached = [key in self.cache for key in keys]
+        missing = list(dict.fromkeys(key for key, hit in zip(keys, cached) if not hit))
+        computed = {}
+        if missing:
+            by_key = dict(zip(keys, examples))
+            computed = dict(zip(missing, self.get_gradients([by_key[key] for key in missing])))
+        gradients = []
+        for key in keys:
+            gradient = computed[key] if key in computed else self.cache[key]
+            self.cache[key] = gradient
+            self.cache.move_to_end(key)
+            gradients.append(gradient)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return torch.stack(gradients), cached
+
+    def query(self, examples, top_ks, funcs):
+        """The most influential train examples of each test example, one pass over the train gradients.
+
+        Args:
+            examples: Tokenized test examples (see `to_example`)
+            top_ks: Number of train examples to return per test example
+            funcs: Influence estimate method per test example ('dot' or 'cosine')
+
+        Returns:
+            One dict per example with the `train_indices`, `train_ids` and `scores` (best first) and
+            whether the test gradient was `cached`
+        """
+        gradients, cached = self.get_cached_gradients(examples)
+        methods = [method for method in METHODS if method in funcs]
+        top_k = min(max(top_ks), self.num_train)
+        best, _ = compute_scores(self.stores, [gradients], methods, device=self.device, block_size=self.block_size, top_k=top_k)
+
+        results = []
+        for j, (k, func) in enumerate(zip(top_ks, funcs)):
+            scores, indices = best[func][0][j, :k].tolist(), best[func][1][j, :k].tolist()
+            results.append({
+                "func": func,
+                "train_indices": indices,
+                "train_ids": [self.train_ids[i] for i in indices] if self.train_ids is not None else indices,
+                "scores": scores,
+                "cached": cached[j],
+            })
+        return results
+
+
+class MicroBatcher:
+    """Runs the requests of concurrent callers in micro-batches on a single worker thread.
+
+    The worker waits up to `max_wait` seconds after the first request of a batch for more requests, until it has
+    `max_batch_size`, and calls `process(items)`, which returns one result per item.
+    """
+
+    def __init__(self, process, max_batch_size=8, max_wait=0.01):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queues an item and blocks until its result is ready (or raises the error of its batch)."""
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while len(batch) < self.max_batch_size:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    if item is None:
+                        self._queue.put(None) # stop after this batch
+                        break
+                    batch.append(item)
+            except queue.Empty:
+                pass
+            items, futures = zip(*batch)
+            try:
+                results = self.process(list(items))
+            except Exception as e:
+                logging.exception(f"batch of {len(items)} request(s) failed")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def make_handler(service, batcher, default_top_k, default_func):
+    """An HTTP request handler serving POST /influence and GET /health."""
+
+    class InfluenceHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self.send_json(404, {"error": f"unknown path {self.path}"})
+            self.send_json(200, {"status": "ok", "num_train": service.num_train, "dim": service.dim, "projection": service.projection, "cached": len(service.cache)})
+
+        def do_POST(self):
+            if self.path != "/influence":
+                return self.send_json(404, {"error": f"unknown path {self.path}"})
+            try: # tokenized in the handler's thread, so bad requests fail on their own
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                top_k = int(request.get("top_k", default_top_k))
+                func = request.get("func", default_func)
+                if func not in METHODS or top_k < 1:
+                    raise ValueError(f"func must be one of {METHODS} and top_k positive")
+                example = service.to_example(request)
+            except (ValueError, TypeError, KeyError) as e:
+                return self.send_json(400, {"error": str(e)})
+            try:
+                result = batcher.submit((example, top_k, func))
+            except Exception as e:
+                return self.send_json(500, {"error": str(e)})
+            self.send_json(200, result)
+
+        def log_message(self, format, *args): # the client address of a Unix socket is empty
+            logging.debug(format % args)
+
+    return InfluenceHandler
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """`ThreadingHTTPServer` on a Unix socket (e.g. `curl --unix-socket <path> http://localhost/health`)."""
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+def get_train_ids(dataset_name, split, num_train):
+    """The `id` column of the train dataset (None without one)."""
+    from datasets import load_dataset
+    dataset = load_dataset(dataset_name, split=split)
+    if len(dataset) != num_train:
+        logging.warning(f"{dataset_name} has {len(dataset)} rows, but the stores hold {num_train} gradients")
+    if "id" not in dataset.column_names:
+        return None
+    return [i.item() if isinstance(i, np.generic) else i for i in dataset["id"]]
+
+
+parser = argparse.ArgumentParser("influence_server")
+parser.add_argument("--train_data_path", help="Gradient store(s) of the train gradients (dense: projected or full), scored in this order", nargs="+", required=True)
+parser.add_argument("--model", help="The model the train gradients were extracted with (default: from the store's manifest)", default=None)
+parser.add_argument("--revision", help="Its revision or a local checkpoint directory (default: from the store's manifest)", default=None)
+parser.add_argument("--dataset", help="Train dataset whose 'id' column is returned with the scores (default: from the store's manifest, if it can be loaded)", default=None)
+parser.add_argument("--dataset_split", help="The split of the train dataset (default: from the store's manifest)", default=None)
+parser.add_argument("--max_seq_length", help="Length the train examples were padded to (4096 in extract_gradients.py)", type=int, default=4096)
+parser.add_argument("--func", help="Default influence estimate method of a request", choices=METHODS, default="cosine")
+parser.add_argument("--top_k", help="Default number of train examples returned per request", type=int, default=10)
+parser.add_argument("--max_batch_size", help="Maximum number of concurrent requests per forward/backward pass and scoring pass", type=int, default=8)
+parser.add_argument("--max_wait_ms", help="How long the first request of a micro-batch waits for others", type=float, default=10)
+parser.add_argument("--cache_size", help="Number of recent test gradients kept in the LRU cache", type=int, default=1024)
+parser.add_argument("--block_size", help="Number of train gradients multiplied at a time (bounds the memory)", type=int, default=4096)
+parser.add_argument("--attn_implementation", help="Attention kernel of the model (default: the model's own choice)", choices=["eager", "sdpa", "flash_attention_2"], default=None)
+parser.add_argument("--autocast", help="Run the forward pass under torch.autocast with this dtype", choices=list(loss_gradients.AUTOCAST_DTYPES), default=None)
+parser.add_argument("--device", help="Device for the gradients and scores (e.g., cuda:0 or cpu)", default="cuda" if torch.cuda.is_available() else "cpu")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--socket", help="Serve on this Unix socket instead of --host/--port", default=None)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    util.set_hf_token()
+
+    stores = [GradientStore(path) for path in args.train_data_path]
+    manifest = stores[0].manifest
+    get_projection(stores, args.device) # before the model is loaded
+    extractor = get_extractor(manifest, args.device, args.model, args.revision, args.max_seq_length, args.attn_implementation, args.autocast)
+
+    train_ids = None
+    if args.dataset is not None or manifest.get("dataset") is not None:
+        try:
+            train_ids = get_train_ids(args.dataset or manifest["dataset"], args.dataset_split or manifest.get("dataset_split", "train"), sum(len(store) for store in stores))
+        except Exception as e:
+            if args.dataset is not None:
+                raise
+            logging.warning(f"returning train indices as ids, the dataset of the store could not be loaded: {e}")
+
+    service = InfluenceService(
+        extractor, stores, max_seq_length=args.max_seq_length, block_size=args.block_size, cache_size=args.cache_size, train_ids=train_ids,
+    )
+
+    def process(items):
+        examples, top_ks, funcs = zip(*items)
+        return service.query(list(examples), list(top_ks), list(funcs))
+
+    batcher = MicroBatcher(process, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    handler = make_handler(service, batcher, args.top_k, args.func)
+    server = UnixHTTPServer(args.socket, handler) if args.socket else ThreadingHTTPServer((args.host, args.port), handler)
+    logging.info(f"serving {service.num_train} train gradients (dim {service.dim}) on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import contextlib
+import torch
+
+from profiling import ExtractionProfiler
+
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+# columns a data collator gets
+MODEL_INPUT_KEYS = ["input_ids", "attention_mask", "labels"]
+
+
+def autocast(device, dtype=None):
+    """`torch.autocast` for the forward pass with `dtype` ('bf16' or 'fp16'), else a no-op."""
+    dtype = AUTOCAST_DTYPES.get(dtype)
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def get_example_length(example):
+    """Returns the number of real (non-padding) tokens of an example. Padding is expected on the right."""
+    if "attention_mask" in example:
+        return int(torch.as_tensor(example["attention_mask"]).sum()) # not sum(): that iterates over every element
+    return len(example["input_ids"])
+
+
+def collate_examples(examples, data_collator):
+    """Cuts every example to its real length and pads the mini-batch to its longest member (on the CPU).
+
+    Returns:
+        (batch, lengths): the collated `input_ids`, `attention_mask` and `labels`, and the real lengths
+    """
+    lengths = [get_example_length(example) for example in examples]
+    batch = data_collator(
+        [
+            {
+            key: value[:length]
+            for key, value in example.items() if key in MODEL_INPUT_KEYS # only keep relevant cols
+            }
+            for example, length in zip(examples, lengths)
+        ])
+    return dict(batch), lengths
+
+
+def get_loss_gradients(model, batch, lengths, device, autocast_dtype=None, capture=None, profiler=None, causal=True):
+    """Computes per-example gradients of the loss function irt to the input embeddings for a mini-batch.
+
+    Every example is cut to its real length and the mini-batch is only padded to its longest member.
+    The loss of each example is averaged over its own label tokens and the per-example losses are summed,
+    so the gradient irt to an example's embeddings is exactly the gradient of that example's loss
+    (padding sits at the end and is never attended to by real tokens of a causal model).
+
+    Masked language models (`causal=False`) attend to the padding, so their examples are collated whole, one at a
+    time (`lengths` are then the padded lengths), and the labels (of the masked tokens) are not shifted.
+
+    Args:
+        model: A causal language model with a `forward` method which returns `logits`
+        batch: A mini-batch of instances from the training data, collated by `collate_examples`
+            (ideally in pinned memory, so the copy to the device does not block)
+        lengths: The real length of every example (see `collate_examples`)
+        device: What device to use (e.g., cuda:0 or cpu)
+        autocast_dtype: Run the forward pass under `torch.autocast` with this dtype ('bf16' or 'fp16')
+        capture: A `FactorCapture` of linear layers whose gradients are returned instead
+        profiler: An `ExtractionProfiler` that times the forward and backward pass
+        causal: Whether the model predicts the next token (labels are shifted) or masked tokens
+
+    Returns:
+        A list of 2D tensors (one per example): gradient of the loss function irt to the input embeddings
+        of the real tokens (the gradient irt to padding embeddings is zero), or with a `capture`,
+        the factor rows of the real tokens (see `FactorCapture.factors`)
+    """
+    profiler = profiler or ExtractionProfiler(enabled=False)
+    model.zero_grad()
+
+    with profiler.stage("forward"), autocast(device, autocast_dtype), capture if capture is not None else contextlib.nullcontext():
+        inputs_embeds = model.get_input_embeddings().weight[batch["input_ids"].to(device, non_blocking=True)]
+        if not inputs_embeds.requires_grad: # frozen parameters (--lean): the embeddings are the only leaf
+            inputs_embeds.requires_grad_()
+
+        logits = model.forward(inputs_embeds=inputs_embeds, **({"use_cache": False} if causal else {})).logits.float() # masked LMs have no cache
+
+        # same shift and reduction as the model's own loss, but one loss per example
+        labels = batch["labels"].to(device, non_blocking=True)
+        if causal:
+            logits, labels = logits[:, :-1], labels[:, 1:]
+        token_losses = torch.nn.functional.cross_entropy(logits.transpose(1, 2), labels, ignore_index=-100, reduction="none")
+        losses = token_losses.sum(dim=-1) / (labels != -100).sum(dim=-1)
+
+    with profiler.stage("backward"):
+        if capture is not None:
+            return capture.factors(losses.sum(), lengths)
+        batch_gradients = torch.autograd.grad(losses.sum(), inputs_embeds, retain_graph=False)[0]
+
+    return [gradient[:length] for gradient, length in zip(batch_gradients, lengths)]
@@ -0,0 +1,25 @@
+import logging
+import argparse
+
+from gradient_store import merge_worker_manifests
+from gradient_stats import merge_worker_moments
+
+logging.basicConfig(
+                    level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+parser = argparse.ArgumentParser("merge_gradients")
+parser.add_argument("path", help="Output folder of a checkpoint written by the workers of a sharded extraction, e.g. ./gradients/full/OLMo-2-1124-7B-SFT/sampled-tulu-1000/train/main")
+parser.add_argument("--mode", help="The --mode of the extraction: 'store' or 'store_mean'", choices=["store", "store_mean"], default="store")
+parser.add_argument("--num_rows", help="Expected number of gradients (default: the dataset size recorded by the workers)", type=int, default=None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.mode == "store":
+        manifest = merge_worker_manifests(args.path, num_rows=args.num_rows)
+        logging.info(f"merged {len(manifest['shards'])} shards ({manifest['num_rows']} gradients) into {args.path}/manifest.json")
+    else:
+        moments = merge_worker_moments(args.path, num_rows=args.num_rows)
+        logging.info(f"merged the means of {moments.count} gradients into {args.path}/mean")
@@ -1,30 +1,42 @@
+import os
+import shutil
+import bisect
+import hashlib
+import logging
+import numpy as np
 import torch
 
 SFT_MESSAGE_KEY = "messages"
 INPUT_IDS_KEY = "input_ids"
 ATTENTION_MASK_KEY = "attention_mask"
 LABELS_KEY = "labels"
+LENGTH_KEY = "length"
+
+CHAT_TEMPLATE = """{% for message in messages %}
+    {{ '<|user|>' if message['role'] == 'user' else '<|assistant|>' }} {{ message['content'].strip() }}
+    {% endfor %}"""
+
+# number of tokens before a message boundary that are re-tokenized to find the boundary (see `sft_tulu_tokenize_v2`)
+PREFIX_CONTEXT_TOKENS = 16
 
 def sft_tulu_tokenize_and_truncate_v1(row, tokenizer, max_seq_length=4096):
     """Taken more or less directly from https://github.com/allenai/open-instruct/blob/main/open_instruct/finetune.py
        (who took it directly from https://github.com/allenai/open-instruct/blob/ba11286e5b9eb00d4ce5b40ef4cac1389888416a/open_instruct/finetune.py#L385)"""
 
-    tokenizer.chat_template = """{% for message in messages %}
-    {{ '<|user|>' if message['role'] == 'user' else '<|assistant|>' }} {{ message['content'].strip() }}
-    {% endfor %}"""
+    input_ids, labels = _sft_tulu_tokenize_v1(_get_messages(row), tokenizer, max_seq_length=max_seq_length)
+    input_ids, labels, attention_mask = _truncate_and_pad(input_ids, labels, tokenizer, max_seq_length)
 
-    messages = row["messages"]
+    # no .flatten()
+    row[INPUT_IDS_KEY] = input_ids
+    row[LABELS_KEY] = labels
+    row[ATTENTION_MASK_KEY] = attention_mask
 
-    # Flatten if necessary
-    if isinstance(messages, list) and len(messages) == 1 and isinstance(messages[0], list):
-        messages = messages[0]  # minus one level of nesting
+    return row
 
-    # Validate structure
-    if not (isinstance(messages, list) and all(isinstance(m, dict) for m in messages)):
-        raise ValueError(f"Invalid message format: {messages}")
 
-    if len(messages) == 0:
-        raise ValueError("messages field is empty.")
+def _sft_tulu_tokenize_v1(messages, tokenizer, max_seq_length):
+    """Returns the (1 x n) input_ids and labels of a conversation, before truncation and padding."""
+    tokenizer.chat_template = CHAT_TEMPLATE
 
     # print(messages)
     # first tokenize without padding/truncation to calculate positions
@@ -89,8 +101,30 @@ def sft_tulu_tokenize_and_truncate_v1(row, tokenizer, max_seq_length=4096):
             if max_seq_length and message_end_idx >= max_seq_length:
                 break
 
+    return input_ids, labels
+
+
+def _get_messages(row):
+    messages = row[SFT_MESSAGE_KEY]
+
+    # Flatten if necessary
+    if isinstance(messages, list) and len(messages) == 1 and isinstance(messages[0], list):
+        messages = messages[0]  # minus one level of nesting
+
+    # Validate structure
+    if not (isinstance(messages, list) and all(isinstance(m, dict) for m in messages)):
+        raise ValueError(f"Invalid message format: {messages}")
+
+    if len(messages) == 0:
+        raise ValueError("messages field is empty.")
+
+    return messages
+
+
+def _truncate_and_pad(input_ids, labels, tokenizer, max_seq_length):
+    """Truncates or right-pads a (1 x n) example to (1 x max_seq_length) and builds its attention mask."""
     # Now padding and truncation. When used earlier, results in 0 gradients
-    if input_ids.shape[1] > max_seq_length:
+    if input_ids.shape[1] >= max_seq_length: # (no padding at exactly max_seq_length, else the mask would be all zeros)
         input_ids = input_ids[:, :max_seq_length]
         labels = labels[:, :max_seq_length]
         attention_mask = torch.ones_like(input_ids)
@@ -110,9 +144,167 @@ def sft_tulu_tokenize_and_truncate_v1(row, tokenizer, max_seq_length=4096):
             torch.zeros_like(input_ids[0, -padding_length:])
         ], dim=0).unsqueeze(0)
 
-    # no .flatten()
+    return input_ids, labels, attention_mask
+
+
+def sft_tulu_tokenize_v2(messages, tokenizer, max_seq_length=4096):
+    """Tokenizes and masks a conversation like `sft_tulu_tokenize_and_truncate_v1`, but in a single pass.
+
+    v1 re-tokenizes the growing conversation prefix for every non-assistant message (quadratic in the conversation
+    length). Here the conversation is rendered once per message and tokenized once. The token position of a message
+    boundary is then read from the offset mapping, and only the last few tokens before it are re-tokenized to get the
+    exact length the prefix would have on its own (BPE merges can cross the boundary). The result is identical to v1.
+
+    Args:
+        messages: A list of {"role": ..., "content": ...} dicts
+        tokenizer: A fast tokenizer
+        max_seq_length: Labels are only computed up to this length (as in v1)
+
+    Returns:
+        (input_ids, labels) as (1 x n) tensors, not yet truncated or padded
+    """
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    def render(conversation, add_generation_prompt=False):
+        return tokenizer.apply_chat_template(conversation=conversation, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    segments = [render([message]) for message in messages]
+    text = render(messages)
+    if not tokenizer.is_fast or "".join(segments) != text:
+        # no offsets, or the template does not render messages independently
+        return _sft_tulu_tokenize_v1(messages, tokenizer, max_seq_length)
+
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    token_ids = encoding["input_ids"]
+    token_ends = [end for _, end in encoding["offset_mapping"]]
+
+    def count_tokens(prefix):
+        """len(tokenizer(prefix)) for a `prefix` that agrees with `text` up to its last few tokens."""
+        n = bisect.bisect_right(token_ends, len(prefix))
+        anchor = max(n - PREFIX_CONTEXT_TOKENS, 0)
+        # don't start inside a character that is split over several byte-level tokens
+        while 0 < anchor < len(token_ids) and token_ends[anchor - 1] > encoding["offset_mapping"][anchor][0]:
+            anchor -= 1
+        if anchor > 0:
+            start = encoding["offset_mapping"][anchor][0]
+            if text[:start] == prefix[:start]:
+                tail = tokenizer(prefix[start:], add_special_tokens=False)["input_ids"]
+                check = max(1, (n - anchor) // 2)
+                if tail[:check] == token_ids[anchor:anchor + check]:
+                    return anchor + len(tail)
+        return len(tokenizer(prefix, add_special_tokens=False)["input_ids"])
+
+    input_ids = torch.tensor([token_ids], dtype=torch.long)
+    labels = input_ids.clone()
+
+    prefix_ends = np.cumsum([len(segment) for segment in segments])
+    for message_idx, message in enumerate(messages):
+        if message["role"] != "assistant":
+            message_start_idx = 0 if message_idx == 0 else count_tokens(text[:prefix_ends[message_idx - 1]])
+
+            prefix = text[:prefix_ends[message_idx]]
+            if message_idx < len(messages) - 1 and messages[message_idx + 1]["role"] == "assistant":
+                # as in v1: the assistant generation prefix is not part of the loss
+                prefix += render([message], add_generation_prompt=True)[len(segments[message_idx]):]
+            message_end_idx = count_tokens(prefix)
+
+            labels[:, message_start_idx:message_end_idx] = -100
+
+            if max_seq_length and message_end_idx >= max_seq_length:
+                break
+
+    return input_ids, labels
+
+
+def sft_tulu_tokenize_and_truncate_v2(row, tokenizer, max_seq_length=4096):
+    """Drop-in replacement for `sft_tulu_tokenize_and_truncate_v1` using `sft_tulu_tokenize_v2`."""
+    input_ids, labels = sft_tulu_tokenize_v2(_get_messages(row), tokenizer, max_seq_length=max_seq_length)
+    input_ids, labels, attention_mask = _truncate_and_pad(input_ids, labels, tokenizer, max_seq_length)
+
     row[INPUT_IDS_KEY] = input_ids
     row[LABELS_KEY] = labels
     row[ATTENTION_MASK_KEY] = attention_mask
 
     return row
+
+
+def pad_tokenized_batch(batch, pad_token_id, max_seq_length=4096):
+    """`set_transform` for a pre-tokenized dataset (see `get_tokenized_sft_dataset`).
+
+    Pads the stored real-length `input_ids`/`labels` to `max_seq_length`, so rows look exactly as if they had been
+    transformed by `sft_tulu_tokenize_and_truncate_v1`.
+    """
+    n = len(batch[INPUT_IDS_KEY])
+    input_ids = torch.full((n, max_seq_length), pad_token_id, dtype=torch.long)
+    labels = torch.full((n, max_seq_length), -100, dtype=torch.long)
+    attention_mask = torch.zeros((n, max_seq_length), dtype=torch.long)
+    for i, (ids, example_labels) in enumerate(zip(batch[INPUT_IDS_KEY], batch[LABELS_KEY])):
+        input_ids[i, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        labels[i, :len(ids)] = torch.as_tensor(example_labels, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+
+    batch[INPUT_IDS_KEY] = input_ids
+    batch[LABELS_KEY] = labels
+    batch[ATTENTION_MASK_KEY] = attention_mask
+    return batch
+
+
+def get_tokenization_cache_key(tokenizer, max_seq_length):
+    """A key that changes whenever the tokenizer, the chat template, or the maximum length change."""
+    h = hashlib.sha256()
+    h.update(tokenizer.backend_tokenizer.to_str().encode() if tokenizer.is_fast else repr(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(CHAT_TEMPLATE.encode())
+    h.update(str(max_seq_length).encode())
+    h.update(str(tokenizer.pad_token_id).encode())
+    return h.hexdigest()[:16]
+
+
+def get_tokenized_sft_dataset(dataset, tokenizer, cache_dir, max_seq_length=4096, num_proc=None):
+    """Tokenizes an sft dataset once and keeps the result as an Arrow dataset on disk.
+
+    The cache lives at `cache_dir/<dataset fingerprint>_<tokenization key>` and is reused by every later job
+    (e.g. train and test extraction). Rows are stored with their real length only and padded on access.
+
+    Args:
+        dataset: A `datasets.Dataset` with a `messages` column
+        tokenizer: The tokenizer to use
+        cache_dir: Where to store tokenized datasets
+        max_seq_length: Maximum sequence length
+        num_proc: Number of processes for `datasets.map`
+
+    Returns:
+        The tokenized dataset, with a transform that pads rows to `max_seq_length`
+    """
+    from datasets import load_from_disk
+
+    path = os.path.join(cache_dir, f"{dataset._fingerprint}_{get_tokenization_cache_key(tokenizer, max_seq_length)}")
+    if os.path.isdir(path):
+        logging.info(f"loading tokenized dataset from {path}")
+        tokenized = load_from_disk(path)
+    else:
+        logging.info(f"tokenizing dataset into {path} ...")
+
+        def tokenize(row):
+            input_ids, labels = sft_tulu_tokenize_v2(_get_messages(row), tokenizer, max_seq_length=max_seq_length)
+            input_ids, labels = input_ids[0, :max_seq_length], labels[0, :max_seq_length]
+            return {
+                INPUT_IDS_KEY: input_ids.numpy().astype(np.int32),
+                LABELS_KEY: labels.numpy().astype(np.int32),
+                LENGTH_KEY: len(input_ids),
+            }
+
+        tokenized = dataset.map(tokenize, num_proc=num_proc, desc="Tokenizing")
+        tmp_path = f"{path}.tmp{os.getpid()}" # workers of a sharded extraction may tokenize at the same time
+        tokenized.save_to_disk(tmp_path)
+        try:
+            os.rename(tmp_path, path) # atomic, so a crashed job never leaves a half-written cache behind
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp_path) # another worker was faster
+        tokenized = load_from_disk(path)
+        logging.info(f"... tokenized dataset stored")
+
+    pad_token_id = tokenizer.pad_token_id
+    tokenized.set_transform(lambda x: pad_tokenized_batch(x, pad_token_id, max_seq_length=max_seq_length))
+    return tokenized
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import resource
+import contextlib
+from collections import defaultdict
+import torch
+
+# stages of the extraction, in pipeline order
+STAGES = ["transform", "collate", "forward", "backward", "pad", "projection", "to_host", "save", "accumulate"]
+
+
+class ExtractionProfiler:
+    """Per-stage timers, token counts and peak memory of the gradient extraction.
+
+    Code wraps its stages in `stage(name)`. Every mini-batch ends with `end_batch` (one "batch" record) and every
+    chunk with `end_chunk` (one "chunk" record with the stage totals, throughput, padding and peak memory). Records
+    are appended to a JSONL file and logged to wandb if a run is given. On CUDA, stage boundaries synchronize the
+    device, so kernels are counted in the stage that launched them.
+
+    A disabled profiler does nothing, so the extraction code can call it unconditionally. Optionally, a
+    `torch.profiler` trace is recorded for a window of mini-batches (see `start_torch_profiler`).
+    """
+
+    def __init__(self, path=None, run=None, device=None, enabled=True):
+        """
+        Args:
+            path: The JSONL file records are appended to
+            run: A wandb run chunk records are logged to
+            device: The device gradients are computed on (for synchronization and peak memory)
+            enabled: Whether to time anything at all
+        """
+        self.enabled = enabled
+        self.run = run
+        self.device = torch.device(device) if device is not None else None
+        self.cuda = self.device is not None and self.device.type == "cuda"
+        self.file = open(path, "a", encoding="utf-8") if enabled and path else None
+        self.torch_profiler = None
+        self.batch_times = defaultdict(float)
+        self.start_chunk()
+
+    def _synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed code as stage `name` (added up within a batch and a chunk)."""
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            elapsed = time.perf_counter() - start
+            self.batch_times[name] += elapsed
+            self.chunk_times[name] += elapsed
+
+    def start_chunk(self):
+        self.chunk_times = defaultdict(float)
+        self.chunk_counts = defaultdict(int)
+        self.chunk_start = time.perf_counter()
+        if self.enabled and self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def start_batch(self):
+        self.batch_times = defaultdict(float)
+        self.batch_start = time.perf_counter()
+
+    def end_batch(self, num_examples, num_tokens, num_padded_tokens):
+        """Records a mini-batch of `num_examples` with `num_tokens` real tokens, padded to `num_padded_tokens`."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+        if not self.enabled:
+            return
+        self.chunk_counts["examples"] += num_examples
+        self.chunk_counts["tokens"] += num_tokens
+        self.chunk_counts["padded_tokens"] += num_padded_tokens
+        self._write({
+            "kind": "batch",
+            "examples": num_examples,
+            "tokens": num_tokens,
+            "padded_tokens": num_padded_tokens,
+            "wall_s": time.perf_counter() - self.batch_start,
+            "stages": dict(self.batch_times),
+        })
+
+    def end_chunk(self, **info):
+        """Writes the summary of the chunk (with `info`, e.g. the shard name) and starts the next one."""
+        if not self.enabled:
+            return
+        wall = time.perf_counter() - self.chunk_start
+        examples, tokens, padded = self.chunk_counts["examples"], self.chunk_counts["tokens"], self.chunk_counts["padded_tokens"]
+        record = {
+            "kind": "chunk",
+            **info,
+            "examples": examples,
+            "tokens": tokens,
+            "padded_tokens": padded,
+            "padding_ratio": 1 - tokens / padded if padded else 0.0,
+            "wall_s": wall,
+            "examples_per_s": examples / wall if wall else 0.0,
+            "tokens_per_s": tokens / wall if wall else 0.0,
+            "stages": dict(self.chunk_times),
+            "stages_per_example": {name: t / examples for name, t in self.chunk_times.items()} if examples else {},
+            "peak_device_memory_mb": torch.cuda.max_memory_allocated(self.device) / 2**20 if self.cuda else None,
+            "peak_host_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, # KB on Linux
+        }
+        self._write(record)
+        if self.run is not None:
+            metrics = {f"profile/{key}": value for key, value in record.items() if isinstance(value, (int, float))}
+            metrics.update({f"profile/stage/{name}": t for name, t in self.chunk_times.items()})
+            self.run.log(metrics, commit=False)
+        self.start_chunk()
+
+    def start_torch_profiler(self, trace_dir, num_steps, wait=1):
+        """Records a `torch.profiler` trace (for TensorBoard / Perfetto) of `num_steps` mini-batches, after `wait`
+        mini-batches and one warm-up mini-batch."""
+        activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.cuda else [])
+        self.torch_profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=1, active=num_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+            profile_memory=True,
+        )
+        os.makedirs(trace_dir, exist_ok=True)
+        self.torch_profiler.start()
+
+    def _write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
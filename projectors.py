@@ -0,0 +1,256 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from trak.projectors import AbstractProjector, CudaProjector, ProjectionType
+
+# projections that are not a dense matrix of iid entries
+STRUCTURED_PROJECTION_TYPES = ["srht", "countsketch", "achlioptas", "very_sparse"]
+PROJECTION_TYPES = [e.name for e in ProjectionType] + STRUCTURED_PROJECTION_TYPES
+# projections whose first k output coordinates are a projection to k dimensions as well (iid columns, or sampled
+# coordinates of a transform). The sparse ones hash into and are scaled by proj_dim, so a prefix of them is not.
+PREFIX_PROJECTION_TYPES = [e.name for e in ProjectionType] + ["srht"]
+
+MASK_32 = 0xFFFFFFFF
+
+
+class CpuProjector(AbstractProjector):
+    """
+    A random projection for the CPU with the same interface (and seeding convention: `seed + 1e4 * model_id`) as
+    trak's CudaProjector.
+
+    The (grad_dim x proj_dim) matrix is never materialised. It is generated tile by tile, each tile from its own
+    seed (base seed, model id, tile row, tile column), projected against, and dropped again. Tiles have a fixed shape,
+    so the result only depends on the seed, not on the number of threads or the batch size. Entry (i, j) of the matrix
+    does not depend on grad_dim or proj_dim either: a shorter input behaves like a zero-padded one, and the first k
+    output dimensions are the same (up to float rounding) for every proj_dim >= k.
+
+    Note: fast_jl (behind CudaProjector) uses its own random number generator, so projections are deterministic and
+    distributed the same way, but not numerically identical to those computed on the GPU.
+    """
+
+    TILE_ROWS = 2**12
+    TILE_COLS = 2**12
+
+    def __init__(
+        self,
+        grad_dim: int,
+        proj_dim: int,
+        seed: int,
+        proj_type: ProjectionType,
+        device="cpu",
+        num_threads: int = None,
+        *args,
+        **kwargs,
+    ) -> None:
+        """
+        Args:
+            grad_dim (int):
+                Number of parameters
+            proj_dim (int):
+                Dimension we project *to* during the projection step
+            seed (int):
+                Random seed
+            proj_type (ProjectionType):
+                Type of randomness to use for projection matrix (rademacher or normal)
+            device:
+                Must be the CPU
+            num_threads (int):
+                Number of threads generating and multiplying tiles (default: torch.get_num_threads()).
+                Peak memory is about num_threads tiles (64 MB each) plus the output.
+        """
+        super().__init__(grad_dim, proj_dim, seed, ProjectionType(proj_type), device)
+        if torch.device(device).type != "cpu":
+            raise ValueError("CpuProjector only works on the CPU; use the CudaProjector on a CUDA device")
+        self.num_threads = num_threads or torch.get_num_threads()
+
+    def generate_tile(self, model_id, tile_row, tile_col):
+        """Returns the (TILE_ROWS x TILE_COLS) float32 tile of the projection matrix at (tile_row, tile_col)."""
+        seed_sequence = np.random.SeedSequence([self.seed + int(1e4) * model_id, tile_row, tile_col])
+        if self.proj_type == ProjectionType.normal:
+            generator = torch.Generator().manual_seed(int(seed_sequence.generate_state(1, dtype=np.uint64)[0]))
+            return torch.randn(self.TILE_ROWS, self.TILE_COLS, generator=generator)
+        elif self.proj_type == ProjectionType.rademacher:
+            # one random bit per entry
+            bits = np.random.default_rng(seed_sequence).integers(0, 256, size=(self.TILE_ROWS, self.TILE_COLS // 8), dtype=np.uint8)
+            tile = np.unpackbits(bits, axis=-1).astype(np.float32)
+            # going from Bernoulli {0, 1} to Rademacher {-1, 1}
+            tile *= 2.0
+            tile -= 1.0
+            return torch.from_numpy(tile)
+        else:
+            raise KeyError(f"Projection type {self.proj_type} not recognized.")
+
+    def project(self, grads, model_id: int):
+        if isinstance(grads, dict):
+            raise NotImplementedError("CpuProjector expects a (batch x grad_dim) tensor")
+        input_dtype = grads.dtype
+        grads = grads.to(self.device)
+        if grads.shape[-1] > self.grad_dim:
+            raise ValueError(f"Gradients of dimension {grads.shape[-1]} do not fit a projector for grad_dim={self.grad_dim}")
+
+        # row tiles where every gradient of the batch is zero (e.g. padding) don't contribute
+        tile_rows = [
+            r for r in range(-(-grads.shape[-1] // self.TILE_ROWS))
+            if grads[:, r * self.TILE_ROWS:(r + 1) * self.TILE_ROWS].any()
+        ]
+        blocks = {r: grads[:, r * self.TILE_ROWS:(r + 1) * self.TILE_ROWS].float() for r in tile_rows}
+
+        sketch = torch.zeros(grads.shape[0], self.proj_dim, dtype=torch.float32)
+
+        def project_columns(tile_col):
+            # each thread owns whole output columns: no locking, and a fixed summation order
+            start = tile_col * self.TILE_COLS
+            end = min(start + self.TILE_COLS, self.proj_dim)
+            for r in tile_rows:
+                block = blocks[r]
+                tile = self.generate_tile(model_id, r, tile_col)
+                sketch[:, start:end] += block @ tile[:block.shape[-1], :end - start]
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            list(pool.map(project_columns, range(-(-self.proj_dim // self.TILE_COLS))))
+
+        return sketch.to(input_dtype)
+
+    def free_memory(self):
+        """A no-op method."""
+        pass
+
+
+def _mul_32(x, c):
+    """(x * c) mod 2**32 for int64 tensors x < 2**32 and a constant c < 2**32, without int64 overflow."""
+    high = ((x * (c >> 16)) & 0xFFFF) << 16
+    return (high + x * (c & 0xFFFF)) & MASK_32
+
+
+def _hash_32(x):
+    """A 32-bit integer hash (lowbias32), computed with int64 tensor ops so it is the same on every device."""
+    x = x & MASK_32
+    x = x ^ (x >> 16)
+    x = _mul_32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = _mul_32(x, 0x846CA68B)
+    x = x ^ (x >> 16)
+    return x
+
+
+def _seed_32(seed, model_id):
+    return int(_hash_32(torch.tensor(seed + int(1e4) * model_id, dtype=torch.long)))
+
+
+class SRHTProjector(AbstractProjector):
+    """
+    Subsampled randomized Hadamard transform: random signs, a fast Walsh-Hadamard transform (O(d log d) instead of
+    O(d k)), and k sampled output coordinates. Like trak's projections it is unnormalised: E[|Px|^2] = k |x|^2.
+
+    Gradients are zero-padded to the next power of two. The k coordinates are the first k of a seeded permutation,
+    so a smaller proj_dim gives a prefix of a larger one.
+    """
+
+    def __init__(self, grad_dim, proj_dim, seed, device="cpu", *args, **kwargs):
+        super().__init__(grad_dim, proj_dim, seed, "srht", device)
+        self.padded_dim = 2 ** math.ceil(math.log2(grad_dim))
+        if proj_dim > self.padded_dim:
+            raise ValueError(f"proj_dim={proj_dim} is larger than the padded gradient dimension {self.padded_dim}")
+        self.model_id = None
+
+    def _setup(self, model_id):
+        if self.model_id == model_id:
+            return
+        seed = _seed_32(self.seed, model_id)
+        coordinates = torch.arange(self.grad_dim, dtype=torch.long)
+        self.signs = (1 - 2 * (_hash_32(coordinates ^ seed) & 1)).to(self.device, torch.float32)
+        generator = torch.Generator().manual_seed(seed)
+        self.sample = torch.randperm(self.padded_dim, generator=generator)[:self.proj_dim].to(self.device)
+        self.model_id = model_id
+
+    def project(self, grads, model_id):
+        self._setup(model_id)
+        input_dtype = grads.dtype
+        x = torch.zeros(grads.shape[0], self.padded_dim, dtype=torch.float32, device=self.device)
+        x[:, :grads.shape[-1]] = grads.to(self.device, torch.float32) * self.signs[:grads.shape[-1]]
+
+        # in-place-free fast Walsh-Hadamard transform, one butterfly stage per step
+        h = 1
+        while h < self.padded_dim:
+            x = x.view(x.shape[0], -1, 2, h)
+            x = torch.stack([x[:, :, 0] + x[:, :, 1], x[:, :, 0] - x[:, :, 1]], dim=2)
+            h *= 2
+        x = x.view(x.shape[0], self.padded_dim)
+
+        return x[:, self.sample].to(input_dtype)
+
+
+class SparseProjector(AbstractProjector):
+    """
+    A sparse random projection where every gradient coordinate is sent to `nnz_per_coordinate` hashed output
+    coordinates with random signs, scaled so that E[|Px|^2] = k |x|^2 (as for the dense projections).
+
+    - countsketch: one output coordinate per input coordinate (O(d))
+    - achlioptas: density 1/3 (Achlioptas, 2003)
+    - very_sparse: density 1/sqrt(d) (Li, Hastie & Church, 2006)
+
+    The matrix is never stored: positions and signs are recomputed from an integer hash of (seed, coordinate, slot),
+    which gives the same matrix on every device.
+    """
+
+    BLOCK_NNZ = 2**22
+
+    def __init__(self, grad_dim, proj_dim, seed, proj_type, device="cpu", *args, **kwargs):
+        super().__init__(grad_dim, proj_dim, seed, proj_type, device)
+        if proj_type == "countsketch":
+            self.nnz_per_coordinate = 1
+        elif proj_type == "achlioptas":
+            self.nnz_per_coordinate = math.ceil(proj_dim / 3)
+        elif proj_type == "very_sparse":
+            self.nnz_per_coordinate = math.ceil(proj_dim / math.sqrt(grad_dim))
+        else:
+            raise KeyError(f"Projection type {proj_type} not recognized.")
+        self.scale = math.sqrt(proj_dim / self.nnz_per_coordinate)
+        self.block_rows = max(1, self.BLOCK_NNZ // self.nnz_per_coordinate)
+
+    def project(self, grads, model_id):
+        input_dtype = grads.dtype
+        grads = grads.to(self.device)
+        seed = _seed_32(self.seed, model_id)
+        slots = torch.arange(self.nnz_per_coordinate, dtype=torch.long, device=self.device)
+        sketch = torch.zeros(grads.shape[0], self.proj_dim, dtype=torch.float32, device=self.device)
+
+        for start in range(0, grads.shape[-1], self.block_rows):
+            block = grads[:, start:start + self.block_rows]
+            if not block.any(): # e.g. padding
+                continue
+            coordinates = torch.arange(start, start + block.shape[-1], dtype=torch.long, device=self.device)
+            keys = _hash_32(_hash_32(coordinates ^ seed)[:, None] + slots[None, :])
+            columns = (keys % self.proj_dim).flatten()
+            signs = (1 - 2 * (_hash_32(keys + 1) & 1)).to(torch.float32).flatten()
+            values = block.float().repeat_interleave(self.nnz_per_coordinate, dim=-1) * signs
+            sketch.index_add_(1, columns, values)
+
+        return (sketch * self.scale).to(input_dtype)
+
+
+def get_projector(proj_type, grad_dim, proj_dim, seed, backend, device, max_batch_size=8):
+    """Creates the projector for a `--proj_type`.
+
+    Args:
+        proj_type: One of PROJECTION_TYPES
+        grad_dim: Dimension of the gradients
+        proj_dim: Dimension of the projected gradients
+        seed: Random seed
+        backend: 'cuda' or 'cpu'. Dense projections use the CudaProjector or CpuProjector,
+            structured ones run on `device` or the CPU
+        device: The CUDA device for the 'cuda' backend
+        max_batch_size: Batch size of the CudaProjector
+
+    Returns:
+        A projector with a `project(grads, model_id)` method
+    """
+    projector_device = device if backend == "cuda" else "cpu"
+    if proj_type == "srht":
+        return SRHTProjector(grad_dim, proj_dim, seed, device=projector_device)
+    if proj_type in STRUCTURED_PROJECTION_TYPES:
+        return SparseProjector(grad_dim, proj_dim, seed, proj_type, device=projector_device)
+    if backend == "cpu":
+        return CpuProjector(grad_dim=grad_dim, proj_dim=proj_dim, seed=seed, proj_type=ProjectionType[proj_type], device="cpu")
+    return CudaProjector(grad_dim=grad_dim, proj_dim=proj_dim, seed=seed, proj_type=ProjectionType[proj_type], device=device, max_batch_size=max_batch_size)
@@ -0,0 +1,161 @@
+import torch
+
+# --storage_dtype of dense gradient stores
+STORAGE_DTYPES = ["float16", "int8", "int4"]
+BITS = {"int8": 8, "int4": 4}
+
+CODES_KEY = "codes"
+SCALES_KEY = "scales"
+BITS_KEY = "bits"
+BLOCK_SIZE_KEY = "block_size"
+DIM_KEY = "dim"
+
+# the int32 accumulator of an integer GEMM holds sums of up to 2**31 / 127**2 products
+MAX_GEMM_DEPTH = 2**16
+
+
+def max_code(bits):
+    return 2 ** (bits - 1) - 1
+
+
+def get_block_size(dim, block_size):
+    """Number of coordinates that share a scale (0 or None: one scale per row)."""
+    return min(block_size or dim, dim)
+
+
+def num_blocks(dim, block_size):
+    return -(-dim // get_block_size(dim, block_size))
+
+
+def code_dim(dim, bits):
+    """Number of bytes per row: 4-bit codes are packed two per byte."""
+    return dim if bits == 8 else -(-dim // 2)
+
+
+def quantize(x, bits, block_size):
+    """Symmetric absmax quantization of (n x dim) gradients, with one float32 scale per block of `block_size`
+    consecutive coordinates of a row.
+
+    Returns:
+        A quantized dict: `codes` (int8, or two 4-bit codes per uint8), `scales` [n, num_blocks], `bits`,
+        `block_size` and `dim`
+    """
+    n, dim = x.shape
+    size = get_block_size(dim, block_size)
+    blocks = num_blocks(dim, block_size)
+    padded = torch.zeros(n, blocks * size, dtype=torch.float32, device=x.device)
+    padded[:, :dim] = x
+    padded = padded.view(n, blocks, size)
+    scales = padded.abs().amax(dim=-1) / max_code(bits)
+    codes = torch.round(padded / torch.where(scales > 0, scales, 1.0)[..., None]).clamp(-max_code(bits), max_code(bits))
+    codes = codes.to(torch.int8).view(n, blocks * size)[:, :dim]
+    if bits == 4:
+        codes = pack_int4(codes)
+    return {CODES_KEY: codes, SCALES_KEY: scales, BITS_KEY: bits, BLOCK_SIZE_KEY: size, DIM_KEY: dim}
+
+
+def pack_int4(codes):
+    """Packs int8 codes in [-7, 7] two per byte (low nibble first), offset by 8."""
+    if codes.shape[-1] % 2:
+        codes = torch.nn.functional.pad(codes, (0, 1))
+    nibbles = (codes.to(torch.int16) + 8).to(torch.uint8)
+    return nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+
+def unpack_int4(packed, dim):
+    low = (packed & 0xF).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack([low, high], dim=-1).view(len(packed), -1)[:, :dim]
+
+
+def is_quantized(gradients):
+    return isinstance(gradients, dict) and CODES_KEY in gradients
+
+
+def num_examples(quantized):
+    return len(quantized[CODES_KEY])
+
+
+def select(quantized, index):
+    """The rows `index` (a slice or indices) of a quantized dict."""
+    return {**quantized, CODES_KEY: quantized[CODES_KEY][index], SCALES_KEY: quantized[SCALES_KEY][index]}
+
+
+def to(quantized, device):
+    return {**quantized, CODES_KEY: quantized[CODES_KEY].to(device), SCALES_KEY: quantized[SCALES_KEY].to(device, torch.float32)}
+
+
+def int8_codes(quantized):
+    """(n x dim) int8 codes, unpacked if needed."""
+    codes = quantized[CODES_KEY]
+    if quantized[BITS_KEY] == 4:
+        return unpack_int4(codes, quantized[DIM_KEY])
+    return codes
+
+
+def _blocks(quantized):
+    """Yields (first coordinate, last coordinate, block index) of every block of scales."""
+    size, dim = quantized[BLOCK_SIZE_KEY], quantized[DIM_KEY]
+    for b, start in enumerate(range(0, dim, size)):
+        yield start, min(start + size, dim), b
+
+
+def dequantize(quantized):
+    """(n x dim) float32 gradients."""
+    codes = int8_codes(quantized)
+    x = torch.empty(codes.shape, dtype=torch.float32, device=codes.device)
+    for start, end, b in _blocks(quantized):
+        x[:, start:end] = codes[:, start:end].float() * quantized[SCALES_KEY][:, b, None]
+    return x
+
+
+def norms(quantized):
+    """L2 norm of every (dequantized) gradient, from the codes: |x|^2 = sum over blocks of scale^2 |codes|^2."""
+    codes = int8_codes(quantized)
+    squared = torch.zeros(len(codes), dtype=torch.float32, device=codes.device)
+    for start, end, b in _blocks(quantized):
+        squared += codes[:, start:end].float().square().sum(dim=-1) * quantized[SCALES_KEY][:, b].square()
+    return squared.sqrt()
+
+
+def _integer_matmul(a, b):
+    """a @ b.T of int8 codes, exact in int32.
+
+    torch._int_mm is only used for a depth (a.shape[1]) of at least 8 and a multiple of 8 (it returns wrong sums
+    for a depth of 1 on the CPU), and on CUDA only for the shapes it supports. Other blocks (e.g. the tail block of an
+    odd dimension) take an int64 matmul, or a float64 one on CUDA (which has no integer matmul), exact as well since
+    the sums of at most MAX_GEMM_DEPTH products stay far below 2**53.
+    """
+    depth = a.shape[1]
+    if depth >= 8 and depth % 8 == 0 and (not a.is_cuda or (len(a) > 16 and len(b) % 8 == 0)):
+        return torch._int_mm(a, b.T)
+    if a.is_cuda:
+        return (a.double() @ b.double().T).to(torch.int32)
+    return (a.long() @ b.long().T).to(torch.int32)
+
+
+def dot(train, test):
+    """Dot products between all train and test gradients, computed on the codes.
+
+    Every block of coordinates takes one integer GEMM of the codes, which is then scaled by the outer product of
+    the blocks' scales: x . y = sum over blocks b of s_x[b] s_y[b] (q_x[b] . q_y[b]). 4-bit codes are unpacked to
+    int8 first, nothing is dequantized.
+
+    Args:
+        train: A quantized dict (N gradients)
+        test: A quantized dict (M gradients) with the same dimension and block size
+
+    Returns:
+        A [N, M] float32 tensor of scores
+    """
+    if train[DIM_KEY] != test[DIM_KEY] or train[BLOCK_SIZE_KEY] != test[BLOCK_SIZE_KEY]:
+        raise ValueError("Train and test gradients are quantized with different dimensions or block sizes.")
+    train_codes, test_codes = int8_codes(train), int8_codes(test)
+    scores = torch.zeros(len(train_codes), len(test_codes), dtype=torch.float32, device=train_codes.device)
+    for start, end, b in _blocks(train):
+        products = sum(
+            _integer_matmul(train_codes[:, k:min(k + MAX_GEMM_DEPTH, end)].contiguous(), test_codes[:, k:min(k + MAX_GEMM_DEPTH, end)].contiguous()).double()
+            for k in range(start, end, MAX_GEMM_DEPTH)
+        ) if end - start > MAX_GEMM_DEPTH else _integer_matmul(train_codes[:, start:end].contiguous(), test_codes[:, start:end].contiguous())
+        scores += products.float() * (train[SCALES_KEY][:, b, None] * test[SCALES_KEY][None, :, b])
+    return scores
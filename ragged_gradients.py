@@ -0,0 +1,119 @@
+import torch
+
+VALUES_KEY = "values"
+OFFSETS_KEY = "offsets"
+STARTS_KEY = "starts"
+LENGTHS_KEY = "lengths"
+MAX_LENGTH_KEY = "max_length"
+
+
+def to_ragged(rows, max_length):
+    """Packs per-example gradients (one [length, hidden] tensor per example) into a ragged, offset-indexed form.
+
+    Only the rows of real tokens are kept. Example `i` owns `values[offsets[i]:offsets[i+1]]`, i.e. the gradient irt
+    to its first `offsets[i+1] - offsets[i]` input embeddings. All other positions (up to `max_length`) are zero.
+
+    Shards written out of order (see gradient_store.AsyncShardWriter) instead store `starts` and `lengths`:
+    example `i` owns `values[starts[i]:starts[i]+lengths[i]]`.
+
+    Args:
+        rows: A list of 2D tensors
+        max_length: The padded sequence length the examples were tokenized to
+
+    Returns:
+        A dict with the concatenated `values`, the `offsets` (len(rows) + 1) and `max_length`
+    """
+    lengths = torch.tensor([len(r) for r in rows], dtype=torch.long)
+    offsets = torch.zeros(len(rows) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(lengths, dim=0)
+    return {
+        VALUES_KEY: torch.cat(rows),
+        OFFSETS_KEY: offsets,
+        MAX_LENGTH_KEY: max_length,
+    }
+
+
+def is_ragged(gradients):
+    return isinstance(gradients, dict) and VALUES_KEY in gradients and (OFFSETS_KEY in gradients or STARTS_KEY in gradients)
+
+
+def starts_and_lengths(ragged):
+    if STARTS_KEY in ragged:
+        return ragged[STARTS_KEY], ragged[LENGTHS_KEY]
+    offsets = ragged[OFFSETS_KEY]
+    return offsets[:-1], offsets[1:] - offsets[:-1]
+
+
+def pad_rows(rows, max_length):
+    """Zero-pads a [length, hidden] gradient back to [max_length, hidden]."""
+    padded = rows.new_zeros(max_length, rows.shape[-1])
+    padded[:len(rows)] = rows
+    return padded
+
+
+def num_examples(ragged):
+    return len(starts_and_lengths(ragged)[1])
+
+
+def grad_dim(ragged):
+    """Dimension of the equivalent dense (flattened, padded) gradient."""
+    return ragged[MAX_LENGTH_KEY] * ragged[VALUES_KEY].shape[-1]
+
+
+def row_index(ragged):
+    """Returns (example id, row in `values`, position within the example) for every stored row."""
+    starts, lengths = starts_and_lengths(ragged)
+    example_ids = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    positions = torch.arange(len(example_ids)) - torch.repeat_interleave(torch.cumsum(lengths, dim=0) - lengths, lengths)
+    return example_ids, starts[example_ids] + positions, positions
+
+
+def norms(ragged):
+    """L2 norm of every example's (dense) gradient, computed in float32."""
+    example_ids, rows, _ = row_index(ragged)
+    squared = torch.cat([(v.float() ** 2).sum(dim=-1) for v in ragged[VALUES_KEY].split(2**16)])[rows]
+    return torch.zeros(num_examples(ragged)).index_add_(0, example_ids, squared).sqrt()
+
+
+def _group_by_position(ragged):
+    """Returns a dict position -> (example ids, row indices) of the rows at that position."""
+    example_ids, rows, positions = row_index(ragged)
+    order = torch.argsort(positions, stable=True)
+    counts = torch.bincount(positions).tolist()
+    groups = {}
+    for position, group in enumerate(torch.split(order, counts)):
+        if len(group) > 0:
+            groups[position] = (example_ids[group], rows[group])
+    return groups
+
+
+def dot(train, test):
+    """Dot products between all train and test gradients without densifying them.
+
+    Position `t` of a train gradient only meets position `t` of a test gradient, so the dot product is the sum over
+    positions of the row-wise products, restricted to positions both examples actually have.
+
+    Args:
+        train: A ragged gradient dict (N examples)
+        test: A ragged gradient dict (M examples)
+
+    Returns:
+        A [N, M] float32 tensor of scores
+    """
+    if train[VALUES_KEY].shape[-1] != test[VALUES_KEY].shape[-1]:
+        raise ValueError("Incompatible gradient dimensions.")
+
+    scores = torch.zeros(num_examples(train), num_examples(test))
+    train_groups = _group_by_position(train)
+    for position, (test_ids, test_rows) in _group_by_position(test).items():
+        if position not in train_groups:
+            continue
+        train_ids, train_rows = train_groups[position]
+        block = train[VALUES_KEY][train_rows].float() @ test[VALUES_KEY][test_rows].float().T
+        scores.index_put_((train_ids[:, None], test_ids[None, :]), block, accumulate=True)
+    return scores
+
+
+def cosine(train, test, eps=1e-12):
+    """Cosine similarities between all train and test gradients (same clamping as `F.normalize`)."""
+    return dot(train, test) / (norms(train).clamp_min(eps)[:, None] * norms(test).clamp_min(eps)[None, :])
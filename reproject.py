@@ -0,0 +1,142 @@
+import os
+import logging
+import argparse
+import multiprocessing
+import torch
+from trak.projectors import CudaProjector
+
+import ragged_gradients
+from gradient_store import GradientStore, AsyncShardWriter, merge_worker_manifests, shard_exists, worker_manifest_file
+from projectors import get_projector, PROJECTION_TYPES
+from quantization import STORAGE_DTYPES, BITS
+
+PROJECTOR_MAX_BATCH_SIZE = 8
+
+# manifest keys that describe the stored gradients rather than where they come from
+GRADIENT_MANIFEST_KEYS = ["format_version", "shards", "num_rows", "kind", "dtype", "dim", "hidden_size", "max_length", "quantization", "projection"]
+
+parser = argparse.ArgumentParser("reproject")
+parser.add_argument("paths", help="Stores of full gradients (one per checkpoint), e.g. ./gradients/full/OLMo-2-1124-7B-SFT/sampled-tulu-1000/train/main", nargs="+")
+parser.add_argument("--proj_dim", help="Dimension(s) of the projected gradients, one output store each", type=int, nargs="+", default=[2**14])
+parser.add_argument("--proj_type", help="Type(s) of projection, one output store each", type=str, nargs="+", default=["rademacher"], choices=PROJECTION_TYPES)
+parser.add_argument("--projector_backend", help="Where to project: 'cpu' (CpuProjector) or 'cuda' (trak CudaProjector / on --device)", choices=["cuda", "cpu"], default="cpu")
+parser.add_argument("--device", help="The CUDA device of the 'cuda' backend", default="cuda:0")
+parser.add_argument("--seed", help="Seed of the projections (extract_gradients.py uses 42)", type=int, default=42)
+parser.add_argument("--storage_dtype", help="How the new stores keep the gradients: float16, or int8 / 4-bit codes with a float32 scale per block (folders get the dtype as a suffix)", choices=STORAGE_DTYPES, default="float16")
+parser.add_argument("--quant_block_size", help="Number of coordinates of a row that share a scale with --storage_dtype int8/int4 (0: one scale per row)", type=int, default=0)
+parser.add_argument("--gradients_output_path", help="Where to write the new stores (default: next to the 'full' folder of each input, as extract_gradients.py would)", default=None)
+parser.add_argument("--num_workers", help="Number of processes, each projecting every num_workers-th shard", type=int, default=1)
+parser.add_argument("--num_threads", help="Number of torch threads per process (default: the CPUs divided by --num_workers)", type=int, default=None)
+parser.add_argument("--max_memory_mb", help="Memory budget per process for the gradients of one chunk (fp16 rows and their float32 copy)", type=int, default=4096)
+parser.add_argument("--writer_queue_size", help="Number of chunks that may wait for the background writer", type=int, default=4)
+
+
+def get_output_dir(source, folder, gradients_output_path=None):
+    """The store a projection of `source` goes to: `folder` (e.g. 'rademacher_16384') replaces the 'full' folder
+    (or 'full_ragged', 'full_int8', ...) of `<gradients_output_path>/full/<model>/<dataset>/<split>/<checkpoint>`."""
+    parts = os.path.normpath(os.path.abspath(source)).split(os.sep)
+    if len(parts) < 5 or not parts[-5].startswith("full"):
+        if gradients_output_path is None:
+            raise ValueError(f"{source} is not in a 'full' folder of extract_gradients.py, set --gradients_output_path")
+        return os.path.join(gradients_output_path, folder, *parts[-4:])
+    root = gradients_output_path if gradients_output_path is not None else os.sep.join(parts[:-5])
+    return os.path.join(root, folder, *parts[-4:])
+
+
+def read_chunk(store, k, start, end):
+    """Rows start:end of shard `k` as a dense [n, dim] tensor (ragged gradients are padded back, quantized ones
+    dequantized)."""
+    if not store.ragged:
+        return store.rows(store.shards[k]["start"] + start, store.shards[k]["start"] + end)
+    rows = store.shard_rows(k)
+    starts, lengths = ragged_gradients.starts_and_lengths(rows)
+    values, max_length = rows[ragged_gradients.VALUES_KEY], rows[ragged_gradients.MAX_LENGTH_KEY]
+    return torch.stack([
+        ragged_gradients.pad_rows(values[s:s + l], max_length).flatten()
+        for s, l in zip(starts[start:end].tolist(), lengths[start:end].tolist())
+    ])
+
+
+def reproject_shards(source, outputs, worker, num_workers, options):
+    """Projects the shards worker, worker + num_workers, ... of `source` into every output store.
+
+    Args:
+        source: The gradient store of full gradients
+        outputs: (output store directory, projection type, projection dim) triples
+        worker: Index of this process
+        num_workers: Number of processes
+        options: The parsed command line arguments
+    """
+    torch.set_num_threads(options.num_threads or max(1, (os.cpu_count() or 1) // num_workers))
+    store = GradientStore(source)
+    # the lineage: everything about where the gradients come from, and which store they were projected from
+    lineage = {key: value for key, value in store.manifest.items() if key not in GRADIENT_MANIFEST_KEYS}
+    lineage["source"] = {"path": os.path.abspath(source), "kind": store.manifest["kind"], "dim": store.dim, "projection": store.manifest.get("projection")}
+
+    writers, projectors = [], []
+    for directory, proj_type, proj_dim in outputs:
+        projection = {"type": proj_type, "dim": proj_dim, "seed": options.seed, "backend": options.projector_backend}
+        writers.append(AsyncShardWriter(directory, {**lineage, "projection": projection}, max_queue_size=options.writer_queue_size, manifest_file=worker_manifest_file(worker, num_workers)))
+        projectors.append(get_projector(proj_type, store.dim, proj_dim, seed=options.seed, backend=options.projector_backend, device=options.device, max_batch_size=PROJECTOR_MAX_BATCH_SIZE))
+
+    def project(projector, x):
+        # the CudaProjector only supports batches of up to PROJECTOR_MAX_BATCH_SIZE gradients
+        chunks = x.split(PROJECTOR_MAX_BATCH_SIZE) if isinstance(projector, CudaProjector) else [x]
+        return torch.cat([projector.project(chunk, model_id=0) for chunk in chunks])
+
+    # fp16 rows plus the float32 copy the projectors make
+    chunk_rows = max(1, options.max_memory_mb * 2**20 // (store.dim * 6))
+    try:
+        for k in range(worker, len(store.shards), num_workers):
+            shard = store.shards[k]
+            pending = [j for j, (directory, _, _) in enumerate(outputs) if not shard_exists(directory, shard["name"])]
+            if not pending:
+                logging.info(f"skipping {shard['name']}, already projected")
+                continue
+            num_rows = shard["end"] - shard["start"]
+            for start in range(0, num_rows, chunk_rows):
+                block = read_chunk(store, k, start, min(start + chunk_rows, num_rows)).half()
+                rows = list(range(start, start + len(block)))
+                for j in pending:
+                    projected = project(projectors[j], block).half().cpu()
+                    if start == 0 and options.storage_dtype != "float16":
+                        writers[j].open_quantized(shard["name"], shard["start"], num_rows, dim=projected.shape[-1], bits=BITS[options.storage_dtype], block_size=options.quant_block_size)
+                    elif start == 0:
+                        writers[j].open_dense(shard["name"], shard["start"], num_rows, dim=projected.shape[-1], dtype=projected.dtype)
+                    writers[j].write(shard["name"], rows, projected)
+            for j in pending:
+                writers[j].finalize(shard["name"])
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parser.parse_args()
+
+    # spawned processes start clean (no inherited CUDA or thread pool state)
+    context = multiprocessing.get_context("spawn")
+    for source in args.paths:
+        store = GradientStore(source)
+        if "factors" in store.manifest:
+            raise ValueError(f"{source} holds factors of linear layers (--gradient_layers), project them during the extraction")
+        if store.manifest.get("projection") is not None:
+            logging.warning(f"{source} holds projected gradients, projecting them again")
+        outputs = [
+            (get_output_dir(source, f"{proj_type}_{proj_dim}{'' if args.storage_dtype == 'float16' else '_' + args.storage_dtype}", args.gradients_output_path), proj_type, proj_dim)
+            for proj_type in dict.fromkeys(args.proj_type) for proj_dim in dict.fromkeys(args.proj_dim)
+        ]
+        logging.info(f"projecting {len(store)} gradients ({len(store.shards)} shards) of {source} to {', '.join(d for d, _, _ in outputs)}")
+
+        if args.num_workers == 1:
+            reproject_shards(source, outputs, 0, 1, args)
+        else:
+            with context.Pool(args.num_workers) as pool:
+                pool.starmap(reproject_shards, [(source, outputs, worker, args.num_workers, args) for worker in range(args.num_workers)])
+            for directory, _, _ in outputs:
+                manifest = merge_worker_manifests(directory, num_rows=len(store))
+                logging.info(f"merged {len(manifest['shards'])} shards ({manifest['num_rows']} gradients) into {directory}/manifest.json")
+    logging.info(f"task complete!")
@@ -0,0 +1,155 @@
+import os
+import sys
+import torch
+
+import ragged_gradients
+import factored_gradients
+import quantization
+from gradient_store import GradientStore, is_gradient_store
+
+METHODS = ["dot", "cosine"]
+
+
+def iter_gradient_blocks(paths, block_size):
+    """Yields blocks of consecutive gradients from one or more sources, without loading a gradient store at once.
+
+    Args:
+        paths: Gradient store directories (or open `GradientStore`s), single gradient files (.pt, e.g. of older runs)
+            or (n x dim) tensors already in memory, read in this order
+        block_size: Maximum number of dense gradients per block
+
+    Yields:
+        (first row, gradients) with rows counted across all sources, gradients being a (n x dim) tensor,
+        or a ragged dict (one per ragged shard/file, see ragged_gradients; factors of linear layers: factored_gradients),
+        or a quantized dict (blocks of a quantized store, see quantization)
+    """
+    offset = 0
+    for path in paths:
+        if isinstance(path, torch.Tensor):
+            for start in range(0, len(path), block_size):
+                yield offset + start, path[start:start + block_size]
+            offset += len(path)
+        elif isinstance(path, GradientStore) or is_gradient_store(path):
+            store = path if isinstance(path, GradientStore) else GradientStore(path)
+            if store.ragged:
+                for k, shard in enumerate(store.shards):
+                    yield offset + shard["start"], store.shard_rows(k)
+            else:
+                for start, block in store.iter_blocks(block_size, dequantize=False):
+                    yield offset + start, block
+            offset += len(store)
+        elif os.path.isfile(path):
+            gradients = torch.load(path)
+            if ragged_gradients.is_ragged(gradients):
+                yield offset, gradients
+                offset += ragged_gradients.num_examples(gradients)
+            else:
+                gradients = gradients.reshape(len(gradients), -1) # [N, 1, D] files
+                for start in range(0, len(gradients), block_size):
+                    yield offset + start, gradients[start:start + block_size]
+                offset += len(gradients)
+            del gradients
+        else:
+            raise FileNotFoundError(f"No gradient store or file at {path}")
+
+
+def _prepare(block, device):
+    """Moves a block to the scoring device (float32, quantized blocks keep their codes) and computes its norms."""
+    if quantization.is_quantized(block):
+        block = quantization.to(block, device)
+        return block, quantization.norms(block), block[quantization.DIM_KEY], quantization.num_examples(block)
+    if factored_gradients.is_factored(block):
+        return block, factored_gradients.norms(block), factored_gradients.grad_dim(block[factored_gradients.FACTORS_KEY]), factored_gradients.num_examples(block)
+    if ragged_gradients.is_ragged(block):
+        return block, ragged_gradients.norms(block), ragged_gradients.grad_dim(block), ragged_gradients.num_examples(block)
+    block = block.to(device, torch.float32)
+    return block, torch.linalg.vector_norm(block, dim=-1), block.shape[-1], len(block)
+
+
+def _dot(train, test):
+    if quantization.is_quantized(train) or quantization.is_quantized(test):
+        if quantization.is_quantized(train) and quantization.is_quantized(test) and train[quantization.BLOCK_SIZE_KEY] == test[quantization.BLOCK_SIZE_KEY]:
+            return quantization.dot(train, test)
+        # different formats: only the quantized block at hand is dequantized
+        train = quantization.dequantize(train) if quantization.is_quantized(train) else train
+        test = quantization.dequantize(test) if quantization.is_quantized(test) else test
+    if isinstance(train, dict) != isinstance(test, dict):
+        raise ValueError("Train and test gradients must both be ragged or both be dense.")
+    if factored_gradients.is_factored(train) != factored_gradients.is_factored(test):
+        raise ValueError("Train and test gradients must both be factored or both be unfactored.")
+    if factored_gradients.is_factored(train): # on the CPU
+        return factored_gradients.dot(train, test)
+    if isinstance(train, dict): # on the CPU
+        return ragged_gradients.dot(train, test)
+    return train @ test.T
+
+
+def _merge_top_k(best, block_scores, first_row, k):
+    """Merges the [n, N_test] scores of a block of train rows into the running top-k (per test) `best`."""
+    block_indices = torch.arange(first_row, first_row + len(block_scores)).expand(block_scores.shape[1], -1)
+    if best is not None:
+        block_scores = torch.cat([best[0], block_scores.T], dim=1)
+        block_indices = torch.cat([best[1], block_indices], dim=1)
+    else:
+        block_scores = block_scores.T
+    values, positions = torch.topk(block_scores, min(k, block_scores.shape[1]), dim=1)
+    return values, torch.gather(block_indices, 1, positions)
+
+
+def compute_scores(train_paths, test_paths, methods, device="cpu", block_size=4096, test_block_size=None, num_threads=None, top_k=None, eps=1e-12):
+    """Influence scores of all train against all test gradients.
+
+    Train gradients are streamed in blocks of `block_size` rows. Each block takes one GEMM per test block
+    (`train_block @ test_block.T`, in float32 on `device`), and cosine similarities are the same dot products
+    divided by the norms of the gradients, so 'dot' and 'cosine' together cost one pass. Peak memory is a train
+    block, the test gradients, and the [N_train, N_test] score matrices, or only [N_test, top_k] with `top_k`.
+
+    Args:
+        train_paths: Gradient store directories or files (see `iter_gradient_blocks`)
+        test_paths: Gradient store directories or files of the test gradients (or tensors, see `iter_gradient_blocks`)
+        methods: A subset of METHODS
+        device: Where to multiply (e.g., cuda:0 or cpu)
+        block_size: Number of train gradients per block
+        test_block_size: Number of test gradients per block (default: all at once)
+        num_threads: Number of CPU threads for torch (default: unchanged)
+        top_k: Only keep the `top_k` highest scores per test gradient, merged block by block
+        eps: Lower bound of the norms (as in `F.normalize`)
+
+    Returns:
+        A dict mapping each method to a [N_train, N_test] float32 tensor (on the CPU), and the gradient dimension.
+        With `top_k`, each method maps to ([N_test, top_k] scores, [N_test, top_k] train indices), best first.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    test_blocks = [
+        (start, *_prepare(block, device))
+        for start, block in iter_gradient_blocks(test_paths, test_block_size or sys.maxsize)
+    ]
+    dim = test_blocks[0][3]
+    num_tests = sum(block[4] for block in test_blocks)
+
+    scores = {method: [] for method in methods}
+    best = {method: None for method in methods}
+    for train_start, train_block in iter_gradient_blocks(train_paths, block_size):
+        train_block, train_norms, train_dim, num_train = _prepare(train_block, device)
+        if train_dim != dim:
+            raise ValueError(f"Incompatible gradient dimensions: {train_dim} (train) and {dim} (test).")
+
+        block_scores = {method: torch.empty(num_train, num_tests) for method in methods}
+        for test_start, test_block, test_norms, _, num_test in test_blocks:
+            dot = _dot(train_block, test_block)
+            if "dot" in methods:
+                block_scores["dot"][:, test_start:test_start + num_test] = dot.cpu()
+            if "cosine" in methods:
+                norms = train_norms.to(dot.device).clamp_min(eps)[:, None] * test_norms.to(dot.device).clamp_min(eps)[None, :]
+                block_scores["cosine"][:, test_start:test_start + num_test] = (dot / norms).cpu()
+        for method in methods:
+            if top_k is not None:
+                best[method] = _merge_top_k(best[method], block_scores[method], train_start, top_k)
+            else:
+                scores[method].append(block_scores[method])
+
+    if top_k is not None:
+        return best, dim
+    return {method: torch.cat(blocks) for method, blocks in scores.items()}, dim
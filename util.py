@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import json
 from huggingface_hub import hf_hub_download
 def get_curriculum(repo_id , filename):
     return torch.load(hf_hub_download(repo_id=repo_id, filename=filename, repo_type="dataset"),weights_only=True)
@@ -17,6 +18,7 @@ def get_epoch_checkpoints(model_dir):
 from huggingface_hub import snapshot_download
 
 from huggingface_hub import list_repo_refs
+from huggingface_hub.errors import LocalEntryNotFoundError
 
 def get_checkpoints_olmo(model_name="allenai/OLMo-2-1124-7B"):
 
@@ -43,6 +45,88 @@ def get_checkpoints_hub(model):
         return get_checkpoints_olmo(model)
 
 
+def resolve_checkpoints(model, names):
+    """The checkpoints `names` of a model as `get_checkpoints_hub` returns them.
+
+    OLMo checkpoints are revisions (their names). Other models get the local path of every checkpoint folder, taken
+    from the Hugging Face cache of this machine if it holds all of them, else downloaded.
+    """
+    if "OLMo" in model:
+        return list(names)
+    try:
+        local_dir = snapshot_download(repo_id=model, allow_patterns=["checkpoints/*"], local_files_only=True)
+        checkpoints = [os.path.join(local_dir, "checkpoints", name) for name in names]
+        if all(os.path.isdir(checkpoint) for checkpoint in checkpoints):
+            return checkpoints
+    except LocalEntryNotFoundError:
+        pass
+    local_dir = snapshot_download(repo_id=model, allow_patterns=["checkpoints/*"])
+    return [os.path.join(local_dir, "checkpoints", name) for name in names]
+
+
+def get_checkpoints(model, cache_dir=None):
+    """`get_checkpoints_hub`, with the list kept in `cache_dir` (one JSON file per model), so later jobs start without
+    listing the Hub.
+
+    Only the checkpoint names are kept, local paths are resolved again on every call (see `resolve_checkpoints`), so
+    the list stays valid after the Hugging Face cache is cleared and on other machines that share `cache_dir`.
+    Delete a model's file to list its checkpoints again (e.g. once new ones were pushed).
+
+    Args:
+        model: A model on the hf hub
+        cache_dir: Where to keep the checkpoint lists (None or '': list them every time)
+    """
+    if not cache_dir:
+        return list(get_checkpoints_hub(model))
+    path = os.path.join(cache_dir, model.strip("/").replace("/", "__") + ".json")
+    if os.path.isfile(path):
+        with open(path, encoding="utf-8") as f:
+            names = [os.path.basename(checkpoint) for checkpoint in json.load(f)] # lists of older runs hold paths
+        return resolve_checkpoints(model, names)
+    checkpoints = list(get_checkpoints_hub(model))
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump([os.path.basename(checkpoint) for checkpoint in checkpoints], f, indent=2)
+    os.replace(path + ".tmp", path) # concurrent workers of a job never read half a list
+    return checkpoints
+
+
+def set_hf_token():
+    """Makes HUGGINGFACE_TOKEN (from the environment or a .env file) the token of huggingface_hub.
+
+    Unlike `login`, this makes no network call: the token is only read when something is downloaded.
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+    token = os.getenv("HUGGINGFACE_TOKEN")
+    if token is not None:
+        os.environ.setdefault("HF_TOKEN", token)
+
+
+def select_checkpoints(checkpoints, specs):
+    """Picks checkpoints by id (their position in `checkpoints`, starting at 0).
+
+    Args:
+        checkpoints: All checkpoints of a model, e.g. from `get_checkpoints_hub`
+        specs: Ids, inclusive ranges ('2-5') or 'all'
+
+    Returns:
+        The selected checkpoints, in the order of `checkpoints` and without duplicates
+    """
+    ids = set()
+    for spec in specs:
+        if spec == "all":
+            ids.update(range(len(checkpoints)))
+        elif "-" in spec:
+            first, last = spec.split("-")
+            ids.update(range(int(first), int(last) + 1))
+        else:
+            ids.add(int(spec))
+    if not ids or max(ids) >= len(checkpoints):
+        raise ValueError(f"{specs} selects no checkpoints or ids beyond the {len(checkpoints)} checkpoints of the model")
+    return [checkpoints[i] for i in sorted(ids)]
+
+
 # def get_all_chunks(checkpoint_path,gradient_input_dir, gradients_per_file):
 #     return [ os.path.join(gradient_input_dir, checkpoint_path.split("-")[-1] + "_" + str(i) + "_" + str(i + gradients_per_file)) for i in range(0, len(dataset["train"]), args.gradients_per_file)]
 def get_epoch(checkpoint_path):
@@ -158,3 +242,17 @@ def batch(lst, batch_size):
 from functools import partial
 from datasets import load_dataset
 from transformers import AutoTokenizer
+
+
+def get_worker_info():
+    """Returns (worker index, number of workers, local rank) of this process.
+
+    Read from the variables torchrun (RANK, WORLD_SIZE, LOCAL_RANK) or a SLURM job array (SLURM_ARRAY_TASK_ID,
+    SLURM_ARRAY_TASK_COUNT) set. A single process is worker 0 of 1.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        return int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), int(os.getenv("LOCAL_RANK", 0))
+    if "SLURM_ARRAY_TASK_ID" in os.environ and "SLURM_ARRAY_TASK_COUNT" in os.environ:
+        task_id = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(os.getenv("SLURM_ARRAY_TASK_MIN", 0))
+        return task_id, int(os.environ["SLURM_ARRAY_TASK_COUNT"]), 0
+    return 0, 1, 0